@@ -0,0 +1,50 @@
+"""
+アルバム（grouped_id）の索引
+
+クローラーが取得時にgrouped_idごとのメッセージIDを記録しておき、
+ダウンロード時に関連メッセージを探す問い合わせをせずにアルバムを復元できるようにします。
+"""
+
+from state_store import load_json_state, save_json_state
+
+
+class AlbumIndex:
+    """(チャンネルID, grouped_id) -> アルバムに含まれるメッセージIDのリスト"""
+
+    def __init__(self, path, max_albums=200000):
+        self.path = path
+        self.max_albums = max_albums
+        self.albums = load_json_state(path, {})
+        self.added = {}  # このプロセスで追加した分（保存時にファイルの内容とマージする）
+
+    @staticmethod
+    def _key(channel_id, grouped_id):
+        return f"{channel_id}:{grouped_id}"
+
+    def add(self, channel_id, grouped_id, message_id):
+        key = self._key(channel_id, grouped_id)
+        for albums in (self.albums, self.added):
+            members = albums.setdefault(key, [])
+            if message_id not in members:
+                members.append(message_id)
+                members.sort()
+
+    def members(self, channel_id, grouped_id):
+        """記録済みのメッセージIDのリスト（なければNone）"""
+        return self.albums.get(self._key(channel_id, grouped_id))
+
+    def save(self):
+        """他のプロセス（常時実行版・都度実行版）が保存した内容とマージして保存"""
+        if not self.added:
+            return
+        albums = load_json_state(self.path, {})
+        for key, message_ids in self.added.items():
+            albums[key] = sorted(set(albums.get(key, [])) | set(message_ids))
+        # 古いアルバムから削除して上限以下に保つ（辞書は追加順）
+        overflow = len(albums) - self.max_albums
+        if overflow > 0:
+            for key in list(albums)[:overflow]:
+                del albums[key]
+        save_json_state(self.path, albums)
+        self.albums = albums
+        self.added = {}
@@ -0,0 +1,84 @@
+"""
+メッセージ抽出処理のマイクロベンチマーク
+
+合成したTelethonのMessage（テキストのみ・写真・動画・ファイル・エンティティ付き）を使って、
+extract_message() + to_dict() + json.dumps() の1件あたりの処理時間を計測します。
+Telegramへの接続は不要です。
+
+使い方:
+    python benchmark_extractor.py
+    python benchmark_extractor.py --number 200000
+"""
+
+from telethon.tl import types
+import argparse
+import datetime
+import json
+import time
+
+from message_extractor import extract_message
+
+SENDER_INFO = {
+    "bot": False,
+    "sender_user": {"user_id": 123456789, "username": "user", "phone": None, "Firstname": "Taro", "Lastname": None},
+}
+
+
+def _message(message_id, text, media=None, entities=None, grouped_id=None):
+    return types.Message(
+        id=message_id,
+        peer_id=types.PeerChannel(1234567890),
+        date=datetime.datetime(2026, 1, 17, 5, 30, tzinfo=datetime.timezone.utc),
+        message=text,
+        from_id=types.PeerUser(123456789),
+        media=media,
+        entities=entities,
+        grouped_id=grouped_id,
+    )
+
+
+def _document(attributes, mime_type):
+    return types.Document(
+        id=555, access_hash=1, file_reference=b'', date=None, mime_type=mime_type,
+        size=10 * 1024 * 1024, dc_id=2, attributes=attributes,
+    )
+
+
+def build_samples():
+    """計測用の合成メッセージ（種類ごとに1件）を作成"""
+    text = "新しい投稿です https://example.com/path を確認してください @someone"
+    photo = types.Photo(id=777, access_hash=1, file_reference=b'', date=None, sizes=[], dc_id=2)
+    return {
+        "text": _message(1, "テキストのみのメッセージ"),
+        "entities": _message(2, text, entities=[
+            types.MessageEntityBold(0, 5),
+            types.MessageEntityUrl(8, 24),
+            types.MessageEntityTextUrl(0, 5, "https://example.org/"),
+            types.MessageEntityMentionName(52, 8, 987654321),
+        ]),
+        "photo": _message(3, "", media=types.MessageMediaPhoto(photo=photo), grouped_id=42),
+        "video": _message(4, "", media=types.MessageMediaDocument(document=_document(
+            [types.DocumentAttributeVideo(duration=30, w=1280, h=720)], "video/mp4"))),
+        "document": _message(5, "", media=types.MessageMediaDocument(document=_document(
+            [types.DocumentAttributeFilename("report.pdf")], "application/pdf"))),
+    }
+
+
+def bench(message, number):
+    """1件あたりの処理時間（マイクロ秒）を返す"""
+    started_at = time.perf_counter()
+    for _ in range(number):
+        record = extract_message(message, 1234567890, "channel")
+        record.set_sender(SENDER_INFO)
+        json.dumps(record.to_dict(), ensure_ascii=False)
+    return (time.perf_counter() - started_at) / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="メッセージ抽出処理のベンチマーク")
+    parser.add_argument("--number", type=int, default=50000, help="種類ごとの繰り返し回数")
+    args = parser.parse_args()
+
+    for name, message in build_samples().items():
+        per_message = bench(message, args.number)
+        print(f"{name:10s}: {per_message:7.2f} µs/件 ({1e6 / per_message:,.0f} 件/秒)")
@@ -0,0 +1,96 @@
+"""
+チャンネルの取り込み判定
+
+include/excludeの条件（チャンネルID・ユーザー名・チャンネル名・メディアの種類）を
+ダイアログ一覧の読み込み時にチャンネルごとの判定表へまとめておき、
+メッセージごとの判定はRPCなしの辞書参照だけで行います。
+"""
+
+from telethon.tl import types
+import re
+
+from message_extractor import media_type
+
+
+def _split(value):
+    """カンマ区切りの設定値をリストにする（空の要素は除く）"""
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class ChannelFilter:
+    """チャンネルごとの取り込み可否を保持し、メッセージをO(1)で判定する"""
+
+    def __init__(self, exception_list=(), include_ids=(), exclude_ids=(), include_usernames=(),
+                 exclude_usernames=(), exclude_name_patterns=(), exclude_media_types=()):
+        # [EXCEPT CHANNEL]: チャンネル名（空白を除く）に含まれていれば除外
+        self.exception_list = [name for name in exception_list if name]
+        self.include_ids = {int(channel_id) for channel_id in include_ids}
+        self.exclude_ids = {int(channel_id) for channel_id in exclude_ids}
+        self.include_usernames = {username.lstrip('@').lower() for username in include_usernames}
+        self.exclude_usernames = {username.lstrip('@').lower() for username in exclude_usernames}
+        self.exclude_name_patterns = [re.compile(pattern) for pattern in exclude_name_patterns]
+        self.exclude_media_types = set(exclude_media_types)
+        self.decisions = {}  # channel_id -> チャンネル名（取り込み対象のチャンネルのみ）
+
+    @classmethod
+    def from_config(cls, config, exception_list):
+        """config.iniの[FILTER]と[EXCEPT CHANNEL]から作成"""
+        return cls(
+            exception_list=exception_list,
+            include_ids=_split(config.get('FILTER', 'include_channel_ids', fallback='')),
+            exclude_ids=_split(config.get('FILTER', 'exclude_channel_ids', fallback='')),
+            include_usernames=_split(config.get('FILTER', 'include_usernames', fallback='')),
+            exclude_usernames=_split(config.get('FILTER', 'exclude_usernames', fallback='')),
+            exclude_name_patterns=_split(config.get('FILTER', 'exclude_name_patterns', fallback='')),
+            exclude_media_types=_split(config.get('FILTER', 'exclude_media_types', fallback='')),
+        )
+
+    def is_included(self, channel):
+        """スナップショットのチャンネル情報が取り込み対象か"""
+        channel_id = channel["channel_id"]
+        name = channel["name"] or ""
+        username = (channel.get("username") or "").lower()
+        if self.include_ids or self.include_usernames:
+            if channel_id not in self.include_ids and username not in self.include_usernames:
+                return False
+        if channel_id in self.exclude_ids or (username and username in self.exclude_usernames):
+            return False
+        # excpet channel
+        compact_name = name.replace(" ", "")
+        for except_name in self.exception_list:
+            if except_name in compact_name:
+                return False
+        for pattern in self.exclude_name_patterns:
+            if pattern.search(name):
+                return False
+        return True
+
+    def compile(self, channels):
+        """ダイアログ一覧（DialogSnapshot.channels）から判定表を作成"""
+        self.decisions = {
+            channel["channel_id"]: channel["name"]
+            for channel in channels.values()
+            if self.is_included(channel)
+        }
+        print(f"取り込み対象のチャンネル: {len(self.decisions)}/{len(channels)}件")
+
+    def channel_name(self, channel_id):
+        """取り込み対象ならチャンネル名、対象外ならNone"""
+        return self.decisions.get(channel_id)
+
+    def admit_media(self, message):
+        """メディアの種類が除外対象でなければTrue"""
+        if not self.exclude_media_types:
+            return True
+        return (media_type(message) or "text") not in self.exclude_media_types
+
+    def admit(self, message):
+        """メッセージ（更新に含まれる情報のみ使用）を取り込むならチャンネル名、取り込まないならNone"""
+        peer = message.peer_id
+        if type(peer) is not types.PeerChannel:
+            # チャンネルでない場合（ユーザーからのメッセージなど）はスキップ
+            return None
+        channel_name = self.decisions.get(peer.channel_id)
+        if channel_name is None or not self.admit_media(message):
+            return None
+        return channel_name
@@ -0,0 +1,161 @@
+"""
+大きなファイルの分割ダウンロード
+
+ファイルを固定サイズのチャンクに分けて取得し、.partファイルへ書き込みながら
+区間ごとの確定済みオフセットを横に置いたJSON（.part.json）に記録します。
+.partと.part.jsonの名前にはdocument_IDを含め、同じファイル名の別のファイルと混ざらないようにします。
+タイムアウトや再起動の後は確定済みのオフセットから再開し、1つのファイルの複数の区間を並行して取得します。
+"""
+
+from telethon.errors import FileReferenceExpiredError, FloodWaitError
+import asyncio
+import inspect
+import os
+
+from state_store import load_json_state, save_json_state
+
+# Telegramの制約: 要求サイズは4KBの倍数かつ1MBの約数（チャンクが1MBの境界をまたがないようにする）
+MIN_CHUNK_SIZE = 4096
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+def document_file_name(message):
+    """保存先のファイル名（元のファイル名がなければdocument_ID＋拡張子）"""
+    file = message.file
+    return file.name or f"document_{message.document.id}{file.ext or ''}"
+
+
+class ChunkedDownload:
+    """1つのファイル（Document）を区間に分けて並行して取得し、途中から再開できるようにする"""
+
+    def __init__(self, client, message, output_dir, chunk_size=512 * 1024, segments=4, chunk_timeout=60,
+                 max_retries=5):
+        if chunk_size % MIN_CHUNK_SIZE or MAX_CHUNK_SIZE % chunk_size:
+            raise ValueError(f"chunk_sizeは{MIN_CHUNK_SIZE}の倍数かつ{MAX_CHUNK_SIZE}の約数にしてください: {chunk_size}")
+        self.client = client
+        self.message = message
+        self.document_id = message.document.id
+        self.file_size = message.document.size
+        self.path = os.path.join(output_dir, document_file_name(message))
+        self.part_path = f"{self.path}.{self.document_id}.part"
+        self.state_path = self.part_path + ".json"
+        self.chunk_size = chunk_size
+        self.chunk_timeout = chunk_timeout  # 1チャンクあたりのタイムアウト（秒）
+        self.max_retries = max_retries  # 区間ごとの連続失敗の上限
+        self.file = None
+        state = load_json_state(self.state_path, None)
+        if (state and os.path.exists(self.part_path) and state.get("document_id") == self.document_id
+                and state.get("file_size") == self.file_size and state.get("chunk_size") == chunk_size):
+            self.segments = state["segments"]
+            print(f"途中から再開します: {self.path} ({self.confirmed / (1024 * 1024):.2f}/"
+                  f"{self.file_size / (1024 * 1024):.2f} MB)")
+        else:
+            self.segments = self._split(segments)
+
+    def _split(self, count):
+        """チャンクの境界で区間に分ける（offsetはその区間の確定済みの位置）"""
+        chunks = -(-self.file_size // self.chunk_size)
+        chunks_per_segment = max(1, -(-chunks // max(1, count)))
+        segments = []
+        for first_chunk in range(0, chunks, chunks_per_segment):
+            start = first_chunk * self.chunk_size
+            end = min(self.file_size, (first_chunk + chunks_per_segment) * self.chunk_size)
+            segments.append({"start": start, "end": end, "offset": start})
+        return segments
+
+    @property
+    def confirmed(self):
+        """書き込みが確定したバイト数"""
+        return sum(segment["offset"] - segment["start"] for segment in self.segments)
+
+    def _save_state(self):
+        save_json_state(self.state_path, {
+            "document_id": self.document_id,
+            "file_size": self.file_size,
+            "chunk_size": self.chunk_size,
+            "segments": self.segments,
+        })
+
+    async def run(self, progress_callback=None):
+        """ダウンロードしてファイルのパスを返す（失敗時は例外。.partと進捗は残るので次回再開できる）"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        mode = 'r+b' if os.path.exists(self.part_path) else 'w+b'
+        with open(self.part_path, mode) as f:
+            f.truncate(self.file_size)
+            self.file = f
+            tasks = [
+                asyncio.ensure_future(self._fetch_segment(segment, progress_callback))
+                for segment in self.segments if segment["offset"] < segment["end"]
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # 1つの区間が失敗したら他の区間も止めてから進捗を保存する
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            finally:
+                f.flush()
+                self._save_state()
+                self.file = None
+            os.fsync(f.fileno())
+        self._finish()
+        os.remove(self.state_path)
+        return self.path
+
+    def _finish(self):
+        """.partを本来の名前にする。同じ名前のファイルが既にあれば上書きせず、名前にdocument_IDを付ける"""
+        try:
+            # 既にあればFileExistsError（存在の確認と作成を不可分に行う）
+            os.link(self.part_path, self.path)
+        except FileExistsError:
+            stem, ext = os.path.splitext(self.path)
+            self.path = f"{stem}_{self.document_id}{ext}"
+            os.replace(self.part_path, self.path)
+        else:
+            os.remove(self.part_path)
+
+    async def _fetch_segment(self, segment, progress_callback):
+        failures = 0
+        while segment["offset"] < segment["end"]:
+            remaining_chunks = -(-(segment["end"] - segment["offset"]) // self.chunk_size)
+            stream = self.client.iter_download(
+                self.message.document, offset=segment["offset"], limit=remaining_chunks,
+                request_size=self.chunk_size, file_size=self.file_size
+            )
+            try:
+                while segment["offset"] < segment["end"]:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=self.chunk_timeout)
+                    except StopAsyncIteration:
+                        raise IOError(f"ファイルが途中で終わりました（オフセット {segment['offset']}）")
+                    # 書き込みとオフセットの更新の間にawaitを挟まないので、区間同士で競合しない
+                    self.file.seek(segment["offset"])
+                    self.file.write(chunk)
+                    self.file.flush()
+                    segment["offset"] += len(chunk)
+                    self._save_state()
+                    failures = 0
+                    if progress_callback is not None:
+                        result = progress_callback(self.confirmed, self.file_size)
+                        if inspect.isawaitable(result):
+                            await result
+            except FloodWaitError as e:
+                print(f"レート制限: {e.seconds}秒待機します...")
+                await asyncio.sleep(e.seconds)
+            except FileReferenceExpiredError:
+                # ファイル参照の期限切れはメッセージを取得し直して続行
+                failures += 1
+                if failures > self.max_retries:
+                    raise
+                self.message = await self.client.get_messages(self.message.peer_id, ids=self.message.id)
+            except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+                failures += 1
+                if failures > self.max_retries:
+                    raise
+                print(f"警告: オフセット {segment['offset']} の取得に失敗しました（{failures}/{self.max_retries}回目、"
+                      f"確定済みの位置から再開します）: {e!r}")
+                await asyncio.sleep(2 ** failures)
+            finally:
+                await stream.close()
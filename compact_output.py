@@ -0,0 +1,245 @@
+"""
+都度実行版の出力ファイルのコンパクション
+
+実行ごとに作られる日時付きのJSONLファイル（例: output/20260117_143000_telegram_messages.jsonl）を、
+送信日（JST）とチャンネルごとのgzip圧縮したパーティションにまとめます。
+    パーティション: <partition_dir>/<YYYY-MM-DD>/<channel_id>.jsonl.gz（送信日時・メッセージID順）
+    マニフェスト: <partition_dir>/manifest.json（パーティションごとの件数・送信日時の範囲・メッセージIDの範囲）
+同じメッセージは1件にまとめ、まとめ終わった元のファイルは削除します。
+クローラーは書き込み中のファイルを<名前>.partialとし、閉じてから本来の名前に変えるため、書き込み中のファイルは対象になりません。
+念のため、最終更新からmin_age秒が経過したファイルだけを対象にします。
+異常終了で残った.partial（最終更新からmin_age秒が経過し、書き込み中のプロセスがロックしていないもの）は
+本来の名前に変えて対象に含めます（書き込み途中の最終行は読み込み時に無視します）。
+
+    python compact_output.py [--config config.ini] [--min-age 600] [--keep-sources] [--dry-run]
+"""
+
+import argparse
+import configparser
+import contextlib
+import datetime
+import glob
+import gzip
+import json
+import os
+import time
+
+from state_store import load_json_state, save_json_state
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def source_pattern(output_file):
+    """[OUTPUT] output_fileから、実行ごとの出力ファイルのglobパターンを作る（_add_timestamp_to_filenameと対応）"""
+    directory = os.path.dirname(output_file)
+    name, ext = os.path.splitext(os.path.basename(output_file))
+    if ext == '.json':
+        ext = '.jsonl'
+    return os.path.join(directory, f"[0-9]*_[0-9]*_{name}{ext}")
+
+
+def _partition_of(channel_id, body):
+    """(送信日, チャンネルID)。送信日時のないレコードは"unknown"にまとめる"""
+    send_time = body.get("JST_send_time") or ""
+    day = send_time[:10].replace("/", "-") if len(send_time) >= 10 else "unknown"
+    return day, str(channel_id)
+
+
+def _sort_key(record):
+    body = next(iter(record.values()))
+    return body.get("JST_send_time") or "", body.get("message_id", 0)
+
+
+class OutputCompactor:
+    """JSONLファイルをパーティションにマージする
+
+    batch_files個ずつ読み込み、その中に含まれるパーティションだけを既存の内容とマージして書き直します。
+    パーティションとマニフェストを書き終えてから元のファイルを削除するので、
+    途中で終了しても再実行すれば（重複排除により）同じ結果になります。
+    """
+
+    def __init__(self, partition_dir="output/partitions", min_age=600, batch_files=200, delete_sources=True,
+                 compress_level=6):
+        self.partition_dir = partition_dir
+        self.manifest_path = os.path.join(partition_dir, "manifest.json")
+        self.lock_path = os.path.join(partition_dir, ".compact.lock")
+        self.min_age = min_age  # 最終更新からこの秒数が経過していないファイルは書き込み中とみなして対象外
+        self.batch_files = max(1, batch_files)
+        self.delete_sources = delete_sources
+        self.compress_level = compress_level
+        self.manifest = load_json_state(self.manifest_path, {"partitions": {}})
+        self.files_compacted = 0
+        self.records_read = 0
+        self.duplicates = 0
+        self.invalid_lines = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """コンパクションの同時実行を防ぐ（別のプロセスが実行中ならBlockingIOError）"""
+        os.makedirs(self.partition_dir, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            yield
+
+    def adopt_partial_files(self, patterns, dry_run=False):
+        """異常終了で残った.partialを本来の名前に変え、引き取ったファイルのパスを返す
+
+        最終更新からmin_age秒が経過していないもの、書き込み中のプロセスがロックしているもの、
+        本来の名前のファイルが既にあるものは対象外です。
+        """
+        now = time.time()
+        adopted = []
+        for partial_path in sorted({path for pattern in patterns for path in glob.glob(pattern + ".partial")}):
+            path = partial_path[:-len(".partial")]
+            try:
+                if now - os.path.getmtime(partial_path) < self.min_age or os.path.exists(path):
+                    continue
+                with open(partial_path, 'rb') as f:
+                    if fcntl is not None:
+                        try:
+                            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                    if not dry_run:
+                        os.replace(partial_path, path)
+            except FileNotFoundError:
+                # 書き込んでいたプロセスが閉じて名前を変えた
+                continue
+            print(f"{'引き取り対象' if dry_run else '引き取りました'}（異常終了で残ったファイル）: {partial_path}")
+            adopted.append(path)
+        return adopted
+
+    def eligible_files(self, patterns):
+        """最終更新からmin_age秒以上経過したファイル（古い順）。書き込み中の.partialは含めない"""
+        now = time.time()
+        paths = sorted({
+            path for pattern in patterns for path in glob.glob(pattern) if not path.endswith(".partial")
+        })
+        eligible = []
+        for path in paths:
+            try:
+                if now - os.path.getmtime(path) >= self.min_age:
+                    eligible.append(path)
+            except FileNotFoundError:
+                continue
+        return eligible
+
+    def _read_source(self, path, partitions):
+        """ファイルのレコードをパーティションごとに振り分ける（書き込み途中の最終行は無視）"""
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n') or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    self.invalid_lines += 1
+                    continue
+                for channel_id, body in record.items():
+                    if not isinstance(body, dict) or "message_id" not in body:
+                        self.invalid_lines += 1
+                        continue
+                    self.records_read += 1
+                    partition = partitions.setdefault(_partition_of(channel_id, body), {})
+                    if body["message_id"] in partition:
+                        self.duplicates += 1
+                    else:
+                        partition[body["message_id"]] = {channel_id: body}
+
+    def _partition_path(self, day, channel_id):
+        return os.path.join(self.partition_dir, day, f"{channel_id}.jsonl.gz")
+
+    def _merge_partition(self, day, channel_id, records):
+        """既存のパーティションと新しいレコードをマージして書き直す"""
+        path = self._partition_path(day, channel_id)
+        merged = {}
+        if os.path.exists(path):
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    record = json.loads(line)
+                    merged[next(iter(record.values()))["message_id"]] = record
+        for message_id, record in records.items():
+            if message_id in merged:
+                self.duplicates += 1
+            else:
+                merged[message_id] = record
+        ordered = sorted(merged.values(), key=_sort_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=self.compress_level) as f:
+            for record in ordered:
+                f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+        os.replace(tmp_path, path)
+        first, last = _sort_key(ordered[0]), _sort_key(ordered[-1])
+        message_ids = merged.keys()
+        self.manifest["partitions"][os.path.relpath(path, self.partition_dir)] = {
+            "day": day,
+            "channel_id": int(channel_id),
+            "count": len(ordered),
+            "first_time": first[0],
+            "last_time": last[0],
+            "min_message_id": min(message_ids),
+            "max_message_id": max(message_ids),
+            "bytes": os.path.getsize(path),
+        }
+
+    def compact(self, patterns, dry_run=False):
+        """patternsに一致するファイルをパーティションにまとめる"""
+        with self._locked():
+            adopted = self.adopt_partial_files(patterns, dry_run=dry_run)
+            files = self.eligible_files(patterns)
+            if dry_run:
+                files = sorted(set(files) | set(adopted))
+                print(f"対象ファイル: {len(files)}件")
+                for path in files:
+                    print(f"  {path}")
+                return
+            for start in range(0, len(files), self.batch_files):
+                batch = files[start:start + self.batch_files]
+                partitions = {}
+                for path in batch:
+                    self._read_source(path, partitions)
+                for (day, channel_id), records in partitions.items():
+                    self._merge_partition(day, channel_id, records)
+                self.manifest["updated_at"] = datetime.datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S")
+                save_json_state(self.manifest_path, self.manifest)
+                if self.delete_sources:
+                    for path in batch:
+                        os.remove(path)
+                self.files_compacted += len(batch)
+                print(f"{self.files_compacted}/{len(files)}ファイルをまとめました（{len(partitions)}パーティションを更新）")
+        print(f"コンパクション完了: {self.files_compacted}ファイル, {self.records_read}件"
+              f"（重複 {self.duplicates}件, 不正な行 {self.invalid_lines}件）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="実行ごとのJSONLファイルを送信日・チャンネルごとのgzipパーティションにまとめる")
+    parser.add_argument("--config", default="config.ini", help="設定ファイル（デフォルト: config.ini）")
+    parser.add_argument("--input", action="append", help="対象ファイルのglobパターン（省略時は[OUTPUT] output_fileから決定）")
+    parser.add_argument("--partition-dir", help="パーティションの保存先（[COMPACT] partition_dirより優先）")
+    parser.add_argument("--min-age", type=int, help="最終更新からこの秒数が経過したファイルだけを対象にする（[COMPACT] min_ageより優先）")
+    parser.add_argument("--keep-sources", action="store_true", help="まとめた元のファイルを削除しない")
+    parser.add_argument("--dry-run", action="store_true", help="対象ファイルの一覧だけを表示")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='utf-8')
+    compactor = OutputCompactor(
+        partition_dir=args.partition_dir or config.get('COMPACT', 'partition_dir', fallback='output/partitions'),
+        min_age=args.min_age if args.min_age is not None else config.getint('COMPACT', 'min_age', fallback=600),
+        batch_files=config.getint('COMPACT', 'batch_files', fallback=200),
+        delete_sources=not args.keep_sources and config.getboolean('COMPACT', 'delete_sources', fallback=True),
+        compress_level=config.getint('COMPACT', 'compress_level', fallback=6)
+    )
+    patterns = args.input or [source_pattern(config.get('OUTPUT', 'output_file', fallback='telegram_messages.json'))]
+    try:
+        compactor.compact(patterns, dry_run=args.dry_run)
+    except BlockingIOError:
+        print("エラー: 別のコンパクションが実行中です")
+        raise SystemExit(1)
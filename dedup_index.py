@@ -0,0 +1,240 @@
+"""
+実行をまたいだメッセージの重複排除
+
+出力済みの(チャンネルID, メッセージID)を記録し、同じメッセージが複数の出力ファイルに入らないようにします。
+    ベースファイル（path）: 16バイト（>QQ）のキーを昇順に並べたもの。mmapして二分探索する
+    追記ログ（path.log）: 前回のコンパクション以降に追加したキー（起動時にメモリへ読み込む）
+    ブルームフィルター（path.bloom）: ベースファイルにないキーの大半を探索なしで判定する
+コンパクションでログをベースファイルへマージし、ブルームフィルターを作り直します。
+
+    python dedup_index.py [--index .dedup_index] [compact|stats]
+"""
+
+import argparse
+import contextlib
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+KEY = struct.Struct('>QQ')
+BLOOM_HEADER = struct.Struct('>QQI')  # ベースファイルの件数, ビット数, ハッシュ関数の数
+
+
+class BloomFilter:
+    """ビット配列とk個のハッシュ（blake2bによるダブルハッシュ）のブルームフィルター"""
+
+    def __init__(self, size_bits, hash_count, bits=None):
+        self.size_bits = max(8, size_bits)
+        self.hash_count = max(1, hash_count)
+        self.bits = bits if bits is not None else bytearray((self.size_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        """capacity件を入れたときの偽陽性率がfalse_positive_rateになる大きさで作成"""
+        capacity = max(1, capacity)
+        size_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        return cls(size_bits, round(size_bits / capacity * math.log(2)))
+
+    def _positions(self, key):
+        h1, h2 = KEY.unpack(hashlib.blake2b(key, digest_size=16).digest())
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size_bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class DedupIndex:
+    """出力済みの(チャンネルID, メッセージID)の集合
+
+    contains()はメモリ上の追加分 → ブルームフィルター → ベースファイルの二分探索の順に判定し、
+    偽陽性はベースファイルで確認するので誤って重複と判定することはありません。
+    add()した分はflush()でログに追記されます（出力ファイルを書き出した後に呼んでください）。
+    """
+
+    def __init__(self, path, expected_items=1000000, false_positive_rate=0.001, compact_threshold=100000):
+        self.path = path
+        self.log_path = path + ".log"
+        self.bloom_path = path + ".bloom"
+        self.lock_path = path + ".lock"
+        self.expected_items = expected_items
+        self.false_positive_rate = false_positive_rate
+        self.compact_threshold = compact_threshold  # close()時にログがこの件数を超えていればコンパクション
+        self.base = None
+        self.base_count = 0
+        self.tail = set()  # ログとこのプロセスで追加したキー
+        self.pending = []  # ログに未書き込みのキー
+        self.checked = 0
+        self.duplicates = 0
+        self._open_base()
+        self._load_log()
+        self._load_bloom()
+
+    # --- 読み込み -----------------------------------------------------------
+
+    def _open_base(self):
+        if self.base is not None:
+            self.base.close()
+            self.base = None
+        self.base_count = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= KEY.size:
+            with open(self.path, 'rb') as f:
+                self.base = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.base_count = len(self.base) // KEY.size
+
+    def _load_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'rb') as f:
+            data = f.read()
+        # 書き込み途中で終了した場合の端数は捨てる
+        usable = len(data) - len(data) % KEY.size
+        self.tail.update(data[offset:offset + KEY.size] for offset in range(0, usable, KEY.size))
+
+    def _load_bloom(self):
+        self.bloom = None
+        if os.path.exists(self.bloom_path):
+            with open(self.bloom_path, 'rb') as f:
+                data = f.read()
+            if len(data) >= BLOOM_HEADER.size:
+                count, size_bits, hash_count = BLOOM_HEADER.unpack_from(data)
+                bits = bytearray(data[BLOOM_HEADER.size:])
+                # ベースファイルと対応していない（別のプロセスがコンパクションした等）場合は作り直す
+                if count == self.base_count and len(bits) == (size_bits + 7) // 8:
+                    self.bloom = BloomFilter(size_bits, hash_count, bits)
+        if self.bloom is None:
+            self._build_bloom()
+        for key in self.tail:
+            self.bloom.add(key)
+
+    def _build_bloom(self):
+        capacity = max(self.expected_items, 2 * (self.base_count + len(self.tail)))
+        self.bloom = BloomFilter.for_capacity(capacity, self.false_positive_rate)
+        for index in range(self.base_count):
+            self.bloom.add(self.base[index * KEY.size:(index + 1) * KEY.size])
+
+    # --- 判定・追加 ---------------------------------------------------------
+
+    def _in_base(self, key):
+        low, high = 0, self.base_count
+        while low < high:
+            middle = (low + high) // 2
+            current = self.base[middle * KEY.size:(middle + 1) * KEY.size]
+            if current == key:
+                return True
+            if current < key:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def contains(self, channel_id, message_id):
+        """出力済みならTrue"""
+        key = KEY.pack(channel_id, message_id)
+        self.checked += 1
+        found = key in self.tail or (key in self.bloom and self.base is not None and self._in_base(key))
+        if found:
+            self.duplicates += 1
+        return found
+
+    def add(self, channel_id, message_id):
+        key = KEY.pack(channel_id, message_id)
+        if key in self.tail:
+            return
+        self.tail.add(key)
+        self.bloom.add(key)
+        self.pending.append(key)
+
+    def flush(self):
+        """追加分をログに追記"""
+        if not self.pending:
+            return
+        with self._locked(exclusive=False), open(self.log_path, 'ab') as f:
+            f.write(b''.join(self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    # --- コンパクション -----------------------------------------------------
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        """ログへの追記（共有）とコンパクション（排他）をプロセス間で排他制御する"""
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def compact(self):
+        """ログをベースファイルにマージし、ログを空にしてブルームフィルターを作り直す"""
+        self.flush()
+        with self._locked(exclusive=True):
+            # 他のプロセスが追記した分も含めて読み直す。このプロセスが開いた後に別のプロセスが
+            # コンパクションしていると、ログの分はベースファイルに移っているのでベースファイルも開き直す
+            self._open_base()
+            self._load_log()
+            # ベースファイル（昇順）と追加分を並べ替えたものを順にマージする（ベースファイルは読み込まない）
+            base_keys = (
+                self.base[offset:offset + KEY.size] for offset in range(0, self.base_count * KEY.size, KEY.size)
+            )
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                previous = None
+                for key in heapq.merge(base_keys, sorted(self.tail)):
+                    if key != previous:
+                        f.write(key)
+                        previous = key
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            open(self.log_path, 'wb').close()
+            self.tail = set()
+            self._open_base()
+            self._build_bloom()
+            with open(self.bloom_path + ".tmp", 'wb') as f:
+                f.write(BLOOM_HEADER.pack(self.base_count, self.bloom.size_bits, self.bloom.hash_count))
+                f.write(self.bloom.bits)
+            os.replace(self.bloom_path + ".tmp", self.bloom_path)
+        print(f"重複排除の索引をコンパクションしました: {self.base_count}件")
+
+    def stats(self):
+        return {
+            "base": self.base_count,
+            "tail": len(self.tail),
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+        }
+
+    def close(self):
+        """ログに書き出し、ログが大きくなっていればコンパクションする"""
+        self.flush()
+        if len(self.tail) >= self.compact_threshold:
+            self.compact()
+        if self.base is not None:
+            self.base.close()
+            self.base = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="重複排除の索引のコンパクション・件数の表示")
+    parser.add_argument("command", choices=["compact", "stats"])
+    parser.add_argument("--index", default=".dedup_index", help="索引のパス（デフォルト: .dedup_index）")
+    args = parser.parse_args()
+    index = DedupIndex(args.index)
+    if args.command == "compact":
+        index.compact()
+    stats = index.stats()
+    print(f"ベースファイル: {stats['base']}件, ログ: {stats['tail']}件")
+    index.close()
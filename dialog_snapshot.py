@@ -0,0 +1,94 @@
+"""
+ダイアログ一覧のスナップショット
+
+iter_dialogsを1回走査してチャンネル名・ユーザー名・アクセスハッシュ・最新メッセージIDを収集し、
+ファイルにキャッシュします。有効期限（TTL）内は前回からの差分だけを走査して更新します。
+"""
+
+from telethon.tl import types
+import time
+
+from state_store import load_json_state, save_json_state
+
+
+class DialogSnapshot:
+    """チャンネルのダイアログ情報をまとめて保持するスナップショット"""
+
+    def __init__(self, path, ttl_seconds=86400):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        state = load_json_state(path, {})
+        self.channels = state.get("channels", {})  # str(channel_id) -> チャンネル情報
+        self.full_scan_at = state.get("full_scan_at", 0)
+        self.updated_at = state.get("updated_at", 0)
+
+    def is_expired(self):
+        """最後の全件走査から有効期限が過ぎているか"""
+        return not self.channels or time.time() - self.full_scan_at > self.ttl_seconds
+
+    @staticmethod
+    def entry_from_dialog(dialog):
+        """ダイアログからチャンネル情報を作成（RPCなし）。チャンネルでない場合はNone"""
+        input_peer = dialog.input_entity
+        if not isinstance(input_peer, types.InputPeerChannel):
+            return None
+        return {
+            "channel_id": input_peer.channel_id,
+            "dialog_id": str(dialog.id),  # -100プレフィックス付きのID
+            "name": dialog.name,
+            "username": getattr(dialog.entity, 'username', None),
+            "access_hash": input_peer.access_hash,
+            "top_message": getattr(dialog.dialog, 'top_message', 0),
+        }
+
+    async def refresh(self, client):
+        """スナップショットを更新する。期限内なら前回以降に動きのあったダイアログだけを走査"""
+        full_scan = self.is_expired()
+        started_at = time.time()
+        seen = set()
+        scanned = 0
+        async for dialog in client.iter_dialogs(ignore_pinned=True):
+            scanned += 1
+            entry = self.entry_from_dialog(dialog)
+            if entry is None:
+                continue
+            key = str(entry["channel_id"])
+            previous = self.channels.get(key)
+            self.channels[key] = entry
+            seen.add(key)
+            # ダイアログは最新メッセージの新しい順に並ぶため、
+            # 前回から変化のないチャンネルに到達したら残りも更新されていない
+            if not full_scan and previous is not None \
+                and previous["top_message"] == entry["top_message"] \
+                and dialog.date is not None and dialog.date.timestamp() <= self.updated_at:
+                break
+
+        if full_scan:
+            # 全件走査した場合は退出済みのチャンネルを削除
+            for key in set(self.channels) - seen:
+                del self.channels[key]
+            self.full_scan_at = started_at
+        self.updated_at = started_at
+        self.save()
+        mode = "全件" if full_scan else "差分"
+        print(f"ダイアログのスナップショットを更新しました（{mode}走査: {scanned}件, チャンネル数: {len(self.channels)}件）")
+
+    def input_peer(self, entry):
+        """保存済みのアクセスハッシュからInputPeerChannelを作成（RPCなし）"""
+        return types.InputPeerChannel(entry["channel_id"], entry["access_hash"])
+
+    def channel_list(self):
+        """既存のchannel_list形式（キーは-100プレフィックス付きID）に変換"""
+        channel_list = {}
+        for entry in self.channels.values():
+            channel_list[entry["dialog_id"]] = {"channel_name": entry["name"]}
+            if entry["username"] != None:
+                channel_list[entry["dialog_id"]].update({"channel_url": "t.me/" + entry["username"]})
+        return channel_list
+
+    def save(self):
+        save_json_state(self.path, {
+            "full_scan_at": self.full_scan_at,
+            "updated_at": self.updated_at,
+            "channels": self.channels,
+        })
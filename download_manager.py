@@ -0,0 +1,259 @@
+"""
+メディアの並行ダウンロード
+
+1つのTelegramClientを使い回し、同時転送数と全体の転送速度（バイト/秒）の上限を守りながら
+複数のメディアを並行してダウンロードします。速度の制限はdownload_media()の
+progress_callback（チャンクを受信するたびに呼ばれ、次のチャンクの要求前に待機される）で行います。
+"""
+
+from telethon.errors import FloodWaitError, TimeoutError as TelethonTimeoutError
+import asyncio
+import time
+
+from chunked_download import ChunkedDownload
+from media_store import file_key
+
+
+class ByteRateLimiter:
+    """全転送で共有するトークンバケット（bytes_per_secondが0なら無制限）"""
+
+    def __init__(self, bytes_per_second=0, burst=None):
+        self.rate = bytes_per_second
+        self.capacity = burst or bytes_per_second
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, amount):
+        """amountバイト分のトークンを消費し、足りなければ補充されるまで待つ"""
+        if self.rate <= 0 or amount <= 0:
+            return
+        # 待機中もロックを保持し、他の転送も含めて全体の速度を上限以下に保つ
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+def has_file(message):
+    """ダウンロードできるファイル（写真・ドキュメント。リンクのプレビューのものを含む）があるか
+
+    投票・位置情報・写真のないリンクのプレビューなどはmediaがあってもファイルがなく、
+    download_media()はNoneを返すので、転送の失敗と区別するために使います。
+    """
+    return bool(getattr(message, 'photo', None) or getattr(message, 'document', None))
+
+
+async def download_with_retry(client, message, output_dir, max_retries, timeout, current=1, total=1,
+                              progress_callback=None):
+    """
+    リトライ処理付きでメディアをダウンロード
+
+    Args:
+        client: TelegramClient
+        message: メッセージオブジェクト
+        output_dir: ダウンロード先ディレクトリ
+        max_retries: 最大リトライ回数
+        timeout: タイムアウト（秒）
+        current: 現在のメッセージ番号
+        total: 総メッセージ数
+        progress_callback: download_media()に渡す進捗コールバック（受信済みバイト数, 全体のバイト数）
+    """
+    for attempt in range(1, max_retries + 1):
+        try:
+            # ファイルサイズをチェック（可能な場合）
+            file_size = None
+            if hasattr(message, 'document') and message.document:
+                file_size = getattr(message.document, 'size', None)
+                if file_size:
+                    size_mb = file_size / (1024 * 1024)
+                    print(f"[{current}/{total}] ダウンロード中... (サイズ: {size_mb:.2f} MB)")
+                    if size_mb > 100:  # 100MB以上の場合
+                        print(f"警告: 大きなファイルです ({size_mb:.2f} MB)。時間がかかる場合があります。")
+
+            # タイムアウト付きでダウンロード
+            file_path = await asyncio.wait_for(
+                message.download_media(file=output_dir, progress_callback=progress_callback),
+                timeout=timeout
+            )
+            return file_path
+
+        except FloodWaitError as e:
+            wait_time = e.seconds
+            print(f"レート制限: {wait_time}秒待機します...")
+            await asyncio.sleep(wait_time)
+            continue
+
+        except TelethonTimeoutError:
+            print(f"タイムアウト: {attempt}/{max_retries}回目の試行がタイムアウトしました")
+            if attempt < max_retries:
+                print("リトライします...")
+                await asyncio.sleep(2 ** attempt)  # 指数バックオフ
+                continue
+            else:
+                raise
+
+        except asyncio.TimeoutError:
+            print(f"タイムアウト: {attempt}/{max_retries}回目の試行がタイムアウトしました")
+            if attempt < max_retries:
+                print("リトライします...")
+                await asyncio.sleep(2 ** attempt)
+                continue
+            else:
+                raise
+
+        except OSError as e:
+            if "No space left" in str(e) or "ディスク容量" in str(e):
+                print(f"エラー: ディスク容量が不足しています: {e}")
+                raise
+            else:
+                print(f"OSエラー: {e}")
+                if attempt < max_retries:
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                else:
+                    raise
+
+        except Exception as e:
+            print(f"エラー: {e}")
+            if attempt < max_retries:
+                print(f"リトライします... ({attempt}/{max_retries})")
+                await asyncio.sleep(2 ** attempt)
+                continue
+            else:
+                raise
+
+    return None
+
+
+class DownloadManager:
+    """1つのクライアントで複数のメディアを並行してダウンロードする
+
+    同時転送数はconcurrency、全体の転送速度はmax_bytes_per_second（0で無制限）で制限します。
+    timeoutは1ファイルあたりの秒数で、速度制限による待機時間も含みます。
+    store（MediaStore）を渡すと、保存済みのファイルは転送せずに参照だけを追加します。
+    chunked_threshold以上のファイルはChunkedDownloadで区間に分けて取得し、中断しても途中から再開します
+    （この場合timeoutの代わりにチャンクごとのchunk_timeoutを使います）。
+    """
+
+    def __init__(self, client, output_dir="downloads", concurrency=4, max_bytes_per_second=0,
+                 max_retries=3, timeout=300, progress_step=0.25, store=None,
+                 chunked_threshold=100 * 1024 * 1024, chunk_size=512 * 1024, chunk_segments=4, chunk_timeout=60):
+        self.client = client
+        self.output_dir = output_dir
+        self.store = store
+        self.chunked_threshold = chunked_threshold  # 0で分割ダウンロードを使わない
+        self.chunk_size = chunk_size
+        self.chunk_segments = chunk_segments
+        self.chunk_timeout = chunk_timeout
+        self.concurrency = max(1, concurrency)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.limiter = ByteRateLimiter(max_bytes_per_second)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.progress_step = progress_step  # 進捗を表示する割合の刻み
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes_downloaded = 0
+        self.started_at = None
+
+    @classmethod
+    def from_config(cls, config, client, output_dir="downloads", store=None, **overrides):
+        """config.iniの[DOWNLOAD]から作成（overridesでNone以外を指定した設定は引数の値を使う）"""
+        settings = dict(
+            concurrency=config.getint('DOWNLOAD', 'concurrency', fallback=4),
+            max_bytes_per_second=config.getint('DOWNLOAD', 'max_bytes_per_second', fallback=0),
+            max_retries=config.getint('DOWNLOAD', 'max_retries', fallback=3),
+            timeout=config.getint('DOWNLOAD', 'timeout', fallback=300),
+            chunked_threshold=config.getint('DOWNLOAD', 'chunked_threshold', fallback=100 * 1024 * 1024),
+            chunk_size=config.getint('DOWNLOAD', 'chunk_size', fallback=512 * 1024),
+            chunk_segments=config.getint('DOWNLOAD', 'chunk_segments', fallback=4),
+            chunk_timeout=config.getint('DOWNLOAD', 'chunk_timeout', fallback=60)
+        )
+        settings.update({name: value for name, value in overrides.items() if value is not None})
+        return cls(client, output_dir=output_dir, store=store, **settings)
+
+    def _progress_callback(self, label, resumed_from=0):
+        """ファイルごとの進捗表示と速度制限を行うコールバックを作成（resumed_fromは再開前に確定済みのバイト数）"""
+        received_so_far = resumed_from
+        next_report = self.progress_step
+
+        async def callback(received, total):
+            nonlocal received_so_far, next_report
+            delta = received - received_so_far
+            if delta < 0:
+                # リトライで最初から受信し直している
+                delta = received
+                next_report = self.progress_step
+            received_so_far = received
+            self.bytes_downloaded += delta
+            await self.limiter.consume(delta)
+            if total and self.progress_step and received / total >= next_report:
+                print(f"{label}: {received / total:.0%} ({received / (1024 * 1024):.2f}/{total / (1024 * 1024):.2f} MB)")
+                while next_report <= received / total:
+                    next_report += self.progress_step
+
+        return callback
+
+    def _is_large(self, message):
+        document = message.document
+        return bool(self.chunked_threshold and document is not None and document.size >= self.chunked_threshold)
+
+    async def download(self, message, current=1, total=1):
+        """1件ダウンロードしてファイルのパスを返す（失敗時はNone）"""
+        label = f"[{current}/{total}] メッセージ {message.id}"
+
+        async def transfer(output_dir):
+            # 転送枠は実際に転送する間だけ使う（ストアにあるファイルは枠を使わない）
+            async with self.semaphore:
+                if self.started_at is None:
+                    self.started_at = time.monotonic()
+                if self._is_large(message):
+                    chunked = ChunkedDownload(
+                        self.client, message, output_dir, self.chunk_size, self.chunk_segments,
+                        self.chunk_timeout, self.max_retries
+                    )
+                    return await chunked.run(self._progress_callback(label, chunked.confirmed))
+                return await download_with_retry(
+                    self.client, message, output_dir, self.max_retries, self.timeout, current, total,
+                    progress_callback=self._progress_callback(label)
+                )
+
+        try:
+            key = file_key(message) if self.store is not None else None
+            if key is not None:
+                file_path = await self.store.get_or_download(message, key, transfer)
+            else:
+                file_path = await transfer(self.output_dir)
+        except Exception as e:
+            print(f"エラー: {label} のダウンロードに失敗しました: {e}")
+            file_path = None
+        if file_path:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        return file_path
+
+    async def download_all(self, messages):
+        """ファイルのあるメッセージを並行してダウンロードし、ファイルのパス（失敗時はNone）を渡した順に返す
+
+        ファイルのないメッセージ（投票・位置情報など）は対象から除きます。
+        """
+        messages = [message for message in messages if has_file(message)]
+        return await asyncio.gather(*(
+            self.download(message, index, len(messages))
+            for index, message in enumerate(messages, 1)
+        ))
+
+    def report(self):
+        """成功・失敗件数と全体のスループットを表示"""
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        size_mb = self.bytes_downloaded / (1024 * 1024)
+        throughput = size_mb / elapsed if elapsed > 0 else 0.0
+        print(f"ダウンロード結果: 成功 {self.succeeded}件, 失敗 {self.failed}件, "
+              f"合計 {size_mb:.2f} MB, 所要時間 {elapsed:.1f}秒 ({throughput:.2f} MB/s)")
+        if self.store is not None:
+            print(f"保存済みのファイルを再利用: {self.store.reused}件（ストア: {len(self.store.files)}ファイル）")
@@ -4,13 +4,60 @@
 取得したメッセージIDとチャンネルIDを使って、メディアをダウンロードする方法を示します。
 """
 
-from telethon import TelegramClient
+from telethon import TelegramClient, errors
 import configparser
-import socks
 import asyncio
 import os
 
-async def download_media_by_id(api_id, api_hash, channel_id, message_id, output_dir="downloads", max_retries=3, timeout=300):
+from album_index import AlbumIndex
+from download_manager import DownloadManager, has_file
+from jsonl_media_source import JsonlMediaSource
+from media_store import MediaStore, file_key_from_media_info
+from peer_cache import PeerCache
+
+# Telegramのアルバムは最大10件のため、前後9件の範囲に同じgrouped_idのメッセージがすべて含まれる
+ALBUM_MAX_SIZE = 10
+
+def load_config(config_file="config.ini"):
+    """ダウンロードの設定（[DOWNLOAD]）を読み込む。ファイルがなければすべてデフォルト値"""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    return config
+
+def to_bare_channel_id(channel_id):
+    """-100プレフィックス付きのチャンネルIDをクローラーの出力形式（プレフィックスなし）に変換"""
+    if channel_id < -1000000000000:
+        return -channel_id - 1000000000000
+    return channel_id
+
+async def resolve_album(client, channel, message, album_index=None, channel_id=None):
+    """
+    messageと同じgrouped_idを持つメッセージをID順に返す（問い合わせは1回）
+    
+    Args:
+        client: TelegramClient
+        channel: チャンネルエンティティ
+        message: アルバムに含まれるメッセージ
+        album_index: クローラーが記録したAlbumIndex（あればその範囲だけを取得）
+        channel_id: AlbumIndexのキーとなるチャンネルID（-100プレフィックスなし）
+    """
+    grouped_id = message.grouped_id
+    member_ids = None
+    if album_index is not None and channel_id is not None:
+        member_ids = album_index.members(channel_id, grouped_id)
+    if member_ids:
+        ids = member_ids
+    else:
+        # 索引にない場合は前後のメッセージをまとめて1回で取得して絞り込む
+        ids = list(range(max(1, message.id - (ALBUM_MAX_SIZE - 1)), message.id + ALBUM_MAX_SIZE))
+    candidates = await client.get_messages(channel, ids=ids)
+    album = {msg.id: msg for msg in candidates if msg is not None and msg.grouped_id == grouped_id}
+    album[message.id] = message
+    return [album[message_id] for message_id in sorted(album)]
+
+async def download_media_by_id(api_id, api_hash, channel_id, message_id, output_dir="downloads", max_retries=None, timeout=None,
+                               album_index_file=".album_index.json", client=None, manager=None,
+                               peer_cache_file=".peer_cache.json", config_file="config.ini"):
     """
     メッセージIDとチャンネルIDからメディアをダウンロード
     
@@ -20,101 +67,60 @@ async def download_media_by_id(api_id, api_hash, channel_id, message_id, output_
         channel_id: チャンネルID（例: -1001234567890）
         message_id: メッセージID
         output_dir: ダウンロード先のディレクトリ
-        max_retries: 最大リトライ回数（デフォルト: 3）
-        timeout: タイムアウト（秒、デフォルト: 300秒=5分）
+        max_retries: 最大リトライ回数（省略時は[DOWNLOAD] max_retries、デフォルト: 3）
+        timeout: タイムアウト（秒、省略時は[DOWNLOAD] timeout、デフォルト: 300秒=5分）
+        album_index_file: クローラーが記録したアルバムの索引（デフォルト: .album_index.json）
+        client: 接続済みのTelegramClient（省略時はこの呼び出しの間だけ接続する）
+        manager: 共有するDownloadManager（省略時はclientとconfig_fileの[DOWNLOAD]で作成する）
+        peer_cache_file: クローラーが記録したアクセスハッシュのキャッシュ（デフォルト: .peer_cache.json）
+        config_file: [DOWNLOAD]を読み込む設定ファイル（デフォルト: config.ini）
     """
-    # TelegramClientを初期化
-    client = TelegramClient('CAnonBot', api_id, api_hash)
-    await client.start()
+    album_index = AlbumIndex(album_index_file)
+    peer_cache = PeerCache(peer_cache_file)
+    # 接続済みのクライアントが渡されなければ初期化（この場合だけ終了時に切断する）
+    owns_client = client is None
+    if owns_client:
+        client = TelegramClient('CAnonBot', api_id, api_hash)
+        await client.start()
+    if manager is None:
+        manager = DownloadManager.from_config(
+            load_config(config_file), client, output_dir, max_retries=max_retries, timeout=timeout
+        )
     
     try:
-        # チャンネルエンティティを取得
-        channel = await client.get_entity(channel_id)
-        
-        # メッセージを取得
-        message = await client.get_messages(channel, ids=message_id)
+        # メッセージを取得（アクセスハッシュがキャッシュにあればチャンネルの取得は行わない）
+        channel, message = await _get_channel_messages(client, to_bare_channel_id(channel_id), message_id, peer_cache)
         
         if not message:
             print(f"メッセージID {message_id} が見つかりません")
             return None
         
-        if not message.media:
-            print("メッセージにメディアが含まれていません")
+        if not has_file(message):
+            print("メッセージにダウンロードできるファイルがありません")
             return None
         
         # ダウンロード先ディレクトリを作成
-        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(manager.output_dir, exist_ok=True)
         
         # 複数メディア（写真アルバムなど）のチェック
         grouped_id = getattr(message, 'grouped_id', None)
         if grouped_id:
             print(f"複数メディア検出 (grouped_id: {grouped_id})。関連メッセージを取得します...")
-            # 同じgrouped_idを持つメッセージを取得
-            # より確実な方法：メッセージの範囲を広く取得してフィルタリング
-            grouped_messages = [message]  # 最初のメッセージを含める
-            
-            # 前後のメッセージを取得（範囲を広めに設定）
-            # まず前方向に検索（最大50件まで）
-            for offset in range(1, 51):
-                try:
-                    prev_msg = await client.get_messages(channel, ids=message_id - offset)
-                    if not prev_msg:
-                        break
-                    prev_grouped_id = getattr(prev_msg, 'grouped_id', None)
-                    if prev_grouped_id == grouped_id:
-                        grouped_messages.insert(0, prev_msg)
-                    elif prev_grouped_id is not None:
-                        # 別のgrouped_idが見つかった場合は終了
-                        break
-                except Exception as e:
-                    # メッセージが存在しない場合は終了
-                    break
-            
-            # 後ろ方向に検索（最大50件まで）
-            for offset in range(1, 51):
-                try:
-                    next_msg = await client.get_messages(channel, ids=message_id + offset)
-                    if not next_msg:
-                        break
-                    next_grouped_id = getattr(next_msg, 'grouped_id', None)
-                    if next_grouped_id == grouped_id:
-                        grouped_messages.append(next_msg)
-                    elif next_grouped_id is not None:
-                        # 別のgrouped_idが見つかった場合は終了
-                        break
-                except Exception as e:
-                    # メッセージが存在しない場合は終了
-                    break
-            
-            # メッセージIDでソート（時系列順）
-            grouped_messages.sort(key=lambda m: m.id)
+            grouped_messages = await resolve_album(
+                client, channel, message, album_index, to_bare_channel_id(channel_id)
+            )
             
             if grouped_messages:
                 print(f"{len(grouped_messages)}件のメッセージをダウンロードします")
-                downloaded_files = []
-                
-                for idx, msg in enumerate(grouped_messages, 1):
-                    if msg.media:
-                        try:
-                            # リトライ処理付きでダウンロード
-                            file_path = await download_with_retry(
-                                client, msg, output_dir, max_retries, timeout, idx, len(grouped_messages)
-                            )
-                            if file_path:
-                                downloaded_files.append(file_path)
-                        except Exception as e:
-                            print(f"エラー: メッセージ {msg.id} のダウンロードに失敗しました: {e}")
-                            continue
-                
+                # アルバム内のファイルは並行してダウンロード
+                downloaded_files = [path for path in await manager.download_all(grouped_messages) if path]
                 print(f"ダウンロード完了: {len(downloaded_files)}/{len(grouped_messages)}件")
                 return downloaded_files
             else:
                 print("関連メッセージが見つかりませんでした。単一メッセージとしてダウンロードします。")
         
         # 単一メッセージのダウンロード
-        file_path = await download_with_retry(
-            client, message, output_dir, max_retries, timeout, 1, 1
-        )
+        file_path = await manager.download(message)
         if file_path:
             print(f"ダウンロード完了: {file_path}")
         return file_path
@@ -125,104 +131,134 @@ async def download_media_by_id(api_id, api_hash, channel_id, message_id, output_
         traceback.print_exc()
         return None
     finally:
-        await client.disconnect()
+        peer_cache.save()
+        if owns_client:
+            await client.disconnect()
 
-async def download_with_retry(client, message, output_dir, max_retries, timeout, current=1, total=1):
+async def resolve_download_batch(client, media_infos, album_index=None, store=None, peer_cache=None):
     """
-    リトライ処理付きでメディアをダウンロード
+    クローラーの出力（mediaフィールド）のリストからダウンロードするメッセージをまとめて取得
+    
+    チャンネルごとに対象のメッセージID（索引にあるアルバムの関連メッセージを含む）を
+    1回のget_messages(ids=[...])で取得します。チャンネルはpeer_cacheのアクセスハッシュを使い、
+    キャッシュにない場合だけget_entityで取得します。
+    結果はmedia_infosと同じ順のリストで、各要素はダウンロードするメッセージのリスト（アルバムはID順）、
+    チャンネルから取得できなかった場合はNone、ダウンロードするものがない（メッセージが削除された・
+    ダウンロードできるファイルがない・ストアに保存済み）場合は空のリストです。
     
     Args:
         client: TelegramClient
-        message: メッセージオブジェクト
-        output_dir: ダウンロード先ディレクトリ
-        max_retries: 最大リトライ回数
-        timeout: タイムアウト（秒）
-        current: 現在のメッセージ番号
-        total: 総メッセージ数
+        media_infos: クローラーの出力のmediaフィールド（download_infoを含む）のリスト
+        album_index: クローラーが記録したAlbumIndex
+        store: MediaStore（保存済みのファイルはメッセージを取得せずに参照だけを追加する）
+        peer_cache: PeerCache（省略時は毎回get_entityで取得する）
     """
-    import asyncio
-    from telethon.errors import FloodWaitError, TimeoutError as TelethonTimeoutError
+    results = [None] * len(media_infos)
+    by_channel = {}  # チャンネルID -> media_infosの添字のリスト
+    for index, media_info in enumerate(media_infos):
+        download_info = media_info["download_info"]
+        channel_id = to_bare_channel_id(download_info["channel_id"])
+        if store is not None and not download_info.get("grouped_id"):
+            # 保存済みのファイルならメッセージを取得せずに参照だけを追加
+            stored_path = store.reuse(channel_id, download_info["message_id"], file_key_from_media_info(media_info))
+            if stored_path:
+                print(f"保存済みのファイルを再利用します: チャンネルID={channel_id}, "
+                      f"メッセージID={download_info['message_id']} -> {stored_path}")
+                results[index] = []
+                continue
+        by_channel.setdefault(channel_id, []).append(index)
     
-    for attempt in range(1, max_retries + 1):
+    for channel_id, indexes in by_channel.items():
+        # 対象のメッセージと、索引にあるアルバムの関連メッセージをまとめて取得
+        ids = set()
+        for index in indexes:
+            download_info = media_infos[index]["download_info"]
+            ids.add(download_info["message_id"])
+            grouped_id = download_info.get("grouped_id")
+            if grouped_id and album_index is not None:
+                ids.update(album_index.members(channel_id, grouped_id) or ())
+        print(f"\nダウンロード中: チャンネルID={channel_id}, {len(indexes)}件（メッセージ{len(ids)}件を取得）")
         try:
-            # ファイルサイズをチェック（可能な場合）
-            file_size = None
-            if hasattr(message, 'document') and message.document:
-                file_size = getattr(message.document, 'size', None)
-                if file_size:
-                    size_mb = file_size / (1024 * 1024)
-                    print(f"[{current}/{total}] ダウンロード中... (サイズ: {size_mb:.2f} MB)")
-                    if size_mb > 100:  # 100MB以上の場合
-                        print(f"警告: 大きなファイルです ({size_mb:.2f} MB)。時間がかかる場合があります。")
-            
-            # タイムアウト付きでダウンロード
-            file_path = await asyncio.wait_for(
-                message.download_media(file=output_dir),
-                timeout=timeout
-            )
-            return file_path
-            
-        except FloodWaitError as e:
-            wait_time = e.seconds
-            print(f"レート制限: {wait_time}秒待機します...")
-            await asyncio.sleep(wait_time)
+            channel, fetched = await _get_channel_messages(client, channel_id, sorted(ids), peer_cache)
+        except Exception as e:
+            print(f"  エラー: チャンネルID {channel_id} のメッセージを取得できませんでした: {e}")
             continue
-            
-        except TelethonTimeoutError:
-            print(f"タイムアウト: {attempt}/{max_retries}回目の試行がタイムアウトしました")
-            if attempt < max_retries:
-                print("リトライします...")
-                await asyncio.sleep(2 ** attempt)  # 指数バックオフ
+        by_id = {msg.id: msg for msg in fetched if msg is not None}
+        
+        for index in indexes:
+            download_info = media_infos[index]["download_info"]
+            message_id = download_info["message_id"]
+            grouped_id = download_info.get("grouped_id")
+            message = by_id.get(message_id)
+            if not message:
+                # 削除されたメッセージは再実行しても取得できないので、ダウンロードするものがないとする
+                print(f"  警告: メッセージID {message_id} が見つかりません（削除されています）")
+                results[index] = []
                 continue
-            else:
-                raise
-                
-        except asyncio.TimeoutError:
-            print(f"タイムアウト: {attempt}/{max_retries}回目の試行がタイムアウトしました")
-            if attempt < max_retries:
-                print("リトライします...")
-                await asyncio.sleep(2 ** attempt)
+            if not has_file(message):
+                print(f"  警告: メッセージID {message_id} にダウンロードできるファイルがありません")
+                results[index] = []
                 continue
-            else:
-                raise
-                
-        except OSError as e:
-            if "No space left" in str(e) or "ディスク容量" in str(e):
-                print(f"エラー: ディスク容量が不足しています: {e}")
-                raise
-            else:
-                print(f"OSエラー: {e}")
-                if attempt < max_retries:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                else:
-                    raise
-                    
-        except Exception as e:
-            print(f"エラー: {e}")
-            if attempt < max_retries:
-                print(f"リトライします... ({attempt}/{max_retries})")
-                await asyncio.sleep(2 ** attempt)
+            if not grouped_id:
+                results[index] = [message]
                 continue
+            # 複数メディアの処理（索引になければ前後をまとめて1回で取得）
+            member_ids = album_index.members(channel_id, grouped_id) if album_index is not None else None
+            if member_ids:
+                album = {msg_id: by_id[msg_id] for msg_id in member_ids
+                         if msg_id in by_id and by_id[msg_id].grouped_id == grouped_id}
+                album[message_id] = message
+                grouped_messages = [album[msg_id] for msg_id in sorted(album)]
             else:
-                raise
-    
-    return None
+                grouped_messages = await resolve_album(client, channel, message)
+            print(f"  複数メディア (grouped_id: {grouped_id}): {len(grouped_messages)}件のメッセージをダウンロードします")
+            results[index] = grouped_messages
+    return results
 
-async def download_media_from_json(json_data, api_id, api_hash, output_dir="downloads", max_retries=3, timeout=300):
+async def _get_channel_messages(client, channel_id, ids, peer_cache=None):
+    """チャンネルのInputPeerと、idsのメッセージ（1回の問い合わせ）を返す"""
+    if peer_cache is None:
+        channel = await client.get_entity(-1000000000000 - channel_id)
+        return channel, await client.get_messages(channel, ids=ids)
+    channel = await peer_cache.resolve(client, channel_id)
+    try:
+        return channel, await client.get_messages(channel, ids=ids)
+    except (errors.ChannelInvalidError, errors.ChannelPrivateError):
+        # キャッシュのアクセスハッシュが無効（別のアカウントのものなど）なら取得し直す
+        peer_cache.discard(channel_id)
+        channel = await peer_cache.resolve(client, channel_id)
+        return channel, await client.get_messages(channel, ids=ids)
+
+async def download_media_from_json(json_data, api_id, api_hash, output_dir="downloads", max_retries=None, timeout=None,
+                                   album_index_file=".album_index.json", concurrency=None, max_bytes_per_second=None,
+                                   store_dir=None, hash_content=False, peer_cache_file=".peer_cache.json",
+                                   config_file="config.ini"):
     """
     JSONデータからメディア情報を抽出してダウンロード
     
+    メッセージはチャンネルごとにまとめて1回で取得し、ファイルの転送は
+    DownloadManagerで並行して行います（1つのクライアントを使い回します）。
+    
     Args:
         json_data: メッセージのJSONデータ（telegram_crawler.pyの出力形式）
         api_id: Telegram API ID
         api_hash: Telegram API Hash
         output_dir: ダウンロード先のディレクトリ
-        max_retries: 最大リトライ回数（デフォルト: 3）
-        timeout: タイムアウト（秒、デフォルト: 300秒=5分）
+        max_retries: 最大リトライ回数（省略時は[DOWNLOAD] max_retries、デフォルト: 3）
+        timeout: タイムアウト（秒、省略時は[DOWNLOAD] timeout、デフォルト: 300秒=5分）
+        album_index_file: クローラーが記録したアルバムの索引（デフォルト: .album_index.json）
+        concurrency: 同時に転送するファイル数（省略時は[DOWNLOAD] concurrency、デフォルト: 4）
+        max_bytes_per_second: 全体の転送速度の上限（バイト/秒、0で無制限。省略時は[DOWNLOAD] max_bytes_per_second）
+        store_dir: 指定するとMediaStoreに保存し、保存済みの写真・ファイルは転送しない
+        hash_content: ストアでファイルの内容（SHA-256）による重複排除も行う
+        peer_cache_file: クローラーが記録したアクセスハッシュのキャッシュ（デフォルト: .peer_cache.json）
+        config_file: [DOWNLOAD]（分割ダウンロードの設定など）を読み込む設定ファイル（デフォルト: config.ini）
     """
     import json
     
+    album_index = AlbumIndex(album_index_file)
+    peer_cache = PeerCache(peer_cache_file)
+    
     if isinstance(json_data, str):
         data = json.loads(json_data)
     else:
@@ -230,139 +266,135 @@ async def download_media_from_json(json_data, api_id, api_hash, output_dir="down
     
     client = TelegramClient('CAnonBot', api_id, api_hash)
     await client.start()
+    store = MediaStore(store_dir, hash_content=hash_content) if store_dir else None
+    manager = DownloadManager.from_config(
+        load_config(config_file), client, output_dir, store=store, concurrency=concurrency,
+        max_bytes_per_second=max_bytes_per_second, max_retries=max_retries, timeout=timeout
+    )
     
-    downloaded_count = 0
     error_count = 0
+    transfers = []
     
     try:
-        for channel_id, message_info in data.items():
-            try:
-                if "media" in message_info and "download_info" in message_info["media"]:
-                    download_info = message_info["media"]["download_info"]
-                    channel_id_int = download_info["channel_id"]
-                    message_id = download_info["message_id"]
-                    grouped_id = download_info.get("grouped_id")
-                    
-                    print(f"\nダウンロード中: チャンネルID={channel_id_int}, メッセージID={message_id}")
-                    if grouped_id:
-                        print(f"  複数メディア (grouped_id: {grouped_id})")
-                    
-                    # チャンネルIDを適切な形式に変換（-100プレフィックスを追加）
-                    if channel_id_int > 0:
-                        channel_entity_id = -1000000000000 - channel_id_int
-                    else:
-                        channel_entity_id = channel_id_int
-                    
-                    # チャンネルエンティティを取得
-                    try:
-                        channel = await client.get_entity(channel_entity_id)
-                    except Exception as e:
-                        print(f"  エラー: チャンネルを取得できませんでした: {e}")
-                        error_count += 1
-                        continue
-                    
-                    # メッセージを取得
-                    try:
-                        message = await client.get_messages(channel, ids=message_id)
-                    except Exception as e:
-                        print(f"  エラー: メッセージを取得できませんでした: {e}")
-                        error_count += 1
-                        continue
-                    
-                    if not message:
-                        print(f"  警告: メッセージID {message_id} が見つかりません")
-                        error_count += 1
-                        continue
-                    
-                    if not message.media:
-                        print(f"  警告: メッセージにメディアが含まれていません")
-                        continue
-                    
-                    # ダウンロード先ディレクトリを作成
-                    os.makedirs(output_dir, exist_ok=True)
-                    
-                    # 複数メディアの処理
-                    if grouped_id:
-                        # 同じgrouped_idを持つメッセージを取得
-                        grouped_messages = [message]  # 最初のメッセージを含める
-                        
-                        # 前方向に検索（最大50件まで）
-                        for offset in range(1, 51):
-                            try:
-                                prev_msg = await client.get_messages(channel, ids=message_id - offset)
-                                if not prev_msg:
-                                    break
-                                prev_grouped_id = getattr(prev_msg, 'grouped_id', None)
-                                if prev_grouped_id == grouped_id:
-                                    grouped_messages.insert(0, prev_msg)
-                                elif prev_grouped_id is not None:
-                                    # 別のgrouped_idが見つかった場合は終了
-                                    break
-                            except Exception as e:
-                                # メッセージが存在しない場合は終了
-                                break
-                        
-                        # 後ろ方向に検索（最大50件まで）
-                        for offset in range(1, 51):
-                            try:
-                                next_msg = await client.get_messages(channel, ids=message_id + offset)
-                                if not next_msg:
-                                    break
-                                next_grouped_id = getattr(next_msg, 'grouped_id', None)
-                                if next_grouped_id == grouped_id:
-                                    grouped_messages.append(next_msg)
-                                elif next_grouped_id is not None:
-                                    # 別のgrouped_idが見つかった場合は終了
-                                    break
-                            except Exception as e:
-                                # メッセージが存在しない場合は終了
-                                break
-                        
-                        # メッセージIDでソート（時系列順）
-                        grouped_messages.sort(key=lambda m: m.id)
-                        
-                        if grouped_messages:
-                            print(f"  {len(grouped_messages)}件のメッセージをダウンロードします")
-                            for idx, msg in enumerate(grouped_messages, 1):
-                                if msg.media:
-                                    try:
-                                        file_path = await download_with_retry(
-                                            client, msg, output_dir, max_retries, timeout, idx, len(grouped_messages)
-                                        )
-                                        if file_path:
-                                            downloaded_count += 1
-                                    except Exception as e:
-                                        print(f"  エラー: メッセージ {msg.id} のダウンロードに失敗: {e}")
-                                        error_count += 1
-                        else:
-                            # グループ化されたメッセージが見つからない場合は単一として処理
-                            file_path = await download_with_retry(
-                                client, message, output_dir, max_retries, timeout, 1, 1
-                            )
-                            if file_path:
-                                downloaded_count += 1
-                    else:
-                        # 単一メッセージのダウンロード
-                        file_path = await download_with_retry(
-                            client, message, output_dir, max_retries, timeout, 1, 1
-                        )
-                        if file_path:
-                            downloaded_count += 1
-                            
-            except Exception as e:
-                print(f"エラー: チャンネルID {channel_id} の処理中にエラーが発生しました: {e}")
-                import traceback
-                traceback.print_exc()
+        media_infos = [
+            message_info["media"] for message_info in data.values()
+            if "media" in message_info and "download_info" in message_info["media"]
+        ]
+        results = await resolve_download_batch(client, media_infos, album_index, store, peer_cache)
+        # ダウンロード先ディレクトリを作成
+        os.makedirs(output_dir, exist_ok=True)
+        for messages in results:
+            if messages is None:
                 error_count += 1
-                continue
+            elif messages:
+                transfers.append(asyncio.create_task(manager.download_all(messages)))
         
-        print(f"\nダウンロード完了: 成功 {downloaded_count}件, エラー {error_count}件")
+        # 転送中のファイルがすべて終わるのを待つ
+        await asyncio.gather(*transfers)
+        print(f"\nダウンロード完了: 成功 {manager.succeeded}件, エラー {manager.failed + error_count}件")
+        manager.report()
                     
     except Exception as e:
         print(f"エラーが発生しました: {e}")
         import traceback
         traceback.print_exc()
     finally:
+        for transfer in transfers:
+            transfer.cancel()
+        if store is not None:
+            store.save()
+        peer_cache.save()
+        await client.disconnect()
+
+async def download_media_from_jsonl(paths, api_id, api_hash, output_dir="downloads", max_retries=None, timeout=None,
+                                    album_index_file=".album_index.json", concurrency=None, max_bytes_per_second=None,
+                                    store_dir=None, hash_content=False, checkpoint_file=".download_checkpoint.json",
+                                    queue_size=1000, batch_size=100, peer_cache_file=".peer_cache.json",
+                                    config_file="config.ini"):
+    """
+    クローラーが出力したJSONLファイルを1行ずつ読みながらメディアをダウンロード
+    
+    ファイル全体を読み込まず、上限付きのキューを通して複数のワーカーが取得・転送します。
+    ワーカーはキューからbatch_size件までまとめて取り出し、チャンネルごとに1回の問い合わせでメッセージを取得します。
+    同じメッセージ（アルバムは同じgrouped_id）は1回だけダウンロードし、
+    ファイルごとに処理済みの位置を保存するので、再実行すると続きから処理します。
+    
+    Args:
+        paths: JSONLファイルのパスまたはglobパターン（複数可）
+        checkpoint_file: ファイルごとの処理済みの位置の保存先（デフォルト: .download_checkpoint.json）
+        queue_size: 読み込み済みで未処理の件数の上限（デフォルト: 1000）
+        batch_size: ワーカーが1回にまとめて取得する最大件数（デフォルト: 100）
+        その他の引数はdownload_media_from_jsonと同じ
+    """
+    album_index = AlbumIndex(album_index_file)
+    peer_cache = PeerCache(peer_cache_file)
+    source = JsonlMediaSource(paths, checkpoint_file)
+    
+    client = TelegramClient('CAnonBot', api_id, api_hash)
+    await client.start()
+    store = MediaStore(store_dir, hash_content=hash_content) if store_dir else None
+    manager = DownloadManager.from_config(
+        load_config(config_file), client, output_dir, store=store, concurrency=concurrency,
+        max_bytes_per_second=max_bytes_per_second, max_retries=max_retries, timeout=timeout
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    queue = asyncio.Queue(maxsize=queue_size)
+    error_count = 0
+    
+    async def download_item(messages):
+        """1行分をダウンロードし、すべて成功したか（ダウンロードするものがない場合を含む）を返す
+
+        download_allはファイルのないメッセージを除くので、Noneのパスは転送の失敗だけです。
+        """
+        if messages is None:
+            return False
+        if not messages:
+            return True
+        return all(path is not None for path in await manager.download_all(messages))
+    
+    async def worker():
+        nonlocal error_count
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                results = await resolve_download_batch(
+                    client, [item.media_info for item in batch], album_index, store, peer_cache
+                )
+                succeeded = await asyncio.gather(*(download_item(messages) for messages in results))
+                for item, ok in zip(batch, succeeded):
+                    if ok:
+                        source.done(item)
+                    else:
+                        # 失敗した行は処理済みにしない（再実行時にその行から読み直す）
+                        error_count += 1
+            except Exception as e:
+                print(f"エラー: {len(batch)}件の処理中にエラーが発生しました: {e}")
+                error_count += len(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+    
+    # 取得の待ち時間に転送が止まらないよう、ワーカーは同時転送数より多めに起動する
+    workers = [asyncio.create_task(worker()) for _ in range(manager.concurrency * 2)]
+    try:
+        for item in source:
+            await queue.put(item)
+        await queue.join()
+        print(f"\nダウンロード完了: 対象 {source.yielded}件（重複 {source.duplicates}件を除く）, "
+              f"成功 {source.yielded - error_count}件, 失敗 {error_count}件（再実行時に読み直します）")
+        manager.report()
+    finally:
+        for task in workers:
+            task.cancel()
+        source.save()
+        if store is not None:
+            store.save()
+        peer_cache.save()
         await client.disconnect()
 
 if __name__ == "__main__":
@@ -387,7 +419,18 @@ if __name__ == "__main__":
     #     json_data=json_data,
     #     api_id=api_id,
     #     api_hash=api_hash,
-    #     output_dir="downloads"
+    #     output_dir="downloads",
+    #     store_dir=config.get('DOWNLOAD', 'store_dir', fallback='') or None,
+    #     hash_content=config.getboolean('DOWNLOAD', 'hash_content', fallback=False)
+    # ))
+    
+    # 使用例3: 都度実行版が出力したJSONLファイルからダウンロード（再実行すると続きから処理）
+    # asyncio.run(download_media_from_jsonl(
+    #     paths=["output/*_telegram_messages.jsonl"],
+    #     api_id=api_id,
+    #     api_hash=api_hash,
+    #     output_dir="downloads",
+    #     checkpoint_file=config.get('DOWNLOAD', 'checkpoint_file', fallback='.download_checkpoint.json')
     # ))
     
     print("使用例をコメントアウトして実行してください")
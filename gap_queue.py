@@ -0,0 +1,90 @@
+"""
+取得しきれなかったメッセージIDの区間（ギャップ）のキュー
+
+1回の実行でチャンネルごとに取得する件数には上限があり、新着がそれを超えたチャンネルは
+最新の分だけを取得して、残りの区間をここに記録します。記録した区間は以降の実行で古い順に少しずつ取得します。
+1回に取得する件数（ページの大きさ）はチャンネルごとに調整し、FloodWaitが起きたら半分に、
+問題なく取得できたら倍にします。
+"""
+
+import time
+
+from state_store import load_json_state, save_json_state
+
+
+class GapQueue:
+    """チャンネルごとの未取得の区間 [low, high]（メッセージID、両端を含む）"""
+
+    def __init__(self, path, page_size=100, min_page_size=20, max_page_size=1000):
+        self.path = path
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        state = load_json_state(path, {})
+        # str(channel_id) -> [{"low", "high", "detected_at"}, ...]（lowの昇順、重なりなし）
+        self.gaps = state.get("gaps", {})
+        self.page_sizes = state.get("page_sizes", {})  # str(channel_id) -> ページの大きさ
+
+    def add(self, channel_id, low, high):
+        """区間を追加（同じチャンネルの重なる・隣接する区間とはまとめる）"""
+        if low > high:
+            return
+        gaps = self.gaps.setdefault(str(channel_id), [])
+        detected_at = time.time()
+        merged = []
+        for gap in gaps:
+            if gap["high"] + 1 < low or high + 1 < gap["low"]:
+                merged.append(gap)
+            else:
+                low, high = min(low, gap["low"]), max(high, gap["high"])
+                detected_at = min(detected_at, gap["detected_at"])
+        merged.append({"low": low, "high": high, "detected_at": detected_at})
+        merged.sort(key=lambda gap: gap["low"])
+        self.gaps[str(channel_id)] = merged
+
+    def channels(self):
+        """ギャップのあるチャンネルID（最も古いギャップが古い順）"""
+        return sorted(
+            (int(key) for key, gaps in self.gaps.items() if gaps),
+            key=lambda channel_id: min(gap["detected_at"] for gap in self.gaps[str(channel_id)])
+        )
+
+    def first(self, channel_id):
+        """チャンネルの最も古い（IDの小さい）ギャップ。なければNone"""
+        gaps = self.gaps.get(str(channel_id))
+        return gaps[0] if gaps else None
+
+    def advance(self, channel_id, gap, next_low):
+        """ギャップの先頭からnext_lowの手前までを取得済みにする（すべて取得したら削除）"""
+        gap["low"] = next_low
+        if gap["low"] > gap["high"]:
+            self.remove(channel_id, gap)
+
+    def remove(self, channel_id, gap):
+        gaps = self.gaps.get(str(channel_id), [])
+        if gap in gaps:
+            gaps.remove(gap)
+        if not gaps:
+            self.gaps.pop(str(channel_id), None)
+
+    def page_size_for(self, channel_id):
+        return self.page_sizes.get(str(channel_id), self.page_size)
+
+    def on_success(self, channel_id):
+        self.page_sizes[str(channel_id)] = min(self.max_page_size, self.page_size_for(channel_id) * 2)
+
+    def on_flood_wait(self, channel_id):
+        self.page_sizes[str(channel_id)] = max(self.min_page_size, self.page_size_for(channel_id) // 2)
+
+    def stats(self):
+        """ギャップの件数・メッセージIDの数の合計（削除済みのメッセージを含む上限）・最も古いギャップの経過時間（秒）"""
+        all_gaps = [gap for gaps in self.gaps.values() for gap in gaps]
+        return {
+            "gaps": len(all_gaps),
+            "channels": len(self.gaps),
+            "message_ids": sum(gap["high"] - gap["low"] + 1 for gap in all_gaps),
+            "oldest_age": time.time() - min(gap["detected_at"] for gap in all_gaps) if all_gaps else 0,
+        }
+
+    def save(self):
+        save_json_state(self.path, {"gaps": self.gaps, "page_sizes": self.page_sizes})
@@ -0,0 +1,250 @@
+"""
+URL・ドメイン・ユーザーIDからメッセージを引く索引
+
+クローラーが出力したレコードのエンティティ（MessageEntityUrl / MessageEntityTextUrlのURL、
+メンションのuser_id）と送信者のユーザーIDをSQLiteに記録し、全件走査せずに該当するメッセージを返します。
+    urls: 正規化したURLと、ドメインを逆順にしたもの（例: www.example.com -> com.example.www）
+    users: ユーザーIDと出現の種類（sender: 送信者 / mention: メンション）
+ドメインはサブドメインを含めて、URLは前方一致で検索できます。
+
+    python indicator_index.py [--index output/indicator_index.db] domain example.com
+    python indicator_index.py [--index output/indicator_index.db] url https://example.com/path [--prefix]
+    python indicator_index.py [--index output/indicator_index.db] user 123456789
+    python indicator_index.py [--index output/indicator_index.db] check-domains domains.txt
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import time
+import urllib.parse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT NOT NULL,
+    rdomain TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    sent_at TEXT,
+    PRIMARY KEY (url, channel_id, message_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_urls_rdomain ON urls (rdomain);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    sent_at TEXT,
+    PRIMARY KEY (user_id, channel_id, message_id, role)
+) WITHOUT ROWID;
+"""
+
+URL_ENTITY_TYPES = ("MessageEntityUrl", "MessageEntityTextUrl")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+DEFANGED_SCHEME = re.compile(r'^hxxp(s?)://', re.IGNORECASE)
+# "//"のないスキーム（mailto:・tel:・javascript:など。ポート番号の":80"とは区別する）
+OPAQUE_SCHEME = re.compile(r'^[a-z][a-z0-9+.-]*:(?!\d)', re.IGNORECASE)
+# ホスト名のラベル（英数字・ハイフン・アンダースコア、IDNは変換前の文字も許可）とIPv6アドレス
+HOST_LABEL = re.compile(r'^[^\W_](?:[\w-]{0,61}[^\W_])?$|^_[\w-]{0,62}$')
+IPV6_ADDRESS = re.compile(r'^[0-9a-f:.]+$')
+
+
+def normalize_domain(domain):
+    """小文字化・末尾のドット除去・IDNはpunycodeに変換"""
+    domain = domain.strip().lower().rstrip(".").replace("[.]", ".")
+    try:
+        return domain.encode("idna").decode("ascii")
+    except UnicodeError:
+        return domain
+
+
+def reverse_domain(domain):
+    """www.example.com -> com.example.www（サブドメインを前方一致で検索するため）"""
+    return ".".join(reversed(domain.split(".")))
+
+
+def is_valid_host(host):
+    """ホスト名（またはIPアドレス）として使える文字だけで構成されているか"""
+    if ":" in host:
+        return bool(IPV6_ADDRESS.match(host))
+    labels = host.split(".")
+    return len(host) <= 253 and all(HOST_LABEL.match(label) for label in labels)
+
+
+def normalize_url(url):
+    """比較用にURLを正規化（スキーム補完・ホストの小文字化・既定ポートとフラグメントの除去）。URLでなければNone
+
+    無害化されたスキーム（hxxp://・hxxps://）とドット（[.]）は元に戻します。
+    http・https以外のスキーム（mailto:・tg://など）はNoneです。
+    """
+    url = DEFANGED_SCHEME.sub(r'http\1://', url.strip()).replace("[.]", ".")
+    if "://" not in url:
+        if OPAQUE_SCHEME.match(url):
+            return None
+        url = "http://" + url
+    try:
+        parts = urllib.parse.urlsplit(url)
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not host:
+        return None
+    host = normalize_domain(host)
+    if not is_valid_host(host):
+        return None
+    netloc = f"[{host}]" if ":" in host else host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{port}"
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def _domain_range(domain):
+    """ドメインとそのサブドメインに一致するrdomainの範囲（'.'の次の文字は'/'）"""
+    rdomain = reverse_domain(normalize_domain(domain))
+    return rdomain, rdomain + ".", rdomain + "/"
+
+
+class IndicatorIndex:
+    """URL・ドメイン・ユーザーID -> (チャンネルID, メッセージID, 送信日時)
+
+    add_record()でクローラーの出力レコードを追加し、batch_size件溜まるかflush()を呼んだときに書き込みます。
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.url_rows = []
+        self.user_rows = []
+
+    @classmethod
+    def from_config(cls, config):
+        """config.iniの[INDEX]から作成（indicator_index_fileが空欄ならNone）"""
+        path = config.get('INDEX', 'indicator_index_file', fallback='')
+        if not path:
+            return None
+        return cls(path, batch_size=config.getint('INDEX', 'indicator_index_batch_size', fallback=1000))
+
+    # --- 追加 ---------------------------------------------------------------
+
+    def add_record(self, record):
+        """出力レコード（{channel_id: {...}}）のURL・メンション・送信者を追加"""
+        for channel_id, body in record.items():
+            key = (int(channel_id), body["message_id"], body.get("JST_send_time"))
+            sender = body.get("sender_user")
+            if sender:
+                self.user_rows.append((sender["user_id"], "sender") + key)
+            for entity in body.get("entities") or ():
+                if entity.get("type") in URL_ENTITY_TYPES and entity.get("url"):
+                    url = normalize_url(entity["url"])
+                    if url is not None:
+                        self.url_rows.append((url, reverse_domain(urllib.parse.urlsplit(url).hostname)) + key)
+                if entity.get("user_id"):
+                    self.user_rows.append((entity["user_id"], "mention") + key)
+        if len(self.url_rows) + len(self.user_rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.url_rows and not self.user_rows:
+            return
+        url_rows, self.url_rows = self.url_rows, []
+        user_rows, self.user_rows = self.user_rows, []
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO urls VALUES (?, ?, ?, ?, ?)", url_rows)
+            self.connection.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?)", user_rows)
+
+    # --- 検索 ---------------------------------------------------------------
+
+    def by_domain(self, domain, limit=1000):
+        """ドメイン（サブドメインを含む）を含むメッセージ: [(url, channel_id, message_id, sent_at), ...]"""
+        rdomain, low, high = _domain_range(domain)
+        return self.connection.execute(
+            "SELECT url, channel_id, message_id, sent_at FROM urls "
+            "WHERE rdomain = ? OR (rdomain >= ? AND rdomain < ?) ORDER BY sent_at DESC LIMIT ?",
+            (rdomain, low, high, limit)
+        ).fetchall()
+
+    def by_url(self, url, prefix=False, limit=1000):
+        """URL（prefix=Trueなら前方一致）を含むメッセージ: [(url, channel_id, message_id, sent_at), ...]"""
+        url = normalize_url(url)
+        if url is None:
+            return []
+        if prefix:
+            # 正規化で補われた末尾の"/"は前方一致の条件に含めない
+            url = url[:-1] if url.endswith("/") and urllib.parse.urlsplit(url).path == "/" else url
+            condition, parameters = "url >= ? AND url < ?", (url, url + "\U0010ffff")
+        else:
+            condition, parameters = "url = ?", (url,)
+        return self.connection.execute(
+            f"SELECT url, channel_id, message_id, sent_at FROM urls WHERE {condition} ORDER BY sent_at DESC LIMIT ?",
+            parameters + (limit,)
+        ).fetchall()
+
+    def by_user(self, user_id, limit=1000):
+        """ユーザーが送信・メンションされたメッセージ: [(role, channel_id, message_id, sent_at), ...]"""
+        return self.connection.execute(
+            "SELECT role, channel_id, message_id, sent_at FROM users WHERE user_id = ? ORDER BY sent_at DESC LIMIT ?",
+            (int(user_id), limit)
+        ).fetchall()
+
+    def count_domains(self, domains):
+        """ドメインの一覧を照合し、出現したものだけを{ドメイン: (件数, 最終出現日時)}で返す"""
+        hits = {}
+        for domain in domains:
+            rdomain, low, high = _domain_range(domain)
+            count, last_seen = self.connection.execute(
+                "SELECT COUNT(*), MAX(sent_at) FROM urls WHERE rdomain = ? OR (rdomain >= ? AND rdomain < ?)",
+                (rdomain, low, high)
+            ).fetchone()
+            if count:
+                hits[domain] = (count, last_seen)
+        return hits
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="URL・ドメイン・ユーザーIDからメッセージを検索")
+    parser.add_argument("--index", default="output/indicator_index.db", help="索引のパス（デフォルト: output/indicator_index.db）")
+    parser.add_argument("--limit", type=int, default=1000)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("domain", help="ドメイン（サブドメインを含む）").add_argument("domain")
+    url_parser = subparsers.add_parser("url", help="URL")
+    url_parser.add_argument("url")
+    url_parser.add_argument("--prefix", action="store_true", help="前方一致")
+    subparsers.add_parser("user", help="ユーザーID").add_argument("user_id", type=int)
+    subparsers.add_parser("check-domains", help="ファイル（1行1ドメイン）のドメインをまとめて照合").add_argument("file")
+    args = parser.parse_args()
+
+    index = IndicatorIndex(args.index)
+    started_at = time.perf_counter()
+    if args.command == "check-domains":
+        with open(args.file, encoding='utf-8') as f:
+            domains = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        hits = index.count_domains(domains)
+        for domain, (count, last_seen) in hits.items():
+            print(f"{domain}\t{count}\t{last_seen}")
+        print(f"{len(domains)}件中{len(hits)}件が出現（{(time.perf_counter() - started_at) * 1000:.1f}ms）")
+    else:
+        if args.command == "domain":
+            rows = index.by_domain(args.domain, limit=args.limit)
+        elif args.command == "url":
+            rows = index.by_url(args.url, prefix=args.prefix, limit=args.limit)
+        else:
+            rows = index.by_user(args.user_id, limit=args.limit)
+        for value, channel_id, message_id, sent_at in rows:
+            print(f"{sent_at}\t{channel_id}\t{message_id}\t{value}")
+        print(f"{len(rows)}件（{(time.perf_counter() - started_at) * 1000:.1f}ms）")
+    index.close()
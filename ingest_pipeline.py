@@ -0,0 +1,232 @@
+"""
+常時実行版の受信パイプライン
+
+NewMessageのイベントハンドラはメッセージを上限付きのキューに積むだけにし、
+送信者の解決・整形・出力は複数のワーカータスクがまとめて行います。
+キューが満杯のときの動作（overflow）は以下から選択します。
+    block: 空きが出るまでハンドラを待たせる（Telethonの更新処理に背圧がかかる）
+    spill: ディスクに退避し、キューに空きができてから順番に戻す
+"""
+
+from telethon.extensions import BinaryReader
+import asyncio
+import base64
+import inspect
+import os
+import sys
+import time
+import traceback
+
+
+class StageStats:
+    """処理段階ごとの件数・合計時間・最大時間"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def observe(self, stage, seconds):
+        count, total, maximum = self.stages.get(stage, (0, 0.0, 0.0))
+        self.stages[stage] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def summary(self):
+        """{段階: {"count", "avg_ms", "max_ms"}}を返す"""
+        return {
+            stage: {"count": count, "avg_ms": total / count * 1000, "max_ms": maximum * 1000}
+            for stage, (count, total, maximum) in self.stages.items()
+        }
+
+
+class IngestPipeline:
+    """受信したメッセージをキュー経由でワーカーに渡す
+
+    process(message)はレコード（dict）またはNoneを返すコルーチン、
+    write(records)はレコードのリストを出力先に渡す関数またはコルーチン関数です（書き込みの完了は出力先から通知します）。
+    コルーチンの場合は完了を待ってから次のメッセージを取り出すので、出力先の背圧がキューに伝わります。
+    write_failed(records)を指定すると、write()が例外を送出したときにそのレコードを渡して呼びます。
+    """
+
+    OVERFLOW_POLICIES = ("block", "spill")
+
+    def __init__(self, process, write, client, queue_size=10000, workers=4, batch_size=100,
+                 overflow="block", spill_file=".ingest_spill.jsonl", stats_interval=60, write_failed=None):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"overflowの設定が不正です: {overflow}（{', '.join(self.OVERFLOW_POLICIES)}のいずれか）")
+        self.process = process
+        self.write = write
+        self.write_failed = write_failed
+        self.client = client
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.stats_interval = stats_interval
+        self.stats = StageStats()
+        self.tasks = []
+        self.max_depth = 0
+        self.processed = 0
+        self.dropped = 0  # 処理対象外（チャンネル以外など）
+        self.errors = 0
+        # ディスクに退避中の件数（前回異常終了時の残りも含む）
+        self.spill_pending = self._count_spilled()
+        self.spill_handle = None
+        self.spill_ready = asyncio.Event()
+
+    # --- 受け付け -----------------------------------------------------------
+
+    async def put(self, message):
+        """メッセージをキューに積む（イベントハンドラから呼ぶ）"""
+        item = (time.monotonic(), message)
+        if self.overflow == "spill":
+            # 退避中は順序を保つため、キューに空きがあっても退避ファイルの後ろに積む
+            if self.spill_pending or self.queue.full():
+                self._spill(message)
+                return
+            self.queue.put_nowait(item)
+        else:
+            await self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _spill(self, message):
+        if self.spill_handle is None:
+            self.spill_handle = open(self.spill_file, 'a', encoding='ascii')
+        # TL形式でシリアライズして1行ずつ追記
+        self.spill_handle.write(base64.b64encode(bytes(message)).decode('ascii') + '\n')
+        self.spill_handle.flush()
+        self.spill_pending += 1
+        self.spill_ready.set()
+
+    def _count_spilled(self):
+        count = 0
+        for path in (self.spill_file + '.draining', self.spill_file):
+            if os.path.exists(path):
+                with open(path, 'r', encoding='ascii') as f:
+                    count += sum(1 for line in f if line.strip())
+        return count
+
+    async def _drain_spill(self):
+        """キューに空きができたら退避したメッセージを古い順に戻す"""
+        draining = self.spill_file + '.draining'
+        while True:
+            if not self.spill_pending:
+                self.spill_ready.clear()
+                await self.spill_ready.wait()
+            # キューが半分以上埋まっている間は待つ
+            while self.queue.qsize() > self.queue.maxsize // 2:
+                await asyncio.sleep(0.1)
+            if not os.path.exists(draining):
+                if self.spill_handle is not None:
+                    self.spill_handle.close()
+                    self.spill_handle = None
+                if not os.path.exists(self.spill_file):
+                    self.spill_pending = 0
+                    continue
+                os.replace(self.spill_file, draining)
+            with open(draining, 'r', encoding='ascii') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        message = BinaryReader(base64.b64decode(line)).tgread_object()
+                        # 復元したメッセージをクライアントに関連付ける（get_sender等を使えるようにする）
+                        message._finish_init(self.client, {}, None)
+                        await self.queue.put((time.monotonic(), message))
+                    except Exception as e:
+                        self.errors += 1
+                        print(f"エラー: 退避したメッセージを復元できませんでした: {e}", file=sys.stderr)
+                    self.spill_pending -= 1
+            os.remove(draining)
+
+    # --- ワーカー -----------------------------------------------------------
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            records = []
+            now = time.monotonic()
+            for enqueued_at, message in batch:
+                self.stats.observe("queue_wait", now - enqueued_at)
+                try:
+                    record = await self.process(message)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"エラー: メッセージ処理中にエラーが発生しました: {e}", file=sys.stderr)
+                    traceback.print_exc()
+                    continue
+                if record is None:
+                    self.dropped += 1
+                else:
+                    records.append(record)
+            if records:
+                started_at = time.monotonic()
+                try:
+                    result = self.write(records)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    self.errors += 1
+                    print(f"エラー: 出力に失敗しました: {e}", file=sys.stderr)
+                    traceback.print_exc()
+                    if self.write_failed is not None:
+                        self.write_failed(records)
+                self.stats.observe("write", time.monotonic() - started_at)
+                self.processed += len(records)
+            for _ in batch:
+                self.queue.task_done()
+
+    # --- 監視 ---------------------------------------------------------------
+
+    def snapshot(self):
+        """監視用の統計（キューの深さ・段階ごとの処理時間など）を返す"""
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_max_depth": self.max_depth,
+            "spill_pending": self.spill_pending,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "stages": self.stats.summary(),
+        }
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            stats = self.snapshot()
+            stages = ", ".join(
+                f"{stage}: 平均{values['avg_ms']:.1f}ms/最大{values['max_ms']:.1f}ms"
+                for stage, values in stats["stages"].items()
+            )
+            # 標準出力はメッセージの出力に使うため、統計は標準エラー出力に出す
+            print(f"[pipeline] キュー: {stats['queue_depth']}件（最大{stats['queue_max_depth']}件）, "
+                  f"退避中: {stats['spill_pending']}件, 処理: {stats['processed']}件, "
+                  f"対象外: {stats['dropped']}件, エラー: {stats['errors']}件 | {stages}", file=sys.stderr)
+
+    # --- 起動・停止 ---------------------------------------------------------
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.overflow == "spill" or self.spill_pending:
+            if self.spill_pending:
+                self.spill_ready.set()
+            self.tasks.append(asyncio.create_task(self._drain_spill()))
+        if self.stats_interval:
+            self.tasks.append(asyncio.create_task(self._report()))
+
+    async def stop(self, timeout=10):
+        """キューに残っている分を処理してから停止する"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"警告: 未処理のメッセージが{self.queue.qsize()}件残ったまま停止します", file=sys.stderr)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.spill_handle is not None:
+            self.spill_handle.close()
+            self.spill_handle = None
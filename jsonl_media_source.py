@@ -0,0 +1,151 @@
+"""
+クローラーのJSONL出力からダウンロード対象を読み出す
+
+ファイル全体を読み込まずに1行ずつ読み、media.download_infoを持つレコードだけを返します。
+ファイルごとに「そこまでの行がすべて処理済み」の位置（バイト数）を記録し、再実行時はその位置から読み始めます。
+"""
+
+from collections import OrderedDict
+import glob
+import json
+import os
+import time
+
+from state_store import load_json_state, save_json_state
+
+
+class DownloadItem:
+    """ダウンロード対象の1行"""
+
+    __slots__ = ("path", "end", "media_info")
+
+    def __init__(self, path, end, media_info):
+        self.path = path
+        self.end = end  # この行の末尾の位置（バイト）
+        self.media_info = media_info
+
+
+class _FileProgress:
+    """1ファイル分の処理済みの位置。完了順が前後しても、先頭から連続して完了した行までを確定する"""
+
+    def __init__(self, committed):
+        self.committed = committed
+        self.pending = OrderedDict()  # 行末の位置 -> 完了したか（読み出した順）
+
+    def add(self, end):
+        self.pending[end] = False
+
+    def skip(self, end):
+        """ダウンロード対象でない行"""
+        if self.pending:
+            self.pending[end] = True
+        else:
+            self.committed = end
+
+    def done(self, end):
+        self.pending[end] = True
+        while self.pending:
+            first_end, finished = next(iter(self.pending.items()))
+            if not finished:
+                break
+            self.pending.popitem(last=False)
+            self.committed = first_end
+
+
+class JsonlMediaSource:
+    """JSONLファイル（globパターン可）を順に読み、ダウンロード対象のDownloadItemを返すイテレーター
+
+    同じメッセージ（アルバムは同じ(チャンネルID, grouped_id)）はmax_seen件まで記憶して重複を除きます。
+    処理が終わった行はdone()で知らせます。処理済みの位置はsave_interval秒ごとと、save()の呼び出し時に保存します。
+    失敗した行はdone()を呼ばないため処理済みの位置はその手前で止まり、再実行時はその行から読み直します。
+    """
+
+    def __init__(self, paths, checkpoint_file=".download_checkpoint.json", max_seen=200000, save_interval=30):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = sorted({
+            os.path.abspath(path)
+            for pattern in paths
+            for path in (glob.glob(pattern) or [pattern])
+        })
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint = load_json_state(checkpoint_file, {})  # 絶対パス -> 処理済みの位置
+        self.progress = {}
+        self.seen = OrderedDict()
+        self.max_seen = max_seen
+        self.yielded = 0
+        self.duplicates = 0
+        self.save_interval = save_interval
+        self.saved_at = time.monotonic()
+
+    @staticmethod
+    def _dedup_key(download_info):
+        grouped_id = download_info.get("grouped_id")
+        if grouped_id:
+            return (download_info["channel_id"], "album", grouped_id)
+        return (download_info["channel_id"], download_info["message_id"])
+
+    def _is_duplicate(self, download_info):
+        key = self._dedup_key(download_info)
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return True
+        self.seen[key] = None
+        if len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return False
+
+    def __iter__(self):
+        for path in self.paths:
+            if not os.path.exists(path):
+                print(f"警告: ファイルが見つかりません: {path}")
+                continue
+            offset = self.checkpoint.get(path, 0)
+            if offset > os.path.getsize(path):
+                # ファイルが置き換えられている場合は最初から
+                offset = 0
+            progress = self.progress[path] = _FileProgress(offset)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # 書き込み途中の行は次回に回す
+                        break
+                    offset += len(line)
+                    media_info = self._media_info(line, path)
+                    if media_info is None or self._is_duplicate(media_info["download_info"]):
+                        if media_info is not None:
+                            self.duplicates += 1
+                        progress.skip(offset)
+                        continue
+                    progress.add(offset)
+                    self.yielded += 1
+                    yield DownloadItem(path, offset, media_info)
+
+    @staticmethod
+    def _media_info(line, path):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"警告: {path} の不正な行をスキップしました: {e}")
+            return None
+        for body in record.values():
+            media_info = body.get("media") if isinstance(body, dict) else None
+            if media_info and "download_info" in media_info:
+                return media_info
+        return None
+
+    def done(self, item):
+        """itemの処理が成功した"""
+        self.progress[item.path].done(item.end)
+        if time.monotonic() - self.saved_at >= self.save_interval:
+            self.save()
+
+    def save(self):
+        for path, progress in self.progress.items():
+            self.checkpoint[path] = progress.committed
+        save_json_state(self.checkpoint_file, self.checkpoint)
+        self.saved_at = time.monotonic()
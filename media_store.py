@@ -0,0 +1,166 @@
+"""
+メディアの重複排除ストア
+
+同じファイルが複数のチャンネルに転送されても1回だけダウンロードするよう、
+TelegramのファイルID（photo_id / document_id）をキーにして1つの実体だけを保存します。
+メッセージ（チャンネルID, メッセージID）からは実体への参照だけを記録します。
+hash_contentを有効にすると、ファイルIDが異なっても内容（SHA-256）が同じなら実体を共有します。
+"""
+
+import asyncio
+import hashlib
+import os
+import shutil
+
+from message_extractor import MEDIA_HANDLERS
+from state_store import load_json_state, save_json_state
+
+
+def file_key_from_media_info(media_info):
+    """クローラーの出力（mediaフィールド）からストアのキーを作成（写真・ファイル以外はNone）"""
+    if media_info.get("photo_id") is not None:
+        return f"photo_{media_info['photo_id']}"
+    # 動画もファイル（Document）として同じIDの空間を使う
+    document_id = media_info.get("document_id") or media_info.get("video_id")
+    if document_id is not None:
+        return f"document_{document_id}"
+    return None
+
+
+def file_key(message):
+    """Messageからストアのキーを作成（写真・ファイル以外はNone）"""
+    media = message.media
+    handler = MEDIA_HANDLERS.get(type(media))
+    media_info = {}
+    if handler is None or not handler(media, media_info):
+        return None
+    return file_key_from_media_info(media_info)
+
+
+class MediaStore:
+    """ファイルIDをキーにした実体の保存先と、メッセージからの参照の索引"""
+
+    def __init__(self, root="downloads/store", index_file=None, hash_content=False):
+        self.root = root
+        self.index_file = index_file or os.path.join(root, "index.json")
+        self.hash_content = hash_content
+        index = load_json_state(self.index_file, {})
+        self.files = index.get("files", {})  # キー -> {"path", "size", "sha256"}
+        self.refs = index.get("refs", {})  # "チャンネルID:メッセージID" -> キー
+        self.hashes = {entry["sha256"]: key for key, entry in self.files.items() if entry.get("sha256")}
+        self.inflight = {}  # ダウンロード中のキー -> Task（同じファイルの同時ダウンロードをまとめる）
+        self.reused = 0
+
+    @staticmethod
+    def _ref(channel_id, message_id):
+        return f"{channel_id}:{message_id}"
+
+    def _stored_path(self, key):
+        entry = self.files.get(key)
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry["path"])
+        if not os.path.exists(path):
+            # 実体が削除されていれば索引からも外す
+            del self.files[key]
+            return None
+        return path
+
+    def lookup(self, key):
+        """保存済みならファイルのパス、未保存ならNone（転送前の確認用）"""
+        if key is None:
+            return None
+        return self._stored_path(key)
+
+    def add_reference(self, channel_id, message_id, key):
+        self.refs[self._ref(channel_id, message_id)] = key
+
+    def reuse(self, channel_id, message_id, key):
+        """保存済みならメッセージからの参照を追加してパスを返す（未保存ならNone）"""
+        path = self.lookup(key)
+        if path is not None:
+            self.add_reference(channel_id, message_id, key)
+            self.reused += 1
+        return path
+
+    def path_for_message(self, channel_id, message_id):
+        """メッセージが参照しているファイルのパス（なければNone）"""
+        key = self.refs.get(self._ref(channel_id, message_id))
+        return self.lookup(key)
+
+    def _sha256(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def commit(self, key, temp_path):
+        """ダウンロードしたファイルをストアに移し、保存先のパスを返す"""
+        sha256 = self._sha256(temp_path) if self.hash_content else None
+        if sha256 is not None:
+            existing = self.hashes.get(sha256)
+            if existing is not None and self._stored_path(existing) is not None:
+                # 内容が同じ実体があればそれを共有し、ダウンロードしたファイルは捨てる
+                os.remove(temp_path)
+                self.files[key] = dict(self.files[existing])
+                return os.path.join(self.root, self.files[key]["path"])
+        kind, file_id = key.split("_", 1)
+        extension = os.path.splitext(temp_path)[1]
+        relative_path = os.path.join(kind, f"{int(file_id) % 256:02x}", key + extension)
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(temp_path, path)
+        self.files[key] = {"path": relative_path, "size": os.path.getsize(path), "sha256": sha256}
+        if sha256 is not None:
+            self.hashes[sha256] = key
+        return path
+
+    async def get_or_download(self, message, key, download):
+        """保存済みなら参照を追加するだけ、未保存ならdownload(一時ディレクトリ)で取得して保存する
+
+        keyはfile_key(message)の結果、downloadはダウンロード先ディレクトリを受け取り
+        ファイルのパス（失敗時はNone）を返すコルーチン関数です。
+        """
+        channel_id = getattr(message.peer_id, 'channel_id', None)
+        path = self.reuse(channel_id, message.id, key)
+        if path is not None:
+            return path
+        task = self.inflight.get(key)
+        if task is not None:
+            # 同じファイルを別のメッセージがダウンロード中
+            path = await asyncio.shield(task)
+            if path is not None:
+                self.reused += 1
+        else:
+            task = self.inflight[key] = asyncio.ensure_future(self._download(key, download))
+            try:
+                path = await task
+            finally:
+                del self.inflight[key]
+        if path is not None:
+            self.add_reference(channel_id, message.id, key)
+        return path
+
+    async def _download(self, key, download):
+        # キーごとに決まった作業ディレクトリを使い、分割ダウンロードの途中経過（.part）を次回に引き継ぐ
+        temp_dir = os.path.join(self.root, ".staging", key)
+        os.makedirs(temp_dir, exist_ok=True)
+        completed = False
+        try:
+            temp_path = await download(temp_dir)
+            if not temp_path:
+                return None
+            path = self.commit(key, temp_path)
+            completed = True
+            return path
+        finally:
+            if completed:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                for name in os.listdir(temp_dir):
+                    if not name.endswith((".part", ".part.json")):
+                        os.remove(os.path.join(temp_dir, name))
+
+    def save(self):
+        save_json_state(self.index_file, {"files": self.files, "refs": self.refs})
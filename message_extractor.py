@@ -0,0 +1,278 @@
+"""
+メッセージの抽出処理（常時実行版・都度実行版で共通）
+
+TelethonのMessageから出力用のレコードを作成します。メディアやエンティティの種類ごとの処理は
+型をキーにした対応表で振り分け、メッセージごとのhasattr/getattrによる判定を避けています。
+"""
+
+from telethon.helpers import add_surrogate, del_surrogate
+from telethon.tl import types
+import datetime
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def utc_to_jst(date_time):
+    """UTCの日時をJSTの文字列（YYYY/MM/DD HH:MM:SS）に変換"""
+    if date_time is None:
+        return None
+    return date_time.astimezone(JST).strftime("%Y/%m/%d %H:%M:%S")
+
+
+class MessageRecord:
+    """1メッセージ分の出力レコード（固定フィールド）"""
+
+    __slots__ = (
+        "channel_id", "channel_name", "message_id", "message", "message_from_geo",
+        "JST_send_time", "display_of_post_author", "media", "entities", "from_id",
+        "sender_user", "bot",
+    )
+
+    def __init__(self, channel_id, channel_name, message_id, message, message_from_geo,
+                 JST_send_time, display_of_post_author, media, entities, from_id):
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+        self.message_id = message_id
+        self.message = message
+        self.message_from_geo = message_from_geo
+        self.JST_send_time = JST_send_time
+        self.display_of_post_author = display_of_post_author
+        self.media = media
+        self.entities = entities
+        self.from_id = from_id
+        self.sender_user = None
+        self.bot = False
+
+    def set_sender(self, sender_info):
+        """SenderCache.resolve()の結果を設定"""
+        self.sender_user = sender_info["sender_user"]
+        self.bot = sender_info["bot"]
+
+    def to_dict(self):
+        """従来の出力形式（{channel_id: {...}}）に変換"""
+        body = {
+            "channel_name": self.channel_name,
+            "message_id": self.message_id,
+            "message": self.message,
+            "message_from_geo": self.message_from_geo,
+            "JST_send_time": self.JST_send_time,
+            "display_of_post_author": self.display_of_post_author,
+        }
+        if self.media:
+            body["media"] = self.media
+        if self.entities:
+            body["entities"] = self.entities
+        body["from_id"] = self.from_id
+        if self.sender_user is not None:
+            body["sender_user"] = self.sender_user
+        body["bot"] = self.bot
+        return {self.channel_id: body}
+
+
+# --- メディア ---------------------------------------------------------------
+
+def _describe_photo(photo, media_info):
+    media_info["type"] = "photo"
+    media_info["photo_id"] = photo.id
+
+
+def _describe_document(document, media_info):
+    # 属性は1回だけ走査して動画判定・再生時間・ファイル名をまとめて取得
+    is_video = False
+    duration = None
+    file_name = None
+    for attribute in document.attributes:
+        attribute_type = type(attribute)
+        if attribute_type is types.DocumentAttributeVideo:
+            if not is_video:
+                is_video = True
+                duration = attribute.duration
+        elif attribute_type is types.DocumentAttributeFilename:
+            file_name = attribute.file_name
+    if is_video:
+        media_info["type"] = "video"
+        media_info["video_id"] = document.id
+        media_info["duration"] = duration
+    else:
+        media_info["type"] = "document"
+        media_info["document_id"] = document.id
+        media_info["mime_type"] = document.mime_type
+        media_info["file_name"] = file_name
+        media_info["file_size"] = document.size
+
+
+def _media_photo(media, media_info):
+    if type(media.photo) is types.Photo:
+        _describe_photo(media.photo, media_info)
+        return True
+    return False
+
+
+def _media_document(media, media_info):
+    if type(media.document) is types.Document:
+        _describe_document(media.document, media_info)
+        return True
+    return False
+
+
+def _media_webpage(media, media_info):
+    # リンクプレビューの写真・ファイルも写真・ファイルとして扱う
+    webpage = media.webpage
+    if type(webpage) is not types.WebPage:
+        return False
+    if type(webpage.photo) is types.Photo:
+        _describe_photo(webpage.photo, media_info)
+        return True
+    if type(webpage.document) is types.Document:
+        _describe_document(webpage.document, media_info)
+        return True
+    return False
+
+
+MEDIA_HANDLERS = {
+    types.MessageMediaPhoto: _media_photo,
+    types.MessageMediaDocument: _media_document,
+    types.MessageMediaWebPage: _media_webpage,
+}
+
+GEO_MEDIA_TYPES = {types.MessageMediaGeo, types.MessageMediaGeoLive, types.MessageMediaVenue}
+
+
+def media_type(message):
+    """メディアの種類（photo, video, document, その他はクラス名）を返す。メディアがなければNone"""
+    media = message.media
+    if media is None:
+        return None
+    media_info = {}
+    handler = MEDIA_HANDLERS.get(type(media))
+    if handler is None or not handler(media, media_info):
+        return type(media).__name__
+    return media_info["type"]
+
+
+def extract_media(message, channel_id):
+    """メディア情報（画像、動画、ファイルなど）を抽出。メディアがなければ空のdict"""
+    media_info = {}
+    # 複数メディア（写真アルバムなど）のチェック
+    grouped_id = message.grouped_id
+    if grouped_id:
+        media_info["grouped_id"] = grouped_id
+        media_info["is_grouped"] = True
+
+    media = message.media
+    if media is None:
+        return media_info
+    handler = MEDIA_HANDLERS.get(type(media))
+    if handler is None or not handler(media, media_info):
+        media_info["type"] = type(media).__name__
+    # ダウンロードするための情報
+    media_info["message_id"] = message.id
+    media_info["channel_id"] = channel_id
+    media_info["download_info"] = {
+        "channel_id": channel_id,
+        "message_id": message.id,
+        "grouped_id": grouped_id
+    }
+    return media_info
+
+
+def extract_geo(message):
+    """位置情報を{"lat", "long"}で返す。位置情報がなければNone"""
+    media = message.media
+    if type(media) not in GEO_MEDIA_TYPES:
+        return None
+    geo = media.geo
+    if type(geo) is not types.GeoPoint:
+        return None
+    return {"lat": geo.lat, "long": geo.long}
+
+
+# --- エンティティ（リンク、メンションなど） ---------------------------------
+
+# 装飾情報（Bold、Emoji）は除外
+SKIPPED_ENTITY_TYPES = {"MessageEntityBold", "MessageEntityCustomEmoji"}
+
+# エンティティの型ごとに、どのフィールドを取り出すかを初回に決めて保持する
+_ENTITY_PLANS = {}
+_SKIP = object()
+
+
+def _compile_entity_plan(entity):
+    entity_type = type(entity).__name__
+    if entity_type in SKIPPED_ENTITY_TYPES:
+        return _SKIP
+    has_span = hasattr(entity, 'offset') and hasattr(entity, 'length')
+    return (
+        entity_type,
+        hasattr(entity, 'url'),
+        has_span,
+        has_span and entity_type == "MessageEntityUrl",  # テキストからURLを抽出
+        hasattr(entity, 'user_id'),  # ユーザーID（メンションの場合）
+    )
+
+
+def extract_entities(entities, text):
+    """エンティティのリストを出力形式に変換
+
+    エンティティのoffset・lengthはUTF-16のコード単位なので、本文から切り出すときは
+    サロゲートペアに展開した本文を使います（絵文字などが前にあってもずれないように）。
+    """
+    entities_info = []
+    surrogate_text = None
+    for entity in entities:
+        plan = _ENTITY_PLANS.get(type(entity))
+        if plan is None:
+            plan = _ENTITY_PLANS[type(entity)] = _compile_entity_plan(entity)
+        if plan is _SKIP:
+            continue
+        entity_type, has_url, has_span, url_from_text, has_user_id = plan
+        entity_data = {"type": entity_type}
+        if has_url:
+            entity_data["url"] = entity.url
+        if has_span:
+            entity_data["offset"] = entity.offset
+            entity_data["length"] = entity.length
+            if url_from_text and text:
+                if surrogate_text is None:
+                    surrogate_text = add_surrogate(text)
+                entity_data["url"] = del_surrogate(surrogate_text[entity.offset:entity.offset + entity.length])
+        if has_user_id:
+            entity_data["user_id"] = entity.user_id
+        entities_info.append(entity_data)
+    return entities_info
+
+
+# --- 送信元 -----------------------------------------------------------------
+
+# four type of message
+FROM_ID_FIELDS = {
+    types.PeerUser: ("peerUser", "user_id"),  # Sender user id
+    types.PeerChat: ("peerChat", "chat_id"),  # Sender chat id
+    types.PeerChannel: ("peerChannel", "channel_id"),  # Sender channel id
+}
+
+
+def extract_from_id(from_id):
+    fields = FROM_ID_FIELDS.get(type(from_id))
+    if fields is None:
+        return {"anonymous": None}  # Unknown sender type
+    key, attribute = fields
+    return {key: getattr(from_id, attribute)}
+
+
+def extract_message(message, channel_id, channel_name):
+    """Messageから出力レコードを作成（送信者情報はset_sender()で後から設定）"""
+    text = message.message
+    entities = message.entities
+    return MessageRecord(
+        channel_id,
+        channel_name,  # Channel title
+        message.id,  # Message ID in channel
+        text,  # Plain text content
+        extract_geo(message),  # Geo tag if present
+        utc_to_jst(message.date),  # Timestamp in JST
+        message.post_author,  # Author name shown on post
+        extract_media(message, channel_id),
+        extract_entities(entities, text) if entities else None,
+        extract_from_id(message.from_id),
+    )
@@ -0,0 +1,409 @@
+"""
+メッセージの出力先
+
+取得したメッセージをメモリに溜め込まず、生成されたそばから書き出します。
+都度実行版はJsonlFileSinkまたはSqliteSink、常時実行版はAsyncLineWriterと各出力先（標準出力・ファイル・ソケット）
+またはSqliteSinkを使います。
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+from sqlite_sink import SqliteSink
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class JsonlFileSink:
+    """メッセージを1行1件のJSONLファイルへ逐次書き込む出力先
+
+    バッファが一定件数に達したとき、または前回の書き込みから一定時間が経過したときに
+    ファイルへ書き出します。書き込み中は<path>.partialに書き、close()でpathに名前を変えるので、
+    pathが存在すればそのファイルは書き終わっています（コンパクションが書き込み中のファイルを読まないため）。
+    書き込み中は<path>.partialの排他ロック（flock）を保持するので、異常終了で残った.partialと区別できます。
+    fsyncの方針は以下から選択します。
+        never: fsyncしない（OSに任せる）
+        flush: 書き出すたびにfsyncする
+        close: 終了時に1回だけfsyncする
+    """
+
+    FSYNC_POLICIES = ("never", "flush", "close")
+
+    def __init__(self, path, buffer_size=500, flush_interval=5.0, fsync="flush"):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"fsyncの設定が不正です: {fsync}（{', '.join(self.FSYNC_POLICIES)}のいずれか）")
+        self.path = path
+        self.partial_path = path + ".partial"
+        self.buffer_size = max(1, buffer_size)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer = []
+        self.file = None
+        self.records_written = 0  # ファイルに書き出した件数
+        self.last_flush = time.monotonic()
+
+    @property
+    def records_pending(self):
+        """バッファ内の未書き込み件数"""
+        return len(self.buffer)
+
+    def write(self, record):
+        """1件追加する。バッファが満杯または一定時間経過していれば書き出す"""
+        self.buffer.append(json.dumps(record, ensure_ascii=False) + '\n')
+        if len(self.buffer) >= self.buffer_size or self.is_flush_due():
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def is_flush_due(self):
+        return bool(self.buffer) and time.monotonic() - self.last_flush >= self.flush_interval
+
+    def _open(self):
+        # ディレクトリが存在しない場合は作成
+        output_dir = os.path.dirname(self.path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+            print(f"ディレクトリを作成しました: {output_dir}")
+        # 書き込むメッセージがあるときだけファイルを作成（追記モード）
+        self.file = open(self.partial_path, 'a', encoding='utf-8')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                self.file = None
+                raise
+
+    def flush(self):
+        """バッファの内容をファイルに書き出す"""
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        if self.file is None:
+            self._open()
+        self.file.write(''.join(self.buffer))
+        self.file.flush()
+        if self.fsync == "flush":
+            os.fsync(self.file.fileno())
+        self.records_written += len(self.buffer)
+        self.buffer.clear()
+
+    async def sync(self):
+        """バッファの内容を書き出し、ディスクに反映されるまで待つ（fsyncはイベントループの外で行う）"""
+        self.flush()
+        if self.file is not None and self.fsync != "flush":
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, self.file.fileno())
+
+    async def autoflush(self):
+        """書き込みが途切れてもflush_interval以内にファイルへ反映されるよう定期的に書き出す"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.is_flush_due():
+                self.flush()
+
+    def close(self):
+        """残りを書き出してファイルを閉じ、書き込み中の名前から本来の名前に変える"""
+        self.flush()
+        if self.file is not None:
+            if self.fsync != "never":
+                os.fsync(self.file.fileno())
+            if fcntl is None:
+                self.file.close()
+            # ロックを保持したまま名前を変え、コンパクションが同じファイルを引き取らないようにする
+            os.replace(self.partial_path, self.path)
+            self.file.close()
+            self.file = None
+
+
+class StdoutSink:
+    """標準出力への出力先"""
+
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def close(self):
+        sys.stdout.buffer.flush()
+
+
+class RotatingFileSink:
+    """一定サイズごとにローテーションするファイルへの出力先
+
+    サイズがmax_bytesを超えたらpath.1, path.2, ...にずらし、backup_countより古いものは削除します。
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = None
+
+    def _open(self):
+        output_dir = os.path.dirname(self.path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self.file = open(self.path, 'ab')
+
+    def _rotate(self):
+        self.file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, data):
+        if self.file is None:
+            self._open()
+        if self.max_bytes and self.file.tell() > 0 and self.file.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class UnixSocketSink:
+    """ローカルのUNIXドメインソケットへの出力先
+
+    受信側が起動していない・切断された場合は接続を閉じて例外を送出し（AsyncLineWriterが再試行する）、
+    次の書き込みで再接続します。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+
+    def write(self, data):
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+            self.sock.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class AsyncLineWriter:
+    """レコードを1行のJSONにしてバッファし、専用スレッドで出力先へまとめて書き出す
+
+    write()はバッファに追加するだけなので、イベントハンドラ（イベントループ）を止めません。
+    バッファがbuffer_size件に達したとき、またはflush_interval秒ごとに書き出します。
+    出力先が遅い・止まっている間にバッファがmax_buffer件に達したら、write_many()は書き出しが進むまで待ちます
+    （受信パイプラインのワーカーが止まり、キューの上限で受信に背圧がかかる）。
+    出力先への書き込みに失敗した分はバッファの先頭に戻して次回に再試行し、max_retries回続けて失敗したら破棄します。
+    on_complete(records, written)を指定すると、出力先に書き込めたレコード（written=True）と
+    破棄したレコード（written=False）を書き込みの結果が確定した時点で渡して呼びます（イベントループのスレッドから）。
+    """
+
+    def __init__(self, sink, buffer_size=1000, flush_interval=0.5, max_retries=3, on_complete=None,
+                 max_buffer=10000):
+        self.sink = sink
+        self.on_complete = on_complete
+        self.buffer_size = max(1, buffer_size)
+        self.max_buffer = max(self.buffer_size, max_buffer)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.buffer = []  # (1行のJSON, レコード)
+        self.failures = 0  # 続けて失敗した回数
+        self.records_written = 0
+        self.records_dropped = 0
+        # 書き込み順を保つため1スレッドで実行
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # 失敗した分をバッファの先頭に戻すため、書き出しは同時に1つだけ行う
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = None
+
+    def write(self, record):
+        self.buffer.append((json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n', record))
+        if len(self.buffer) >= self.buffer_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    async def write_many(self, records):
+        """追加する。バッファがmax_buffer件以上なら、それを下回るまで書き出しを待つ"""
+        for record in records:
+            self.write(record)
+        while len(self.buffer) >= self.max_buffer:
+            try:
+                await self.flush()
+            except Exception as e:
+                # 失敗した分はバッファに戻る（max_retries回続けて失敗したら破棄される）ので、間を置いて再試行する
+                print(f"エラー: 出力に失敗しました: {e}", file=sys.stderr)
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        """バッファの内容を出力先に書き出す"""
+        async with self.flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self.buffer:
+            return
+        entries, self.buffer = self.buffer, []
+        data = ''.join(line for line, _ in entries).encode('utf-8')
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.sink.write, data)
+        except Exception:
+            self.failures += 1
+            if self.failures < self.max_retries:
+                # 順序を保つため、書き込み中に追加された分より前に戻す
+                self.buffer[:0] = entries
+            else:
+                self.failures = 0
+                self._drop(entries)
+                print(f"エラー: 出力に{self.max_retries}回続けて失敗したため{len(entries)}件を破棄しました"
+                      f"（破棄した合計: {self.records_dropped}件）", file=sys.stderr)
+            raise
+        self.failures = 0
+        self.records_written += len(entries)
+        if self.on_complete is not None:
+            self.on_complete([record for _, record in entries], True)
+
+    def _drop(self, entries):
+        self.records_dropped += len(entries)
+        if self.on_complete is not None:
+            self.on_complete([record for _, record in entries], False)
+
+    async def run(self):
+        """バックグラウンドで定期的に書き出す（asyncio.create_task()で起動）"""
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"エラー: 出力に失敗しました: {e}", file=sys.stderr)
+                traceback.print_exc()
+
+    async def close(self):
+        """残りを書き出して出力先を閉じる"""
+        for _ in range(self.max_retries):
+            try:
+                await self.flush()
+                break
+            except Exception as e:
+                print(f"エラー: 出力に失敗しました: {e}", file=sys.stderr)
+        if self.buffer:
+            print(f"エラー: 書き出せなかった{len(self.buffer)}件を破棄して終了します", file=sys.stderr)
+            entries, self.buffer = self.buffer, []
+            self._drop(entries)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.sink.close)
+        self.executor.shutdown(wait=True)
+
+
+class AsyncSinkWriter:
+    """SqliteSinkを常時実行版の書き込み（AsyncLineWriterと同じインターフェース）として使う
+
+    書き出しはSqliteSinkの書き込みスレッドが行います。on_complete(records, written)を指定すると、
+    バッチがコミットされた（written=True）またはコミットできなかった（written=False）時点で
+    イベントループのスレッドから呼びます。
+    """
+
+    def __init__(self, sink, on_complete=None):
+        self.sink = sink
+        self.on_complete = on_complete
+        self.loop = None
+        if on_complete is not None:
+            sink.on_commit = self._committed
+
+    @property
+    def records_written(self):
+        return self.sink.records_written
+
+    def write_many(self, records):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.sink.write_many(records)
+
+    def _committed(self, batch, committed):
+        # 書き込みスレッドから呼ばれる
+        self.loop.call_soon_threadsafe(self.on_complete, batch, committed)
+
+    async def run(self):
+        await self.sink.autoflush()
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.sink.close)
+
+
+def create_sink(config, output_file):
+    """config.iniの[OUTPUT]から都度実行版の出力先を作成（backend=sqliteのときはoutput_fileを使わない）"""
+    backend = config.get('OUTPUT', 'backend', fallback='jsonl')
+    buffer_size = config.getint('OUTPUT', 'buffer_size', fallback=500)
+    flush_interval = config.getfloat('OUTPUT', 'flush_interval', fallback=5.0)
+    if backend == 'jsonl':
+        return JsonlFileSink(
+            output_file,
+            buffer_size=buffer_size,
+            flush_interval=flush_interval,
+            fsync=config.get('OUTPUT', 'fsync', fallback='flush')
+        )
+    if backend == 'sqlite':
+        return SqliteSink(
+            config.get('OUTPUT', 'sqlite_file', fallback='output/telegram_messages.db'),
+            buffer_size=buffer_size,
+            flush_interval=flush_interval
+        )
+    raise ValueError(f"backendの設定が不正です: {backend}（jsonl, sqliteのいずれか）")
+
+
+def create_live_writer(config, on_complete=None):
+    """config.iniの[OUTPUT]から常時実行版の出力先を作成
+
+    on_complete(records, written)は出力先への書き込みの結果が確定したときに呼ばれます。
+    """
+    output = config.get('OUTPUT', 'live_output', fallback='stdout')
+    if output == 'stdout':
+        sink = StdoutSink()
+    elif output == 'file':
+        sink = RotatingFileSink(
+            config.get('OUTPUT', 'live_output_file', fallback='output/live_messages.jsonl'),
+            max_bytes=config.getint('OUTPUT', 'live_rotate_bytes', fallback=100 * 1024 * 1024),
+            backup_count=config.getint('OUTPUT', 'live_rotate_backups', fallback=10)
+        )
+    elif output == 'socket':
+        sink = UnixSocketSink(config.get('OUTPUT', 'live_socket', fallback='/tmp/telegram_crawler.sock'))
+    elif output == 'sqlite':
+        # SqliteSinkは自前の書き込みスレッドを持つのでAsyncLineWriterを介さない
+        return AsyncSinkWriter(SqliteSink(
+            config.get('OUTPUT', 'sqlite_file', fallback='output/telegram_messages.db'),
+            buffer_size=config.getint('OUTPUT', 'live_buffer_size', fallback=1000),
+            flush_interval=config.getfloat('OUTPUT', 'live_flush_interval', fallback=0.5)
+        ), on_complete=on_complete)
+    else:
+        raise ValueError(f"live_outputの設定が不正です: {output}（stdout, file, socket, sqliteのいずれか）")
+    return AsyncLineWriter(
+        sink,
+        buffer_size=config.getint('OUTPUT', 'live_buffer_size', fallback=1000),
+        flush_interval=config.getfloat('OUTPUT', 'live_flush_interval', fallback=0.5),
+        on_complete=on_complete,
+        max_buffer=config.getint('OUTPUT', 'live_max_buffer', fallback=10000)
+    )
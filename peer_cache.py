@@ -0,0 +1,70 @@
+"""
+チャンネルのアクセスハッシュのキャッシュ
+
+クローラーがダイアログ一覧を読み込んだときにチャンネルID -> アクセスハッシュを記録し、
+ダウンロード時はget_entityを呼ばずにInputPeerChannelを作成できるようにします。
+DialogSnapshotと違い、全件走査で見えなくなったチャンネルも削除せずに保持します。
+"""
+
+from telethon import utils
+from telethon.tl import types
+
+from state_store import load_json_state, save_json_state
+
+
+class PeerCache:
+    """チャンネルID（-100プレフィックスなし） -> アクセスハッシュ"""
+
+    def __init__(self, path):
+        self.path = path
+        self.peers = load_json_state(path, {})  # str(channel_id) -> access_hash
+        self.changed = {}  # このプロセスで追加・更新した分（保存時にファイルの内容とマージする）
+        self.removed = set()
+
+    def put(self, channel_id, access_hash):
+        key = str(channel_id)
+        if self.peers.get(key) != access_hash:
+            self.peers[key] = access_hash
+            self.changed[key] = access_hash
+            self.removed.discard(key)
+
+    def discard(self, channel_id):
+        """無効になったアクセスハッシュを削除"""
+        key = str(channel_id)
+        self.peers.pop(key, None)
+        self.changed.pop(key, None)
+        self.removed.add(key)
+
+    def update_from_snapshot(self, channels):
+        """DialogSnapshot.channelsの内容を取り込む"""
+        for entry in channels.values():
+            self.put(entry["channel_id"], entry["access_hash"])
+
+    def input_peer(self, channel_id):
+        """キャッシュにあればInputPeerChannel（RPCなし）、なければNone"""
+        access_hash = self.peers.get(str(channel_id))
+        if access_hash is None:
+            return None
+        return types.InputPeerChannel(int(channel_id), access_hash)
+
+    async def resolve(self, client, channel_id):
+        """キャッシュにあればそのまま、なければget_entityで取得してキャッシュに追加"""
+        peer = self.input_peer(channel_id)
+        if peer is None:
+            entity = await client.get_entity(types.PeerChannel(int(channel_id)))
+            peer = utils.get_input_peer(entity)
+            self.put(channel_id, peer.access_hash)
+        return peer
+
+    def save(self):
+        """他のプロセス（クローラー・ダウンローダー）が保存した内容とマージして保存"""
+        if not self.changed and not self.removed:
+            return
+        peers = load_json_state(self.path, {})
+        for key in self.removed:
+            peers.pop(key, None)
+        peers.update(self.changed)
+        save_json_state(self.path, peers)
+        self.peers = peers
+        self.changed = {}
+        self.removed = set()
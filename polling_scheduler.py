@@ -0,0 +1,121 @@
+"""
+チャンネルごとの取得間隔の調整
+
+ダイアログ一覧の最新メッセージIDの増え方からチャンネルごとの投稿頻度（件/秒）を指数移動平均で推定し、
+target_messages件ほど溜まる間隔（min_interval～max_intervalの範囲）で履歴を取得します。
+投稿の多いチャンネルは頻繁に、少ないチャンネルはまれに取得し、履歴の取得に使うRPCの数は
+1分あたりrpc_budget_per_minute回（トークンバケット）に抑えます。状態は実行をまたいで保存します。
+"""
+
+import math
+import time
+
+from state_store import load_json_state, save_json_state
+
+MESSAGES_PER_REQUEST = 100  # iter_messagesの1回のRPCで取得できる最大件数
+
+
+class PollingScheduler:
+    """チャンネルごとの投稿頻度の推定と、取得するチャンネルの選択"""
+
+    def __init__(self, path, min_interval=60, max_interval=3600, target_messages=50, smoothing=0.3,
+                 rpc_budget_per_minute=60, burst_minutes=10):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.target_messages = max(1, target_messages)
+        self.smoothing = smoothing  # 指数移動平均の重み（新しい観測の割合）
+        self.rpc_budget_per_minute = rpc_budget_per_minute
+        self.capacity = rpc_budget_per_minute * max(1, burst_minutes)  # 間隔が空いたときに使える上限
+        state = load_json_state(path, {})
+        # str(channel_id) -> {"rate", "top_message", "observed_at", "polled_at"}
+        self.channels = state.get("channels", {})
+        self.tokens = state.get("tokens", self.capacity)
+        self.refilled_at = state.get("refilled_at", time.time())
+        self.deferred = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """config.iniの[SCHEDULER]から作成（enabled=falseならNone）"""
+        if not config.getboolean('SCHEDULER', 'enabled', fallback=False):
+            return None
+        return cls(
+            config.get('SCHEDULER', 'state_file', fallback='.polling_schedule.json'),
+            min_interval=config.getint('SCHEDULER', 'min_interval', fallback=60),
+            max_interval=config.getint('SCHEDULER', 'max_interval', fallback=3600),
+            target_messages=config.getint('SCHEDULER', 'target_messages', fallback=50),
+            smoothing=config.getfloat('SCHEDULER', 'smoothing', fallback=0.3),
+            rpc_budget_per_minute=config.getint('SCHEDULER', 'rpc_budget_per_minute', fallback=60),
+            burst_minutes=config.getint('SCHEDULER', 'burst_minutes', fallback=10)
+        )
+
+    def observe(self, channel_id, top_message, now=None):
+        """ダイアログ一覧の最新メッセージIDから投稿頻度を更新（RPCなし）"""
+        now = time.time() if now is None else now
+        state = self.channels.get(str(channel_id))
+        if state is None:
+            self.channels[str(channel_id)] = {
+                "rate": 0.0, "top_message": top_message, "observed_at": now, "polled_at": None,
+            }
+            return
+        elapsed = now - state["observed_at"]
+        if elapsed <= 0:
+            return
+        sample = max(0, top_message - state["top_message"]) / elapsed
+        state["rate"] = self.smoothing * sample + (1 - self.smoothing) * state["rate"]
+        state["top_message"] = top_message
+        state["observed_at"] = now
+
+    def interval(self, channel_id):
+        """取得間隔（秒）: target_messages件溜まる時間をmin_interval～max_intervalに収めたもの"""
+        state = self.channels.get(str(channel_id))
+        rate = state["rate"] if state else 0.0
+        if rate <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, self.target_messages / rate))
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rpc_budget_per_minute / 60)
+        self.refilled_at = now
+
+    def select(self, candidates, max_messages, now=None):
+        """新着のあるチャンネル [(channel, cursor), ...] から今回取得するものを選ぶ
+
+        取得間隔が経過したものを未取得の件数の多い順に、RPCの予算の範囲で選びます。
+        選ばれなかったチャンネルはカーソルが進まないので、次回以降に取得されます。
+        """
+        now = time.time() if now is None else now
+        self._refill(now)
+        due = []
+        for channel, cursor in candidates:
+            state = self.channels.get(str(channel["channel_id"]))
+            polled_at = state and state["polled_at"]
+            if cursor is None or polled_at is None or now - polled_at >= self.interval(channel["channel_id"]):
+                due.append((channel, cursor))
+        due.sort(key=lambda item: item[0]["top_message"] - (item[1] or 0), reverse=True)
+        selected = []
+        for channel, cursor in due:
+            backlog = min(max_messages, channel["top_message"] - (cursor or 0))
+            cost = max(1, math.ceil(backlog / MESSAGES_PER_REQUEST))
+            if cost > self.tokens and selected:
+                continue
+            # 予算が足りなくても1チャンネルは取得する（予算が小さすぎて何も取得できなくなるのを防ぐ）
+            self.tokens -= cost
+            selected.append((channel, cursor))
+            self.channels.setdefault(str(channel["channel_id"]), {
+                "rate": 0.0, "top_message": channel["top_message"], "observed_at": now, "polled_at": None,
+            })["polled_at"] = now
+        self.deferred = len(candidates) - len(selected)
+        return selected
+
+    def stats(self):
+        rates = [state["rate"] for state in self.channels.values()]
+        return {
+            "channels": len(rates),
+            "hot": sum(1 for rate in rates if rate > 0 and self.target_messages / rate <= self.min_interval),
+            "deferred": self.deferred,
+            "tokens": self.tokens,
+        }
+
+    def save(self):
+        save_json_state(self.path, {"channels": self.channels, "tokens": self.tokens, "refilled_at": self.refilled_at})
@@ -0,0 +1,146 @@
+"""
+送信者（ユーザー）情報のキャッシュ
+
+get_sender()/get_entity()の結果をユーザーIDごとに保持し、同じユーザーの投稿で
+問い合わせを繰り返さないようにします。件数上限・有効期限（TTL）・LRU方式の削除に対応し、
+常時実行版と都度実行版の両方で使用します。
+"""
+
+from telethon.tl import types
+from collections import OrderedDict
+import asyncio
+import time
+
+from state_store import load_json_state, save_json_state
+
+
+class SenderCache:
+    """ユーザーIDをキーに送信者情報（ボット判定とsender_user）をキャッシュする"""
+
+    def __init__(self, max_size=10000, ttl_seconds=86400, path=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.entries = OrderedDict()  # user_id -> (有効期限, 送信者情報)
+        self.pending = {}  # 取得中のユーザーID -> asyncio.Future（同じユーザーの同時取得を1回にまとめる）
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def _lookup(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if expires_at < time.time():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return info
+
+    def get(self, user_id):
+        """キャッシュ済みの送信者情報を返す。ない場合・期限切れの場合はNone"""
+        info = self._lookup(user_id)
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return info
+
+    def put(self, user_id, info):
+        self.entries[user_id] = (time.time() + self.ttl_seconds, info)
+        self.entries.move_to_end(user_id)
+        # 上限を超えた分は最も長く使われていないものから削除
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def info_from_entity(entity):
+        """ユーザー/チャンネルのエンティティから送信者情報を作成"""
+        sender_is_bot = getattr(entity, "bot", False)
+        sender_user = None
+        if not sender_is_bot and isinstance(entity, types.User):
+            sender_user = {
+                "user_id": entity.id,
+                "username": entity.username,
+                "phone": getattr(entity, "phone", None),
+                "Firstname": entity.first_name,
+                "Lastname": entity.last_name,
+            }
+        return {"bot": sender_is_bot, "sender_user": sender_user}
+
+    @staticmethod
+    def info_from_message(message):
+        """送信者を取得できない場合にメッセージ情報からボット判定する"""
+        if getattr(message, 'via_bot_id', None) is not None:
+            return {"bot": True, "sender_user": None}  # ボット経由のメッセージ
+        # チャンネル投稿（通常はボットではない）や判断できない場合はFalseとする
+        return {"bot": False, "sender_user": None}
+
+    async def resolve(self, client, message):
+        """メッセージの送信者情報を返す。ユーザーからの投稿はキャッシュを使用"""
+        user_id = getattr(message.from_id, "user_id", None)
+        if user_id is None:
+            # ユーザー以外（チャンネル投稿・匿名など）はキャッシュしない
+            sender = await message.get_sender()
+            if sender is None:
+                return self.info_from_message(message)
+            return self.info_from_entity(sender)
+
+        info = self.get(user_id)
+        if info is not None:
+            return info
+
+        pending = self.pending.get(user_id)
+        if pending is not None:
+            # 別のタスクが取得中ならその結果を待つ（待っている側がキャンセルされても取得は続ける）
+            info = await asyncio.shield(pending)
+            if info is None:
+                return self.info_from_message(message)
+            self.misses -= 1
+            self.hits += 1
+            return info
+
+        # 取得を始めたタスクだけが登録・削除する
+        pending = self.pending[user_id] = asyncio.get_running_loop().create_future()
+        info = None
+        try:
+            sender = await message.get_sender()
+            if sender is None and getattr(message, 'via_bot_id', None) is None \
+                and not getattr(message, 'post', False):
+                # from_idのuser_idからユーザー情報を取得
+                try:
+                    sender = await client.get_entity(user_id)
+                except:
+                    sender = None  # 取得できない場合はメッセージ情報から判断
+            if sender is None:
+                return self.info_from_message(message)
+            info = self.info_from_entity(sender)
+            self.put(user_id, info)
+            return info
+        finally:
+            # 取得できなかった・失敗した場合はNoneを渡し、待っていたタスクは各自のメッセージ情報から判断する
+            pending.set_result(info)
+            del self.pending[user_id]
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を返す"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": hit_rate, "size": len(self.entries)}
+
+    def load(self):
+        state = load_json_state(self.path, {})
+        now = time.time()
+        # 有効期限の古い順に並べてLRUの順序を復元
+        for user_id, (expires_at, info) in sorted(state.items(), key=lambda item: item[1][0]):
+            if expires_at >= now:
+                self.entries[int(user_id)] = (expires_at, info)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        save_json_state(self.path, {str(user_id): [expires_at, info] for user_id, (expires_at, info) in self.entries.items()})
@@ -0,0 +1,293 @@
+"""
+SQLiteへの出力
+
+メッセージ・送信者・メディア・エンティティを正規化したテーブルに保存し、チャンネル・送信日時・送信者で検索できるようにします。
+書き込みは専用スレッドがバッチごとに1トランザクションで行い（WALモード）、イベントループを止めません。
+コミットに失敗したバッチは再試行し、それでも失敗した場合はJSONLファイル（failed_file）に退避します。
+JsonlFileSinkと同じwrite/flush/sync/close/autoflushのインターフェースを持ちます。
+"""
+
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    channel_name TEXT,
+    message TEXT,
+    geo_lat REAL,
+    geo_long REAL,
+    sent_at TEXT,  -- JST（YYYY/MM/DD HH:MM:SS、文字列の順序が日時の順序と一致）
+    post_author TEXT,
+    from_type TEXT,  -- peerUser / peerChat / peerChannel / anonymous
+    from_id INTEGER,
+    sender_user_id INTEGER,
+    bot INTEGER NOT NULL DEFAULT 0,
+    grouped_id INTEGER,
+    PRIMARY KEY (channel_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_channel_sent_at ON messages (channel_id, sent_at);
+CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_user_id);
+
+CREATE TABLE IF NOT EXISTS senders (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    phone TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS media (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    type TEXT,
+    file_id INTEGER,  -- photo_id / video_id / document_id
+    grouped_id INTEGER,
+    mime_type TEXT,
+    file_name TEXT,
+    file_size INTEGER,
+    duration REAL,
+    PRIMARY KEY (channel_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS idx_media_file_id ON media (file_id);
+
+CREATE TABLE IF NOT EXISTS entities (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT,
+    "offset" INTEGER,
+    length INTEGER,
+    url TEXT,
+    user_id INTEGER,
+    PRIMARY KEY (channel_id, message_id, position)
+);
+"""
+
+
+def _rows_from_record(record):
+    """出力レコード（{channel_id: {...}}）を各テーブルの行に分解"""
+    for channel_id, body in record.items():
+        channel_id = int(channel_id)
+        message_id = body["message_id"]
+        geo = body.get("message_from_geo") or {}
+        from_type, from_id = next(iter((body.get("from_id") or {"anonymous": None}).items()))
+        sender = body.get("sender_user")
+        media = body.get("media") or {}
+        message_row = (
+            channel_id, message_id, body.get("channel_name"), body.get("message"),
+            geo.get("lat"), geo.get("long"), body.get("JST_send_time"), body.get("display_of_post_author"),
+            from_type, from_id, sender["user_id"] if sender else None, int(bool(body.get("bot"))),
+            media.get("grouped_id"),
+        )
+        sender_row = None
+        if sender:
+            sender_row = (
+                sender["user_id"], sender.get("username"), sender.get("phone"),
+                sender.get("Firstname"), sender.get("Lastname"), body.get("JST_send_time"),
+            )
+        media_row = None
+        if "type" in media:
+            media_row = (
+                channel_id, message_id, media["type"],
+                media.get("photo_id") or media.get("video_id") or media.get("document_id"),
+                media.get("grouped_id"), media.get("mime_type"), media.get("file_name"),
+                media.get("file_size"), media.get("duration"),
+            )
+        entity_rows = [
+            (channel_id, message_id, position, entity.get("type"), entity.get("offset"),
+             entity.get("length"), entity.get("url"), entity.get("user_id"))
+            for position, entity in enumerate(body.get("entities") or ())
+        ]
+        yield message_row, sender_row, media_row, entity_rows
+
+
+def _resolve(future):
+    if not future.done():  # sync()を待っていた側がキャンセルされた場合
+        future.set_result(None)
+
+
+class SqliteSink:
+    """メッセージをSQLiteデータベースへ書き込む出力先
+
+    write()はバッファに追加するだけで、buffer_size件に達したときまたはflush_interval秒ごとに
+    バッファを書き込みスレッドへ渡します。同じメッセージを書き込んだ場合は上書きします。
+    on_commitにon_commit(batch, committed)を設定すると、バッチをコミットした（committed=True）
+    またはfailed_fileに退避した（committed=False）後に書き込みスレッドから呼びます。
+    """
+
+    def __init__(self, path, buffer_size=500, flush_interval=5.0, max_retries=3, failed_file=None):
+        self.path = path
+        self.buffer_size = max(1, buffer_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.failed_file = failed_file or path + ".failed.jsonl"
+        self.buffer = []
+        # 件数はイベントループのスレッドと書き込みスレッドの両方から更新するためロックで保護する
+        self.lock = threading.Lock()
+        self.records_written = 0  # コミット済みの件数
+        self.records_queued = 0  # 書き込みスレッドに渡してまだコミットしていない件数
+        self.records_failed = 0  # コミットできずfailed_fileに退避した件数
+        self.on_commit = None
+        self.last_flush = time.monotonic()
+        self.batches = queue.Queue()
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self.thread.start()
+        # スキーマの作成に失敗した場合（パスが不正など）は起動時にエラーにする
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def records_pending(self):
+        """コミットしていない件数"""
+        with self.lock:
+            return len(self.buffer) + self.records_queued
+
+    def write(self, record):
+        """1件追加する。バッファが満杯または一定時間経過していれば書き込みスレッドへ渡す"""
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size or self.is_flush_due():
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def is_flush_due(self):
+        return bool(self.buffer) and time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """バッファの内容を書き込みスレッドへ渡す（コミットを待たない）"""
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        with self.lock:
+            self.records_queued += len(batch)
+        self.batches.put(batch)
+
+    async def sync(self):
+        """バッファの内容を書き込みスレッドへ渡し、それまでのバッチがコミット（または退避）されるまで待つ
+
+        待っている間もイベントループは止めません（書き込みスレッドがcall_soon_threadsafeで完了を知らせる）。
+        """
+        self.flush()
+        committed = asyncio.get_running_loop().create_future()
+        self.batches.put(committed)
+        await committed
+
+    async def autoflush(self):
+        """書き込みが途切れてもflush_interval以内にデータベースへ反映されるよう定期的に書き出す"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.is_flush_due():
+                self.flush()
+
+    def close(self):
+        """残りを書き込み、書き込みスレッドの終了を待つ"""
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()
+
+    # --- 書き込みスレッド ---------------------------------------------------
+
+    def _connect(self):
+        output_dir = os.path.dirname(self.path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+            print(f"ディレクトリを作成しました: {output_dir}")
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    def _run(self):
+        try:
+            connection = self._connect()
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        try:
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, asyncio.Future):
+                    # sync()の待ち合わせ（キューの順に処理するので、それより前のバッチは処理済み）
+                    batch.get_loop().call_soon_threadsafe(_resolve, batch)
+                    continue
+                self._commit(connection, batch)
+        finally:
+            connection.close()
+
+    def _commit(self, connection, batch):
+        """バッチを1トランザクションで書き込む。max_retries回失敗したらfailed_fileに退避"""
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with connection:
+                    self._insert(connection, batch)
+            except Exception as e:
+                print(f"エラー: SQLiteへの書き込みに失敗しました（{len(batch)}件, {attempt}/{self.max_retries}回目）: {e}")
+                if attempt == self.max_retries:
+                    traceback.print_exc()
+                    break
+                time.sleep(attempt)
+                continue
+            with self.lock:
+                self.records_written += len(batch)
+                self.records_queued -= len(batch)
+            self._notify(batch, True)
+            return
+        try:
+            with open(self.failed_file, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in batch)
+            print(f"警告: 書き込めなかった{len(batch)}件を {self.failed_file} に退避しました")
+        except OSError as e:
+            print(f"エラー: {len(batch)}件を {self.failed_file} に退避できませんでした: {e}")
+            traceback.print_exc()
+        with self.lock:
+            self.records_failed += len(batch)
+            self.records_queued -= len(batch)
+        self._notify(batch, False)
+
+    def _notify(self, batch, committed):
+        if self.on_commit is None:
+            return
+        try:
+            self.on_commit(batch, committed)
+        except Exception:
+            traceback.print_exc()
+
+    def _insert(self, connection, batch):
+        messages, senders, media, entities = [], [], [], []
+        for record in batch:
+            for message_row, sender_row, media_row, entity_rows in _rows_from_record(record):
+                messages.append(message_row)
+                if sender_row is not None:
+                    senders.append(sender_row)
+                if media_row is not None:
+                    media.append(media_row)
+                entities.extend(entity_rows)
+        # 上書きするメッセージの以前のメディア・エンティティを削除（エンティティが減った場合に古い行が残らないよう）
+        keys = [row[:2] for row in messages]
+        connection.executemany("DELETE FROM media WHERE channel_id = ? AND message_id = ?", keys)
+        connection.executemany("DELETE FROM entities WHERE channel_id = ? AND message_id = ?", keys)
+        connection.executemany("INSERT OR REPLACE INTO messages VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", messages)
+        connection.executemany("INSERT OR REPLACE INTO senders VALUES (?,?,?,?,?,?)", senders)
+        connection.executemany("INSERT OR REPLACE INTO media VALUES (?,?,?,?,?,?,?,?,?)", media)
+        connection.executemany("INSERT OR REPLACE INTO entities VALUES (?,?,?,?,?,?,?,?)", entities)
@@ -0,0 +1,60 @@
+"""
+クローラーの状態ファイル（JSON）を読み書きするヘルパー
+
+実行をまたいで保持する状態（チャンネルごとのカーソルなど）をここで扱います。
+"""
+
+import json
+import os
+import traceback
+
+
+def load_json_state(path, default):
+    """状態ファイルを読み込む。存在しない・壊れている場合はdefaultを返す"""
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"警告: 状態ファイル {path} の読み込みに失敗しました（初期状態で続行します）: {e}")
+        return default
+
+
+def save_json_state(path, data):
+    """一時ファイルに書き込んでから置き換える（書き込み中に落ちても元のファイルは壊れない）"""
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"エラー: 状態ファイル {path} の保存に失敗しました: {e}")
+        traceback.print_exc()
+
+
+class ChannelCursorStore:
+    """チャンネルごとに最後に取得したメッセージIDを保持する"""
+
+    def __init__(self, path):
+        self.path = path
+        self.exists = os.path.exists(path)
+        state = load_json_state(path, {})
+        self.cursors = {str(channel_id): int(message_id) for channel_id, message_id in state.items()}
+
+    def get(self, channel_id):
+        """カーソル（最終取得メッセージID）を返す。未取得のチャンネルはNone"""
+        return self.cursors.get(str(channel_id))
+
+    def advance(self, channel_id, message_id):
+        """カーソルを進める（後退はさせない）"""
+        key = str(channel_id)
+        if message_id > self.cursors.get(key, 0):
+            self.cursors[key] = message_id
+
+    def save(self):
+        save_json_state(self.path, self.cursors)
+        self.exists = True
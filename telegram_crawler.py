@@ -1,14 +1,38 @@
-from telethon import TelegramClient, events
-from telethon.tl import types
+from telethon import TelegramClient, errors, events
 from telethon.tl.custom import Message
 import configparser
-import datetime
+import contextlib
 import socks
-import json
-import pprint
+import sys
 import traceback
+import time
 import asyncio
 
+from album_index import AlbumIndex
+from channel_filter import ChannelFilter
+from dedup_index import DedupIndex
+from dialog_snapshot import DialogSnapshot
+from gap_queue import GapQueue
+from indicator_index import IndicatorIndex
+from ingest_pipeline import IngestPipeline
+from message_extractor import extract_message, utc_to_jst
+from output_sink import create_live_writer
+from peer_cache import PeerCache
+from sender_cache import SenderCache
+from state_store import ChannelCursorStore
+from text_index import TextIndex
+
+class LiveTelegramClient(TelegramClient):
+    """自動の再接続が完了したときにon_reconnectを呼ぶTelegramClient"""
+
+    on_reconnect = None
+
+    async def _handle_auto_reconnect(self):
+        # Telethonは再接続後に更新の受信を再開するだけで、切断中のメッセージは取得しない
+        await super()._handle_auto_reconnect()
+        if self.on_reconnect is not None:
+            self.on_reconnect()
+
 class TelegramCrawler:
     def __init__(self):
         try:
@@ -20,6 +44,52 @@ class TelegramCrawler:
             proxy       = self.set_proxy(config)
             self.exception_list = config.get('EXCEPT CHANNEL', 'channel')
             self.exception_list = self.exception_list.replace(" ","").split(',')
+            # 取り込み対象の判定（ダイアログ読み込み時にチャンネルごとの判定表を作成）
+            self.channel_filter = ChannelFilter.from_config(config, self.exception_list)
+            # ダイアログ一覧のスナップショット（起動間でキャッシュ）
+            self.dialog_snapshot = DialogSnapshot(
+                config.get('DIALOG', 'snapshot_file', fallback='.dialog_snapshot.json'),
+                config.getint('DIALOG', 'snapshot_ttl', fallback=86400)
+            )
+            # 送信者情報のキャッシュ（都度実行版と共有）
+            self.sender_cache = SenderCache(
+                max_size=config.getint('CACHE', 'sender_cache_size', fallback=10000),
+                ttl_seconds=config.getint('CACHE', 'sender_cache_ttl', fallback=86400),
+                path=config.get('CACHE', 'sender_cache_file', fallback='.sender_cache.json')
+            )
+            # アルバム（grouped_id）ごとのメッセージIDの索引（ダウンロード時に使用）
+            self.album_index = AlbumIndex(config.get('CACHE', 'album_index_file', fallback='.album_index.json'))
+            # チャンネルのアクセスハッシュ（ダウンロード時にget_entityを呼ばずに済むよう記録）
+            self.peer_cache = PeerCache(config.get('CACHE', 'peer_cache_file', fallback='.peer_cache.json'))
+            # 出力済みの(チャンネルID, メッセージID)の索引（実行をまたいで同じメッセージを出力しない）
+            self.dedup_index = DedupIndex(
+                config.get('CACHE', 'dedup_index_file', fallback='.dedup_index'),
+                expected_items=config.getint('CACHE', 'dedup_expected_items', fallback=1000000),
+                compact_threshold=config.getint('CACHE', 'dedup_compact_threshold', fallback=100000)
+            )
+            # 出力したレコードを追加する索引（全文検索・URL/ドメイン/ユーザーID。[INDEX]でファイルが空欄のものは作成しない）
+            self.record_indexes = [
+                index for index in (TextIndex.from_config(config), IndicatorIndex.from_config(config)) if index is not None
+            ]
+            self.state_save_interval = config.getint('CACHE', 'save_interval', fallback=300)
+            # チャンネルごとの最終出力メッセージID（起動時・再接続時に切断中の分だけを取得する）
+            self.cursor_store = ChannelCursorStore(config.get('LIVE', 'cursor_file', fallback='.live_cursors.json'))
+            self.catchup_overlap = config.getint('LIVE', 'catchup_overlap', fallback=20)
+            self.catchup_max_messages = config.getint('LIVE', 'catchup_max_messages', fallback=1000)
+            self.catchup_concurrency = max(1, config.getint('LIVE', 'catchup_concurrency', fallback=4))
+            self.max_flood_wait = config.getint('LIVE', 'max_flood_wait', fallback=300)
+            self.reconnect_delay = config.getint('LIVE', 'reconnect_delay', fallback=10)
+            self.connection_check_interval = config.getint('LIVE', 'connection_check_interval', fallback=10)
+            # 取得しきれなかった・処理に失敗したメッセージIDの区間（次回の取得で再処理する）
+            self.gap_queue = GapQueue(config.get('LIVE', 'gap_file', fallback='.live_gap_queue.json'))
+            self.gap_budget = config.getint('LIVE', 'gap_budget', fallback=1000)
+            self.catchup_task = None
+            self.catchup_requested = False
+            # ワーカーが処理中の(チャンネルID, メッセージID)（受信と切断中の分の取得で同じメッセージを重複して出力しないため）
+            self.in_flight = set()
+            # 出力先（標準出力・ローテーションするファイル・ローカルソケット）
+            # 書き込みが完了した（または破棄した）時点でcomplete_recordsが呼ばれる
+            self.writer = create_live_writer(config, on_complete=self.complete_records)
         except (configparser.NoSectionError, configparser.NoOptionError) as e:
             print(f"エラー: config.iniの設定が不正です: {e}")
             raise
@@ -28,9 +98,24 @@ class TelegramCrawler:
             raise
 
         # start telegram client
-        self.telegram_client = TelegramClient('CAnonBot', api_id, api_hash, proxy=proxy)
+        self.telegram_client = LiveTelegramClient('CAnonBot', api_id, api_hash, proxy=proxy)
+        self.telegram_client.on_reconnect = self.on_reconnect
         self.telegram_client.add_event_handler(self.new_message_handler, events.NewMessage(incoming=None))
 
+        # 受信キューとワーカー（送信者の解決・整形・出力はワーカーで行う）
+        self.pipeline = IngestPipeline(
+            self.process_message,
+            self.writer.write_many,
+            self.telegram_client,
+            write_failed=self.fail_records,
+            queue_size=config.getint('PIPELINE', 'queue_size', fallback=10000),
+            workers=config.getint('PIPELINE', 'workers', fallback=4),
+            batch_size=config.getint('PIPELINE', 'batch_size', fallback=100),
+            overflow=config.get('PIPELINE', 'overflow', fallback='block'),
+            spill_file=config.get('PIPELINE', 'spill_file', fallback='.ingest_spill.jsonl'),
+            stats_interval=config.getint('PIPELINE', 'stats_interval', fallback=60)
+        )
+
     def set_proxy(self, config):
         proxy_type  = config.get('PROXY', 'type')
         proxy_addr  = config.get('PROXY', 'addr')
@@ -57,213 +142,84 @@ class TelegramCrawler:
         return proxy
 
     async def set_own_channel_list(self):
-        self.channel_list = {}
-        async for dialog in self.telegram_client.iter_dialogs(ignore_pinned=True):
-            self.channel_list[str(dialog.id)] = {"channel_name": dialog.name}
-            if dialog.entity.username != None: 
-                self.channel_list[str(dialog.id)].update({"channel_url": "t.me/" + dialog.entity.username})
+        """ダイアログのスナップショットを更新してチャンネルリストを作成"""
+        # 再接続時にも呼ばれるため、標準出力（メッセージの出力）に経過を混ぜない
+        with contextlib.redirect_stdout(sys.stderr):
+            await self.dialog_snapshot.refresh(self.telegram_client)
+            self.peer_cache.update_from_snapshot(self.dialog_snapshot.channels)
+            self.peer_cache.save()
+            self.channel_list = self.dialog_snapshot.channel_list()
+            self.channel_filter.compile(self.dialog_snapshot.channels)
 
     # Waiting new message
     async def new_message_handler(self, event: events.NewMessage.Event):
+        """取り込み対象のメッセージだけをキューに積む（判定は更新に含まれる情報のみで行い、RPCはしない）"""
+        message: Message = event.message
+        if self.channel_filter.admit(message) is None:
+            return
+        await self.pipeline.put(message)
+
+    async def process_message(self, message: Message):
+        """メッセージを整形してレコードを返す。処理対象外の場合はNone（ワーカーから呼ばれる）
+
+        出力済みの記録（重複排除の索引・最終出力メッセージID）は、出力先への書き込みが完了した後にcomplete_recordsで行います。
+        """
+        chennel_id      = message.peer_id.channel_id
+        channel_name    = self.channel_filter.channel_name(chennel_id)
+        if channel_name is None:
+            # キューに積んだ後にチャンネルリストが更新された場合など
+            return None
+        key = (chennel_id, message.id)
+        if key in self.in_flight or self.dedup_index.contains(*key):
+            # 出力済み、または別のワーカーが処理中（退避ファイルからの再処理・切断中の分の取得と受信の重複など）
+            return None
+        self.in_flight.add(key)
         try:
-            message_logs = {}
-            message: Message    = event.message
-            sender              = await event.get_sender()
-            chennel_info        = await event.get_input_chat()
-
-            # チャンネルかどうかをチェック
-            if not hasattr(chennel_info, 'channel_id'):
-                # チャンネルでない場合（ユーザーからのメッセージなど）はスキップ
-                return
+            # メッセージ本文・メディア・エンティティを抽出（都度実行版と共通）
+            started_at = time.monotonic()
+            record = extract_message(message, chennel_id, channel_name)
+            self.pipeline.stats.observe("serialize", time.monotonic() - started_at)
+            if message.grouped_id:
+                self.album_index.add(chennel_id, message.grouped_id, message.id)
 
-            chennel_id                  = chennel_info.channel_id
-            message_logs[chennel_id]    = {}
-            
-            # チャンネルリストに存在するかチェック
-            channel_key = '-100' + str(chennel_id)
-            if channel_key not in self.channel_list:
-                # チャンネルリストにない場合はスキップ
-                return
-            
-            channel_name                = self.channel_list[channel_key]["channel_name"]
-            
-            # excpet channel
-            for except_list in self.exception_list:
-                if except_list in channel_name.replace(" ",""): return
-
-            # message from user
-            message_logs[chennel_id]["channel_name"]       =  channel_name  # Channel title
-            message_logs[chennel_id]["message_id"]         =  message.id  # Message ID in channel
-            message_logs[chennel_id]["message"]            =  message.raw_text  # Plain text content
-            message_logs[chennel_id]["message_from_geo"]   =  message.geo  # Geo tag if present
-            message_logs[chennel_id]["JST_send_time"]      =  self.utc_to_jts(message.date)  # Timestamp in JST
-            message_logs[chennel_id]["display_of_post_author"] =  message.post_author  # Author name shown on post
-            
-            # Media information (画像、動画、ファイルなど)
-            media_info = {}
-            # 複数メディア（写真アルバムなど）のチェック
-            grouped_id = getattr(message, 'grouped_id', None)
-            if grouped_id:
-                media_info["grouped_id"] = grouped_id
-                media_info["is_grouped"] = True
-            
-            if message.photo:
-                media_info["type"] = "photo"
-                media_info["photo_id"] = message.photo.id if hasattr(message.photo, 'id') else None
-                # 写真をダウンロードするための情報
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = chennel_id
-                    media_info["download_info"] = {
-                        "channel_id": chennel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            elif message.video:
-                media_info["type"] = "video"
-                media_info["video_id"] = message.video.id if hasattr(message.video, 'id') else None
-                media_info["duration"] = getattr(message.video, 'duration', None)
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = chennel_id
-                    media_info["download_info"] = {
-                        "channel_id": chennel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            elif message.document:
-                media_info["type"] = "document"
-                media_info["document_id"] = message.document.id if hasattr(message.document, 'id') else None
-                media_info["mime_type"] = getattr(message.document, 'mime_type', None)
-                media_info["file_name"] = getattr(message.document, 'file_name', None)
-                media_info["file_size"] = getattr(message.document, 'size', None)
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = chennel_id
-                    media_info["download_info"] = {
-                        "channel_id": chennel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            elif message.media:
-                media_info["type"] = str(type(message.media).__name__)
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = chennel_id
-                    media_info["download_info"] = {
-                        "channel_id": chennel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            if media_info:
-                message_logs[chennel_id]["media"] = media_info
-            
-            # Links and entities (リンク、メンションなど)
-            if message.entities:
-                entities_info = []
-                for entity in message.entities:
-                    entity_type = type(entity).__name__
-                    # 装飾情報（Bold、Emoji）は除外
-                    if entity_type in ["MessageEntityBold", "MessageEntityCustomEmoji"]:
-                        continue
-                    entity_data = {
-                        "type": entity_type
-                    }
-                    # URL情報の取得
-                    if hasattr(entity, 'url'):
-                        entity_data["url"] = entity.url
-                    # テキスト内の位置情報
-                    if hasattr(entity, 'offset') and hasattr(entity, 'length'):
-                        entity_data["offset"] = entity.offset
-                        entity_data["length"] = entity.length
-                        # テキストからURLを抽出（MessageEntityUrlの場合）
-                        if entity_data["type"] == "MessageEntityUrl":
-                            try:
-                                url_text = message.raw_text[entity.offset:entity.offset + entity.length]
-                                entity_data["url"] = url_text
-                            except:
-                                pass
-                    # ユーザーID（メンションの場合）
-                    if hasattr(entity, 'user_id'):
-                        entity_data["user_id"] = entity.user_id
-                    entities_info.append(entity_data)
-                if entities_info:
-                    message_logs[chennel_id]["entities"] = entities_info
-
-            # four type of message
-            if hasattr(message.from_id, "user_id") == True: 
-                message_logs[chennel_id]["from_id"] = {"peerUser": message.from_id.user_id}  # Sender user id
-
-            elif hasattr(message.from_id, "chat_id") == True:
-                message_logs[chennel_id]["from_id"] = {"peerChat": message.from_id.chat_id}  # Sender chat id
-
-            elif hasattr(message.from_id, "channel_id") == True:
-                message_logs[chennel_id]["from_id"] = {"peerChannel": message.from_id.channel_id}  # Sender channel id
-
-            else: 
-                message_logs[chennel_id]["from_id"] = {"anonymous": None}  # Unknown sender type
-
-            # if it wasn't a bot, get user data (sender can be Channel/Chat without bot attr)
-            if sender is None:
-                # senderがNoneの場合、メッセージ情報から判断
-                if hasattr(message, 'via_bot_id') and message.via_bot_id is not None:
-                    sender_is_bot = True  # ボット経由のメッセージ
-                elif hasattr(message, 'post') and message.post:
-                    sender_is_bot = False  # チャンネル投稿（通常はボットではない）
-                elif hasattr(message.from_id, "user_id"):
-                    # from_idにuser_idがある場合は、そのユーザー情報を取得して確認
-                    try:
-                        user_entity = await self.telegram_client.get_entity(message.from_id.user_id)
-                        sender_is_bot = getattr(user_entity, "bot", False)
-                        if not sender_is_bot and isinstance(user_entity, types.User):
-                            message_logs[chennel_id]["sender_user"] = {
-                                "user_id": user_entity.id,
-                                "username": user_entity.username,
-                                "phone": getattr(user_entity, "phone", None),
-                                "Firstname": user_entity.first_name,
-                                "Lastname": user_entity.last_name,
-                            }
-                    except:
-                        sender_is_bot = False  # 取得できない場合はFalseとする
+            # if it wasn't a bot, get user data（送信者情報はキャッシュから取得）
+            started_at = time.monotonic()
+            record.set_sender(await self.sender_cache.resolve(self.telegram_client, message))
+            self.pipeline.stats.observe("resolve_sender", time.monotonic() - started_at)
+        except Exception:
+            # 次回の切断中の分の取得で再処理する
+            self.in_flight.discard(key)
+            self.gap_queue.add(chennel_id, message.id, message.id)
+            raise
+
+        # output:JSON（1行のJSONとして出力先へ。書き出しはバックグラウンドで行う）
+        return record.to_dict()
+
+    def complete_records(self, records, written):
+        """出力先に書き込んだレコードを出力済みとして記録（出力先から呼ばれる）
+
+        書き込めずに破棄した場合はギャップとして記録し、次回の切断中の分の取得で再処理します。
+        """
+        for output in records:
+            for channel_id, body in output.items():
+                key = (int(channel_id), body["message_id"])
+                self.in_flight.discard(key)
+                if written:
+                    self.dedup_index.add(*key)
+                    self.cursor_store.advance(*key)
                 else:
-                    sender_is_bot = False  # 判断できない場合はFalseとする
-            else:
-                sender_is_bot = getattr(sender, "bot", False)
-                if not sender_is_bot and isinstance(sender, types.User):
-                    message_logs[chennel_id]["sender_user"] = {
-                        "user_id": sender.id,  # Sender user id
-                        "username": sender.username,  # Sender username
-                        "phone": getattr(sender, "phone", None),  # Sender phone number
-                        "Firstname": sender.first_name,  # Sender first name
-                        "Lastname": sender.last_name,  # Sender last name
-                    }
-            message_logs[chennel_id]["bot"] = sender_is_bot  # True if sender is bot
-
-            # output:JSON
-            self.json_telegram_message_data = json.dumps(message_logs, indent=2, ensure_ascii=False)
-            pprint.pprint(self.json_telegram_message_data)
-        except Exception as e:
-            print(f"エラー: メッセージ処理中にエラーが発生しました: {e}")
-            traceback.print_exc()
-            return
+                    self.gap_queue.add(key[0], key[1], key[1])
+            if written:
+                for index in self.record_indexes:
+                    index.add_record(output)
     
+    def fail_records(self, records):
+        """出力先に渡せなかったレコードをギャップとして記録（ワーカーから呼ばれる）"""
+        self.complete_records(records, False)
+
     def utc_to_jts(self, date_time):
         try:
-            date_time = date_time.astimezone(datetime.timezone(datetime.timedelta(hours=9)))
-            date_time = date_time.strftime("%Y/%m/%d %H:%M:%S")
-            return date_time
+            return utc_to_jst(date_time)
         except:
             traceback.print_exc()
             return None
@@ -272,15 +228,236 @@ class TelegramCrawler:
     async def logout_from_telegram_session(self):
         await self.telegram_client.log_out()
 
+    # --- 切断中のメッセージの取得 -----------------------------------------------
+    # 標準出力はメッセージの出力に使うため、経過は標準エラー出力に出す
+
+    async def catch_up(self, refresh=True):
+        """最終出力メッセージIDより新しいメッセージがあるチャンネルについて、その分だけを取得してキューに積む
+
+        取得しきれなかった区間と以前に記録した区間（ギャップ）は、gap_budget件までここで取得します。
+        """
+        if refresh:
+            await self.set_own_channel_list()
+        channels = []
+        for channel in self.dialog_snapshot.channels.values():
+            channel_id = channel["channel_id"]
+            if self.channel_filter.channel_name(channel_id) is None:
+                continue
+            cursor = self.cursor_store.get(channel_id)
+            if cursor is None:
+                # 初めて受信するチャンネルは現在の最新メッセージIDから（過去の分はバックフィルで取得）
+                self.cursor_store.advance(channel_id, channel["top_message"])
+            elif channel["top_message"] > cursor:
+                channels.append((channel, cursor))
+        self.cursor_store.save()
+        if channels:
+            print(f"切断中に新着のあった{len(channels)}件のチャンネルを取得します", file=sys.stderr)
+            semaphore = asyncio.Semaphore(self.catchup_concurrency)
+            counts = await asyncio.gather(*(
+                self.catch_up_channel(channel, cursor, semaphore) for channel, cursor in channels
+            ))
+            print(f"切断中のメッセージの取得完了: {sum(counts)}件をキューに積みました", file=sys.stderr)
+        if self.gap_queue.channels():
+            queued = await self.fill_gaps()
+            stats = self.gap_queue.stats()
+            print(f"ギャップから{queued}件をキューに積みました（残り: {stats['gaps']}区間, "
+                  f"メッセージIDの数: {stats['message_ids']}）", file=sys.stderr)
+        self.gap_queue.save()
+
+    async def catch_up_channel(self, channel, cursor, semaphore):
+        """カーソルより新しい（重複排除に任せてcatchup_overlap件手前からの）メッセージを新しい順に取得
+
+        取得しきれなかった区間（中断した場合を含む）はギャップとして記録します（受信によってカーソルが先に進んでも失われない）。
+        """
+        min_id = max(0, cursor - self.catchup_overlap)  # min_idは範囲に含まれない
+        progress = {"queued": 0, "oldest": None, "completed": False}
+        try:
+            async with semaphore:
+                await self._fetch_missed(channel, min_id, progress)
+        finally:
+            high = channel["top_message"] if progress["oldest"] is None else progress["oldest"] - 1
+            if (not progress["completed"] or progress["queued"] >= self.catchup_max_messages) and high > min_id:
+                self.gap_queue.add(channel["channel_id"], min_id + 1, high)
+                print(f"警告: {channel['name']} のメッセージID {min_id + 1}-{high} を取得しきれなかったため、ギャップとして記録しました",
+                      file=sys.stderr)
+        return progress["queued"]
+
+    async def _fetch_missed(self, channel, min_id, progress):
+        for attempt in range(2):
+            try:
+                async for message in self.telegram_client.iter_messages(
+                    self.dialog_snapshot.input_peer(channel),
+                    min_id=min_id,
+                    max_id=progress["oldest"] or 0,  # FloodWait後は取得済みの続きから
+                    limit=self.catchup_max_messages - progress["queued"]
+                ):
+                    progress["oldest"] = message.id
+                    progress["queued"] += 1
+                    if self.channel_filter.admit(message) is not None:
+                        await self.pipeline.put(message)
+                progress["completed"] = True
+                return
+            except errors.FloodWaitError as e:
+                if attempt or e.seconds > self.max_flood_wait:
+                    print(f"エラー: {channel['name']} の切断中のメッセージはレート制限（{e.seconds}秒）のため取得できませんでした",
+                          file=sys.stderr)
+                    return
+                print(f"レート制限: {channel['name']} で{e.seconds}秒待機します", file=sys.stderr)
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                print(f"エラー: {channel['name']} の切断中のメッセージの取得中にエラーが発生しました: {e}", file=sys.stderr)
+                traceback.print_exc()
+                return
+
+    async def fill_gaps(self):
+        """ギャップを検出の古いチャンネルから順に、合計gap_budget件まで取得してキューに積んだ件数を返す"""
+        budget = {"remaining": self.gap_budget, "queued": 0}
+        semaphore = asyncio.Semaphore(self.catchup_concurrency)
+        await asyncio.gather(*(
+            self.fill_channel_gaps(channel_id, budget, semaphore) for channel_id in self.gap_queue.channels()
+        ))
+        return budget["queued"]
+
+    async def fill_channel_gaps(self, channel_id, budget, semaphore):
+        """1チャンネルのギャップを古い順にページ単位で取得（FloodWaitが起きたら今回は打ち切る）"""
+        channel = self.dialog_snapshot.channels.get(str(channel_id))
+        if channel is None or self.channel_filter.channel_name(channel_id) is None:
+            # 退出した・対象外になったチャンネルのギャップは残しておく
+            return
+        async with semaphore:
+            while budget["remaining"] > 0:
+                gap = self.gap_queue.first(channel_id)
+                if gap is None:
+                    break
+                page_size = min(self.gap_queue.page_size_for(channel_id), budget["remaining"])
+                budget["remaining"] -= page_size
+                fetched = 0
+                next_low = gap["low"]
+                try:
+                    async for message in self.telegram_client.iter_messages(
+                        self.dialog_snapshot.input_peer(channel),
+                        min_id=gap["low"] - 1,
+                        max_id=gap["high"] + 1,
+                        reverse=True,
+                        limit=page_size
+                    ):
+                        fetched += 1
+                        next_low = message.id + 1
+                        if self.channel_filter.admit(message) is not None:
+                            await self.pipeline.put(message)
+                except errors.FloodWaitError as e:
+                    self.gap_queue.on_flood_wait(channel_id)
+                    print(f"レート制限: {channel['name']} のギャップの取得を中断します（{e.seconds}秒）", file=sys.stderr)
+                    break
+                except Exception as e:
+                    print(f"エラー: {channel['name']} のギャップの取得中にエラーが発生しました: {e}", file=sys.stderr)
+                    traceback.print_exc()
+                    break
+                finally:
+                    budget["remaining"] += page_size - fetched
+                    budget["queued"] += fetched
+                    self.gap_queue.advance(channel_id, gap, next_low)
+                if fetched < page_size:
+                    # ページが埋まらなければギャップの残りにメッセージはない
+                    self.gap_queue.remove(channel_id, gap)
+                self.gap_queue.on_success(channel_id)
+
+    def start_catch_up(self, refresh=True):
+        """切断中のメッセージの取得をバックグラウンドで開始（実行中なら終わった後にもう一度行う）"""
+        if self.catchup_task is not None and not self.catchup_task.done():
+            self.catchup_requested = True
+            return
+        self.catchup_task = asyncio.create_task(self._catch_up_safely(refresh))
+
+    async def _catch_up_safely(self, refresh):
+        while True:
+            self.catchup_requested = False
+            try:
+                await self.catch_up(refresh)
+            except Exception as e:
+                print(f"エラー: 切断中のメッセージの取得中にエラーが発生しました: {e}", file=sys.stderr)
+                traceback.print_exc()
+            if not self.catchup_requested:
+                return
+            refresh = True
+
+    def on_reconnect(self):
+        """Telethonが自動で再接続したときに呼ばれる"""
+        print("再接続しました。切断中のメッセージを取得します", file=sys.stderr)
+        self.start_catch_up()
+
+    async def watch_connection(self):
+        """再接続の通知が得られなかった場合に備え、接続状態の変化からも再接続を検知する"""
+        connected = True
+        while True:
+            await asyncio.sleep(self.connection_check_interval)
+            now_connected = self.telegram_client.is_connected()
+            if now_connected and not connected:
+                self.on_reconnect()
+            connected = now_connected
+
+    async def run(self):
+        """更新を受信し続ける。接続が切れたら再接続し、切断中のメッセージを取得する"""
+        while True:
+            await self.telegram_client.run_until_disconnected()
+            print(f"接続が切れました。{self.reconnect_delay}秒後に再接続します", file=sys.stderr)
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.telegram_client.connect()
+            except Exception as e:
+                print(f"エラー: 再接続に失敗しました: {e}", file=sys.stderr)
+                continue
+            self.start_catch_up()
+
     async def initialize(self):
         """非同期初期化メソッド"""
         await self.telegram_client.start()
         await self.set_own_channel_list()
+        self.writer_task = asyncio.create_task(self.writer.run())
+        self.state_task = asyncio.create_task(self.save_state_periodically())
+        self.pipeline.start()
+        # 前回の終了（または異常終了）から起動までの分を取得。受信はその間も並行して行う
+        self.start_catch_up(refresh=False)
+        self.connection_task = asyncio.create_task(self.watch_connection())
+
+    def save_state(self):
+        """最終出力メッセージID・ギャップ・送信者キャッシュ・アルバムの索引・重複排除の索引・検索用の索引を保存"""
+        self.cursor_store.save()
+        self.gap_queue.save()
+        self.sender_cache.save()
+        self.album_index.save()
+        self.dedup_index.flush()
+        for index in self.record_indexes:
+            index.flush()
+
+    async def save_state_periodically(self):
+        while True:
+            await asyncio.sleep(self.state_save_interval)
+            self.save_state()
+
+    async def close(self):
+        """キューに残ったメッセージを処理し、出力を書き出して終了"""
+        self.connection_task.cancel()
+        if self.catchup_task is not None:
+            self.catchup_task.cancel()
+            await asyncio.gather(self.catchup_task, return_exceptions=True)
+        await self.pipeline.stop()
+        self.writer_task.cancel()
+        self.state_task.cancel()
+        await self.writer.close()
+        # 次回起動時のために送信者キャッシュとアルバムの索引を保存
+        self.save_state()
+        self.dedup_index.close()
+        for index in self.record_indexes:
+            index.close()
 
 if __name__ == "__main__":
     async def main():
         abc = TelegramCrawler()
         await abc.initialize()
-        await abc.telegram_client.run_until_disconnected()
+        try:
+            await abc.run()
+        finally:
+            await abc.close()
     
     asyncio.run(main())
@@ -0,0 +1,190 @@
+"""
+過去のメッセージの一括取得（バックフィル）
+
+指定したチャンネルのメッセージIDの範囲（1 ～ 最新メッセージID）をrange_size件ずつの区間に分け、
+複数のワーカーが区間ごとにiter_messages(min_id, max_id)で並行して取得します。
+出力・重複排除・索引は都度実行版と共通で、区間が終わるたびにチェックポイントへ記録するため、
+中断した場合も次回は終わっていない区間から再開します。
+
+    python telegram_crawler_backfill.py チャンネル [チャンネル ...] [--range-size 5000] [--workers 4] [--min-id 1] [--restart]
+    （チャンネルはチャンネルID・-100付きのID・ユーザー名、またはall）
+"""
+
+from telethon import errors
+import argparse
+import asyncio
+import time
+import traceback
+
+from state_store import load_json_state, save_json_state
+from telegram_crawler_cron import TelegramCrawlerCron
+
+
+class TelegramCrawlerBackfill(TelegramCrawlerCron):
+    def __init__(self, range_size=None, workers=None):
+        super().__init__()
+        config = self.config
+        self.range_size = range_size or config.getint('BACKFILL', 'range_size', fallback=5000)
+        self.workers = max(1, workers or config.getint('BACKFILL', 'workers', fallback=self.concurrency))
+        self.checkpoint_file = config.get('BACKFILL', 'checkpoint_file', fallback='.backfill_checkpoint.json')
+        # str(channel_id) -> {"top_message", "range_size", "pending": [[最小ID, 最大ID], ...]}
+        self.checkpoint = load_json_state(self.checkpoint_file, {})
+
+    def select_channels(self, names):
+        """チャンネルID・-100付きのID・ユーザー名（allで全チャンネル）からスナップショットのエントリを選ぶ"""
+        channels = list(self.dialog_snapshot.channels.values())
+        if "all" in names:
+            return [channel for channel in channels if self.channel_filter.channel_name(channel["channel_id"]) is not None]
+        selected = []
+        for name in names:
+            key = name.lstrip("@").lower()
+            matches = [
+                channel for channel in channels
+                if key in (str(channel["channel_id"]), channel["dialog_id"], (channel["username"] or "").lower())
+            ]
+            if not matches:
+                print(f"警告: チャンネル {name} が見つかりません（参加しているチャンネルのみ指定できます）")
+            elif self.channel_filter.channel_name(matches[0]["channel_id"]) is None:
+                print(f"警告: チャンネル {name} は取り込み対象外の設定のためスキップします")
+            else:
+                selected.append(matches[0])
+        return selected
+
+    def plan(self, channel, min_id=1, restart=False):
+        """チャンネルの未取得の区間（新しい順）。チェックポイントがあればその続きから"""
+        key = str(channel["channel_id"])
+        state = self.checkpoint.get(key)
+        if state is not None and not restart:
+            return state["pending"]
+        top = channel["top_message"]
+        pending = []
+        high = top
+        while high >= min_id:
+            low = max(min_id, high - self.range_size + 1)
+            pending.append([low, high])
+            high = low - 1
+        self.checkpoint[key] = {"top_message": top, "range_size": self.range_size, "pending": pending}
+        save_json_state(self.checkpoint_file, self.checkpoint)
+        return pending
+
+    async def fetch_range(self, channel, task):
+        """区間内のメッセージを新しい順に取得（task["next_max"]より前から。再試行時は処理済みの続きから）"""
+        async for message in self.telegram_client.iter_messages(
+            self.dialog_snapshot.input_peer(channel),
+            min_id=task["low"] - 1,  # min_id・max_idは範囲に含まれない
+            max_id=task["next_max"]
+        ):
+            await self.process_message(message, channel["channel_id"])
+            task["next_max"] = message.id
+            task["processed"] += 1
+
+    async def complete_range(self, channel, task):
+        """区間の出力が書き込まれる（SQLiteではコミットされる）のを待ってからチェックポイントに記録"""
+        await self.sink.sync()
+        self.dedup_index.flush()
+        state = self.checkpoint[str(channel["channel_id"])]
+        state["pending"] = [bounds for bounds in state["pending"] if bounds != [task["low"], task["high"]]]
+        save_json_state(self.checkpoint_file, self.checkpoint)
+        return len(state["pending"])
+
+    async def backfill_range(self, channel, task):
+        """1区間を取得。FloodWaitは待機して続きから再試行し、それ以外の失敗は区間を未完了のまま残す"""
+        for attempt in range(1, self.flood_wait_retries + 2):
+            try:
+                await self.fetch_range(channel, task)
+            except errors.FloodWaitError as e:
+                if attempt > self.flood_wait_retries or e.seconds > self.max_flood_wait:
+                    print(f"エラー: {channel['name']} の区間 {task['low']}-{task['high']} はレート制限（{e.seconds}秒）のため次回に回します")
+                    return False
+                print(f"レート制限: {channel['name']} の区間 {task['low']}-{task['high']} で{e.seconds}秒待機します"
+                      f"（{attempt}/{self.flood_wait_retries}回目）")
+                await asyncio.sleep(e.seconds)
+                continue
+            except Exception as e:
+                print(f"エラー: {channel['name']} の区間 {task['low']}-{task['high']} の取得中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                return False
+            remaining = await self.complete_range(channel, task)
+            print(f"  → {channel['name']}: 区間 {task['low']}-{task['high']} 完了（{task['processed']}件, 残り{remaining}区間）")
+            return True
+        return False
+
+    def save_results(self):
+        """出力を閉じてから、バックフィルで更新したものだけを保存
+
+        都度実行版のカーソル・ギャップ・取得間隔の状態は変更しないため保存しません
+        （起動時に読み込んだ内容で、並行して動いた都度実行版の保存内容を上書きしないため）。
+        """
+        self.close_output()
+        self.sender_cache.save()
+        self.album_index.save()
+        self.dedup_index.flush()
+        for index in self.record_indexes:
+            index.flush()
+
+    async def worker(self, queue, results):
+        while True:
+            channel, task = await queue.get()
+            try:
+                if await self.backfill_range(channel, task):
+                    results["completed"] += 1
+                else:
+                    results["failed"] += 1
+                results["processed"] += task["processed"]
+            finally:
+                queue.task_done()
+
+    async def backfill(self, names, min_id=1, restart=False):
+        """指定したチャンネルの過去のメッセージを取得"""
+        started_at = time.monotonic()
+        try:
+            await self.run_backfill(names, min_id, restart, started_at)
+        finally:
+            # 失敗した場合も出力済みの分と重複排除の索引を保存する
+            self.save_results()
+            await self.close()
+
+    async def run_backfill(self, names, min_id, restart, started_at):
+        await self.telegram_client.start()
+        print("チャンネルリストを取得中...")
+        await self.set_own_channel_list()
+        channels = self.select_channels(names)
+
+        # チャンネルごとの区間を交互に並べ、複数のチャンネルが並行して進むようにする
+        plans = [(channel, list(self.plan(channel, min_id, restart))) for channel in channels]
+        queue = asyncio.Queue()
+        while any(pending for _, pending in plans):
+            for channel, pending in plans:
+                if pending:
+                    low, high = pending.pop(0)
+                    queue.put_nowait((channel, {"low": low, "high": high, "next_max": high + 1, "processed": 0}))
+        print(f"{len(channels)}件のチャンネルの{queue.qsize()}区間をワーカー{self.workers}個で取得します（区間の大きさ: {self.range_size}）")
+
+        results = {"completed": 0, "failed": 0, "processed": 0}
+        autoflush_task = asyncio.create_task(self.sink.autoflush())
+        workers = [asyncio.create_task(self.worker(queue, results)) for _ in range(self.workers)]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            autoflush_task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        print(f"\nバックフィル完了: {results['processed']}件のメッセージを処理しました")
+        print(f"  完了した区間: {results['completed']}件, 次回に回した区間: {results['failed']}件")
+        print(f"  所要時間: {time.monotonic() - started_at:.1f}秒（ワーカー数: {self.workers}）")
+        print(f"  出力済みのためスキップ: {self.dedup_index.stats()['duplicates']}件")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="指定したチャンネルの過去のメッセージを一括取得")
+    parser.add_argument("channels", nargs="+", help="チャンネルID・-100付きのID・ユーザー名、またはall")
+    parser.add_argument("--range-size", type=int, help="1区間のメッセージIDの数（[BACKFILL] range_sizeより優先）")
+    parser.add_argument("--workers", type=int, help="並行して取得する区間の数（[BACKFILL] workersより優先）")
+    parser.add_argument("--min-id", type=int, default=1, help="このメッセージID以降だけを取得（デフォルト: 1）")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から取得")
+    args = parser.parse_args()
+
+    crawler = TelegramCrawlerBackfill(range_size=args.range_size, workers=args.workers)
+    asyncio.run(crawler.backfill(args.channels, min_id=args.min_id, restart=args.restart))
@@ -1,15 +1,27 @@
-from telethon import TelegramClient
-from telethon.tl import types
+from telethon import TelegramClient, errors
 from telethon.tl.custom import Message
 import configparser
 import datetime
 import socks
-import json
-import pprint
 import traceback
 import os
+import time
 import asyncio
 
+from album_index import AlbumIndex
+from channel_filter import ChannelFilter
+from dedup_index import DedupIndex
+from dialog_snapshot import DialogSnapshot
+from gap_queue import GapQueue
+from indicator_index import IndicatorIndex
+from message_extractor import extract_message, utc_to_jst
+from sender_cache import SenderCache
+from text_index import TextIndex
+from output_sink import create_sink
+from peer_cache import PeerCache
+from polling_scheduler import PollingScheduler
+from state_store import ChannelCursorStore
+
 class TelegramCrawlerCron:
     def __init__(self):
         try:
@@ -19,8 +31,7 @@ class TelegramCrawlerCron:
             api_id      = config.get('TELEGRAM', 'api_id')
             api_hash    = config.get('TELEGRAM', 'api_hash')
             proxy       = self.set_proxy(config)
-            self.exception_list = config.get('EXCEPT CHANNEL', 'channel')
-            self.exception_list = self.exception_list.replace(" ","").split(',')
+            self.apply_settings(config)
         except (configparser.NoSectionError, configparser.NoOptionError) as e:
             print(f"エラー: config.iniの設定が不正です: {e}")
             raise
@@ -30,8 +41,67 @@ class TelegramCrawlerCron:
 
         # start telegram client
         self.telegram_client = TelegramClient('CAnonBot', api_id, api_hash, proxy=proxy)
-        self.last_run_file = '.last_run'
+        self.last_run_file = '.last_run'  # 旧形式（カーソル導入前）の前回実行時刻
         self.channel_list = {}
+        self.config = config
+        self.open_sink(config)
+
+        # チャンネルごとのカーソル（最終取得メッセージID）
+        self.cursor_store = ChannelCursorStore(config.get('CRON', 'cursor_file', fallback='.channel_cursors.json'))
+        # 投稿頻度に応じてチャンネルごとの取得間隔を調整する（[SCHEDULER] enabled=trueの場合のみ）
+        self.scheduler = PollingScheduler.from_config(config)
+        self.gap_queue = GapQueue(
+            config.get('CRON', 'gap_file', fallback='.gap_queue.json'),
+            page_size=config.getint('CRON', 'gap_page_size', fallback=100),
+            min_page_size=config.getint('CRON', 'gap_min_page_size', fallback=20),
+            max_page_size=config.getint('CRON', 'gap_max_page_size', fallback=1000)
+        )
+
+        # ダイアログ一覧のスナップショット（実行間でキャッシュ）
+        self.dialog_snapshot = DialogSnapshot(
+            config.get('DIALOG', 'snapshot_file', fallback='.dialog_snapshot.json'),
+            config.getint('DIALOG', 'snapshot_ttl', fallback=86400)
+        )
+
+        # 送信者情報のキャッシュ（実行間で保持し、常時実行版と共有）
+        self.sender_cache = SenderCache(
+            max_size=config.getint('CACHE', 'sender_cache_size', fallback=10000),
+            ttl_seconds=config.getint('CACHE', 'sender_cache_ttl', fallback=86400),
+            path=config.get('CACHE', 'sender_cache_file', fallback='.sender_cache.json')
+        )
+        # アルバム（grouped_id）ごとのメッセージIDの索引（ダウンロード時に使用）
+        self.album_index = AlbumIndex(config.get('CACHE', 'album_index_file', fallback='.album_index.json'))
+        # チャンネルのアクセスハッシュ（ダウンロード時にget_entityを呼ばずに済むよう記録）
+        self.peer_cache = PeerCache(config.get('CACHE', 'peer_cache_file', fallback='.peer_cache.json'))
+        # 出力済みの(チャンネルID, メッセージID)の索引（実行をまたいで同じメッセージを出力しない）
+        self.dedup_index = DedupIndex(
+            config.get('CACHE', 'dedup_index_file', fallback='.dedup_index'),
+            expected_items=config.getint('CACHE', 'dedup_expected_items', fallback=1000000),
+            compact_threshold=config.getint('CACHE', 'dedup_compact_threshold', fallback=100000)
+        )
+        # 出力したレコードを追加する索引（全文検索・URL/ドメイン/ユーザーID。[INDEX]でファイルが空欄のものは作成しない）
+        self.record_indexes = [
+            index for index in (TextIndex.from_config(config), IndicatorIndex.from_config(config)) if index is not None
+        ]
+
+    def apply_settings(self, config):
+        """取り込み対象の判定と取得の設定を読み込む（常駐版では設定の再読み込み時にも呼ばれる）"""
+        self.exception_list = config.get('EXCEPT CHANNEL', 'channel')
+        self.exception_list = self.exception_list.replace(" ","").split(',')
+        # 取り込み対象の判定（ダイアログ読み込み時にチャンネルごとの判定表を作成）
+        self.channel_filter = ChannelFilter.from_config(config, self.exception_list)
+
+        # 並行取得の設定（同時に処理するチャンネル数とFloodWait時の待機上限）
+        self.concurrency = max(1, config.getint('CRON', 'concurrency', fallback=5))
+        self.max_flood_wait = config.getint('CRON', 'max_flood_wait', fallback=300)
+        self.flood_wait_retries = config.getint('CRON', 'flood_wait_retries', fallback=3)
+        self.initial_lookback_hours = config.getint('CRON', 'initial_lookback_hours', fallback=24)
+        # 1回の実行でチャンネルごとに取得する上限。超えた分はギャップとして記録し、以降の実行でgap_budget件ずつ取得する
+        self.max_messages_per_channel = max(1, config.getint('CRON', 'max_messages_per_channel', fallback=100))
+        self.gap_budget = config.getint('CRON', 'gap_budget', fallback=1000)
+
+    def open_sink(self, config):
+        """実行（常駐版ではサイクル）ごとの出力先を作成"""
         # JSON出力ファイルの設定（config.iniから読み込み、なければデフォルト値）
         try:
             base_output_file = config.get('OUTPUT', 'output_file')
@@ -40,7 +110,9 @@ class TelegramCrawlerCron:
         
         # ファイル名に日時を追加
         self.output_file = self._add_timestamp_to_filename(base_output_file)
-        self.all_messages = []  # すべてのメッセージを保存するリスト
+        # メッセージは生成されたそばからJSONLファイル（またはSQLite）へ書き出す（メモリに溜め込まない）
+        self.sink = create_sink(config, self.output_file)
+        self.output_file = self.sink.path
 
     def set_proxy(self, config):
         proxy_type  = config.get('PROXY', 'type')
@@ -68,25 +140,29 @@ class TelegramCrawlerCron:
         return proxy
 
     async def set_own_channel_list(self):
-        self.channel_list = {}
-        async for dialog in self.telegram_client.iter_dialogs(ignore_pinned=True):
-            self.channel_list[str(dialog.id)] = {"channel_name": dialog.name}
-            if dialog.entity.username != None: 
-                self.channel_list[str(dialog.id)].update({"channel_url": "t.me/" + dialog.entity.username})
-
-    def get_last_run_time(self):
-        """前回実行時刻を取得。ファイルが存在しない場合は24時間前を返す"""
-        if os.path.exists(self.last_run_file):
+        """ダイアログのスナップショットを更新してチャンネルリストを作成（ダイアログの走査は1回だけ）"""
+        await self.dialog_snapshot.refresh(self.telegram_client)
+        self.peer_cache.update_from_snapshot(self.dialog_snapshot.channels)
+        self.peer_cache.save()
+        self.channel_list = self.dialog_snapshot.channel_list()
+        self.channel_filter.compile(self.dialog_snapshot.channels)
+
+    def get_initial_fetch_time(self):
+        """カーソルのないチャンネルの取得開始時刻を返す
+
+        旧形式の.last_runしかない場合（カーソル導入前からの移行時）はその時刻、
+        それ以外は初回取得の遡り時間（デフォルト24時間）前を返す
+        """
+        lookback = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=self.initial_lookback_hours)
+        if not self.cursor_store.exists and os.path.exists(self.last_run_file):
             try:
                 with open(self.last_run_file, 'r') as f:
                     timestamp_str = f.read().strip()
                     return datetime.datetime.fromisoformat(timestamp_str)
             except:
-                # ファイルが壊れている場合は24時間前を返す
-                return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=24)
-        else:
-            # 初回実行時は24時間前を返す
-            return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=24)
+                # ファイルが壊れている場合は通常の遡り時間を使う
+                return lookback
+        return lookback
 
     def _add_timestamp_to_filename(self, filepath):
         """ファイル名の先頭に日時を追加（JSONL形式に変換）"""
@@ -114,233 +190,43 @@ class TelegramCrawlerCron:
         else:
             return new_filename
     
-    def save_last_run_time(self):
-        """現在時刻を前回実行時刻として保存"""
-        current_time = datetime.datetime.now(datetime.timezone.utc)
-        with open(self.last_run_file, 'w') as f:
-            f.write(current_time.isoformat())
-    
     def save_messages_to_file(self):
-        """すべてのメッセージをJSONLファイルに保存（各行が1つのJSONオブジェクト）"""
+        """バッファに残っているメッセージを書き出して出力先を閉じる"""
         try:
-            # ディレクトリが存在しない場合は作成
-            output_dir = os.path.dirname(self.output_file)
-            if output_dir and not os.path.exists(output_dir):
-                os.makedirs(output_dir, exist_ok=True)
-                print(f"ディレクトリを作成しました: {output_dir}")
-            
-            # 既存のファイルがある場合は読み込む（JSONL形式）
-            existing_count = 0
-            if os.path.exists(self.output_file):
-                try:
-                    with open(self.output_file, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            line = line.strip()
-                            if line:  # 空行をスキップ
-                                existing_count += 1
-                    print(f"既存のファイルを読み込みました: {existing_count}件のメッセージ")
-                except Exception as e:
-                    # ファイルが壊れている場合は新規作成
-                    print(f"警告: 既存ファイルの読み込みに失敗しました（新規作成します）: {e}")
-                    existing_count = 0
-            
-            # JSONL形式で保存（追記モード）
-            with open(self.output_file, 'a', encoding='utf-8') as f:
-                for message_log in self.all_messages:
-                    # 各メッセージを1行のJSONとして書き込み
-                    json_line = json.dumps(message_log, ensure_ascii=False)
-                    f.write(json_line + '\n')
-            
-            total_count = existing_count + len(self.all_messages)
-            print(f"JSONLファイルに保存しました: {self.output_file} ({len(self.all_messages)}件のメッセージを追加、合計: {total_count}件)")
+            self.sink.close()
+            print(f"保存しました: {self.output_file} ({self.sink.records_written}件のメッセージを追加)")
         except Exception as e:
-            print(f"エラー: JSONLファイルの保存に失敗しました: {e}")
+            print(f"エラー: 出力先への保存に失敗しました: {e}")
             traceback.print_exc()
 
     async def process_message(self, message: Message, channel_id: int):
         """メッセージを処理してJSON形式で出力"""
         try:
-            message_logs = {}
-            sender = await message.get_sender()
-            
-            message_logs[channel_id] = {}
-            # チャンネルIDのキー形式を元のコードに合わせる（-100プレフィックス）
-            channel_key = '-100' + str(channel_id) if channel_id > 0 else str(channel_id)
-            if channel_key not in self.channel_list:
-                # チャンネルリストにない場合はスキップ
+            # 取り込み対象のチャンネル・メディアの種類かを判定
+            channel_name = self.channel_filter.channel_name(channel_id)
+            if channel_name is None or not self.channel_filter.admit_media(message):
                 return
-            
-            channel_name = self.channel_list[channel_key]["channel_name"]
-            
-            # except channel
-            for except_list in self.exception_list:
-                if except_list in channel_name.replace(" ",""): 
-                    return
-
-            # message from user
-            message_logs[channel_id]["channel_name"]       = channel_name
-            message_logs[channel_id]["message_id"]         = message.id
-            message_logs[channel_id]["message"]            = message.raw_text
-            message_logs[channel_id]["message_from_geo"]   = message.geo
-            message_logs[channel_id]["JST_send_time"]      = self.utc_to_jts(message.date)
-            message_logs[channel_id]["display_of_post_author"] = message.post_author
-            
-            # Media information (画像、動画、ファイルなど)
-            media_info = {}
-            # 複数メディア（写真アルバムなど）のチェック
-            grouped_id = getattr(message, 'grouped_id', None)
-            if grouped_id:
-                media_info["grouped_id"] = grouped_id
-                media_info["is_grouped"] = True
-            
-            if message.photo:
-                media_info["type"] = "photo"
-                media_info["photo_id"] = message.photo.id if hasattr(message.photo, 'id') else None
-                # 写真をダウンロードするための情報
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = channel_id
-                    media_info["download_info"] = {
-                        "channel_id": channel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            elif message.video:
-                media_info["type"] = "video"
-                media_info["video_id"] = message.video.id if hasattr(message.video, 'id') else None
-                media_info["duration"] = getattr(message.video, 'duration', None)
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = channel_id
-                    media_info["download_info"] = {
-                        "channel_id": channel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            elif message.document:
-                media_info["type"] = "document"
-                media_info["document_id"] = message.document.id if hasattr(message.document, 'id') else None
-                media_info["mime_type"] = getattr(message.document, 'mime_type', None)
-                media_info["file_name"] = getattr(message.document, 'file_name', None)
-                media_info["file_size"] = getattr(message.document, 'size', None)
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = channel_id
-                    media_info["download_info"] = {
-                        "channel_id": channel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            elif message.media:
-                media_info["type"] = str(type(message.media).__name__)
-                try:
-                    media_info["message_id"] = message.id
-                    media_info["channel_id"] = channel_id
-                    media_info["download_info"] = {
-                        "channel_id": channel_id,
-                        "message_id": message.id,
-                        "grouped_id": grouped_id
-                    }
-                except Exception as e:
-                    media_info["download_error"] = str(e)
-                    traceback.print_exc()
-            if media_info:
-                message_logs[channel_id]["media"] = media_info
-            
-            # Links and entities (リンク、メンションなど)
-            if message.entities:
-                entities_info = []
-                for entity in message.entities:
-                    entity_type = type(entity).__name__
-                    # 装飾情報（Bold、Emoji）は除外
-                    if entity_type in ["MessageEntityBold", "MessageEntityCustomEmoji"]:
-                        continue
-                    entity_data = {
-                        "type": entity_type
-                    }
-                    # URL情報の取得
-                    if hasattr(entity, 'url'):
-                        entity_data["url"] = entity.url
-                    # テキスト内の位置情報
-                    if hasattr(entity, 'offset') and hasattr(entity, 'length'):
-                        entity_data["offset"] = entity.offset
-                        entity_data["length"] = entity.length
-                        # テキストからURLを抽出（MessageEntityUrlの場合）
-                        if entity_data["type"] == "MessageEntityUrl":
-                            try:
-                                url_text = message.raw_text[entity.offset:entity.offset + entity.length]
-                                entity_data["url"] = url_text
-                            except:
-                                pass
-                    # ユーザーID（メンションの場合）
-                    if hasattr(entity, 'user_id'):
-                        entity_data["user_id"] = entity.user_id
-                    entities_info.append(entity_data)
-                if entities_info:
-                    message_logs[channel_id]["entities"] = entities_info
-
-            # four type of message
-            if hasattr(message.from_id, "user_id") == True: 
-                message_logs[channel_id]["from_id"] = {"peerUser": message.from_id.user_id}
-
-            elif hasattr(message.from_id, "chat_id") == True:
-                message_logs[channel_id]["from_id"] = {"peerChat": message.from_id.chat_id}
-
-            elif hasattr(message.from_id, "channel_id") == True:
-                message_logs[channel_id]["from_id"] = {"peerChannel": message.from_id.channel_id}
-
-            else: 
-                message_logs[channel_id]["from_id"] = {"anonymous": None}
-
-            # if it wasn't a bot, get user data
-            if sender is None:
-                # senderがNoneの場合、メッセージ情報から判断
-                if hasattr(message, 'via_bot_id') and message.via_bot_id is not None:
-                    sender_is_bot = True  # ボット経由のメッセージ
-                elif hasattr(message, 'post') and message.post:
-                    sender_is_bot = False  # チャンネル投稿（通常はボットではない）
-                elif hasattr(message.from_id, "user_id"):
-                    # from_idにuser_idがある場合は、そのユーザー情報を取得して確認
-                    try:
-                        # ユーザーIDからユーザーエンティティ（ユーザー情報）を取得
-                        user_entity = await self.telegram_client.get_entity(message.from_id.user_id)
-                        sender_is_bot = getattr(user_entity, "bot", False)
-                        # ユーザーエンティティが存在する場合は、ユーザー情報を取得
-                        if not sender_is_bot and isinstance(user_entity, types.User):
-                            message_logs[channel_id]["sender_user"] = {
-                                "user_id": user_entity.id,
-                                "username": user_entity.username,
-                                "phone": getattr(user_entity, "phone", None),
-                                "Firstname": user_entity.first_name,
-                                "Lastname": user_entity.last_name,
-                            }
-                    except:
-                        sender_is_bot = False  # 取得できない場合はFalseとする
-                else:
-                    sender_is_bot = False  # 判断できない場合はFalseとする
-            else:
-                sender_is_bot = getattr(sender, "bot", False)
-                if not sender_is_bot and isinstance(sender, types.User):
-                    message_logs[channel_id]["sender_user"] = {
-                        "user_id": sender.id, 
-                        "username": sender.username,  
-                        "phone": getattr(sender, "phone", None), 
-                        "Firstname": sender.first_name, 
-                        "Lastname": sender.last_name
-                    }
-            message_logs[channel_id]["bot"] = sender_is_bot  # True if sender is bot
-
-            # メッセージをリストに追加（後でファイルに保存）
-            self.all_messages.append(message_logs)
+            # 以前の実行で出力済みのメッセージは整形しない
+            if self.dedup_index.contains(channel_id, message.id):
+                return
+
+            # メッセージ本文・メディア・エンティティを抽出（常時実行版と共通）
+            record = extract_message(message, channel_id, channel_name)
+            if message.grouped_id:
+                self.album_index.add(channel_id, message.grouped_id, message.id)
+
+            # if it wasn't a bot, get user data（送信者情報はキャッシュから取得）
+            record.set_sender(await self.sender_cache.resolve(self.telegram_client, message))
+
+            # メッセージを出力先に渡す（バッファが溜まったら逐次ファイルに書き出す）
+            output = record.to_dict()
+            self.sink.write(output)
+            self.dedup_index.add(channel_id, message.id)
+            for index in self.record_indexes:
+                index.add_record(output)
+            if not self.sink.records_pending:
+                # ファイルに書き出した分は索引のログにも反映（異常終了後の再実行で重複させない）
+                self.dedup_index.flush()
         except Exception as e:
             print(f"エラー: メッセージ処理中にエラーが発生しました (message_id: {message.id if hasattr(message, 'id') else 'unknown'}): {e}")
             traceback.print_exc()
@@ -348,117 +234,256 @@ class TelegramCrawlerCron:
     
     def utc_to_jts(self, date_time):
         try:
-            date_time = date_time.astimezone(datetime.timezone(datetime.timedelta(hours=9)))
-            date_time = date_time.strftime("%Y/%m/%d %H:%M:%S")
-            return date_time
+            return utc_to_jst(date_time)
         except:
             traceback.print_exc()
             return None
 
+    async def fetch_channel_messages(self, channel, progress):
+        """1チャンネル分の新着メッセージを取得して処理（progressに進捗を記録）"""
+        # カーソル（last_message_id）より後のメッセージを古い順に取得する
+        # FloodWait後の再試行でも処理済みのメッセージIDより後から再開できる
+        since = progress["since"]
+        kwargs = {}
+        if since is not None:
+            # カーソルがないチャンネルは日時で取得範囲を決める
+            kwargs["offset_date"] = since
+        channel_id = channel["channel_id"]
+        async for message in self.telegram_client.iter_messages(
+            self.dialog_snapshot.input_peer(channel),
+            min_id=progress["last_message_id"],
+            reverse=True,  # 古い順に取得（カーソルの直後から）
+            limit=self.max_messages_per_channel - progress["checked"],  # 1チャンネルあたりの上限（デフォルト100件）
+            **kwargs
+        ):
+            progress["checked"] += 1
+            if since is not None:
+                # タイムゾーンを統一して比較
+                message_date_utc = message.date
+                if message_date_utc.tzinfo is None:
+                    message_date_utc = message_date_utc.replace(tzinfo=datetime.timezone.utc)
+                if message_date_utc <= since:
+                    continue
+            await self.process_message(message, channel_id)
+            progress["processed"] += 1
+            progress["last_message_id"] = message.id
+
+    async def crawl_channel(self, channel, cursor, initial_fetch_time):
+        """同時実行数の上限内で1チャンネルを処理。FloodWaitはこのチャンネルだけが待機する"""
+        channel_id = channel["channel_id"]
+        progress = {
+            "checked": 0,
+            "processed": 0,
+            "last_message_id": cursor or 0,
+            "since": initial_fetch_time if cursor is None else None,
+        }
+        backlog = channel["top_message"] - (cursor or 0)
+        if cursor is not None and backlog > self.max_messages_per_channel:
+            # 上限を超える新着は最新の分だけを取得し、それより前はギャップとして後の実行で取得する
+            start = channel["top_message"] - self.max_messages_per_channel
+            self.gap_queue.add(channel_id, cursor + 1, start)
+            progress["last_message_id"] = start
+            print(f"  {channel['name']}: 新着が上限（{self.max_messages_per_channel}件）を超えたため、"
+                  f"メッセージID {cursor + 1}-{start} をギャップとして記録しました")
+        for attempt in range(1, self.flood_wait_retries + 2):
+            try:
+                # 待機中は枠を解放するため、セマフォは取得処理の間だけ保持する
+                async with self.channel_semaphore:
+                    print(f"チャンネル処理中: {channel['name']}")
+                    await self.fetch_channel_messages(channel, progress)
+                break
+            except errors.FloodWaitError as e:
+                if attempt > self.flood_wait_retries or e.seconds > self.max_flood_wait:
+                    print(f"エラー: チャンネル {channel['name']} はレート制限（{e.seconds}秒）のため今回はスキップします")
+                    break
+                print(f"レート制限: チャンネル {channel['name']} のみ{e.seconds}秒待機します（{attempt}/{self.flood_wait_retries}回目）")
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                print(f"エラー: チャンネル {channel['name']} の処理中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                break
+        
+        # 処理できたところまでカーソルを進める
+        self.cursor_store.advance(channel_id, progress["last_message_id"])
+        if cursor is None and progress["processed"] == 0 and progress["checked"] < self.max_messages_per_channel:
+            # 初回で新着がなかったチャンネルは最新メッセージの位置から次回を始める
+            self.cursor_store.advance(channel_id, channel["top_message"])
+        if progress["processed"] > 0:
+            print(f"  → {channel['name']}: {progress['processed']}件のメッセージを処理しました")
+        return progress["processed"]
+
+    async def fill_gaps(self):
+        """ギャップを検出の古いチャンネルから順に、合計gap_budget件まで取得して処理した件数を返す"""
+        budget = {"remaining": self.gap_budget, "processed": 0}
+        await asyncio.gather(*[
+            self.fill_channel_gaps(channel_id, budget) for channel_id in self.gap_queue.channels()
+        ])
+        return budget["processed"]
+
+    async def fill_channel_gaps(self, channel_id, budget):
+        """1チャンネルのギャップを古い順にページ単位で取得（FloodWaitが起きたら今回は打ち切る）"""
+        channel = self.dialog_snapshot.channels.get(str(channel_id))
+        if channel is None or self.channel_filter.channel_name(channel_id) is None:
+            # 退出した・対象外になったチャンネルのギャップは残しておく
+            return
+        processed = 0
+        async with self.channel_semaphore:
+            while budget["remaining"] > 0:
+                gap = self.gap_queue.first(channel_id)
+                if gap is None:
+                    break
+                page_size = min(self.gap_queue.page_size_for(channel_id), budget["remaining"])
+                budget["remaining"] -= page_size
+                fetched = 0
+                next_low = gap["low"]
+                try:
+                    async for message in self.telegram_client.iter_messages(
+                        self.dialog_snapshot.input_peer(channel),
+                        min_id=gap["low"] - 1,
+                        max_id=gap["high"] + 1,
+                        reverse=True,
+                        limit=page_size
+                    ):
+                        await self.process_message(message, channel_id)
+                        fetched += 1
+                        next_low = message.id + 1
+                except errors.FloodWaitError as e:
+                    self.gap_queue.on_flood_wait(channel_id)
+                    print(f"レート制限: チャンネル {channel['name']} のギャップの取得を中断します（{e.seconds}秒、"
+                          f"次回のページの大きさ: {self.gap_queue.page_size_for(channel_id)}件）")
+                    break
+                except Exception as e:
+                    print(f"エラー: チャンネル {channel['name']} のギャップの取得中にエラーが発生しました: {e}")
+                    traceback.print_exc()
+                    break
+                finally:
+                    budget["remaining"] += page_size - fetched
+                    budget["processed"] += fetched
+                    processed += fetched
+                    self.gap_queue.advance(channel_id, gap, next_low)
+                if fetched < page_size:
+                    # ページが埋まらなければギャップの残りにメッセージはない
+                    self.gap_queue.remove(channel_id, gap)
+                self.gap_queue.on_success(channel_id)
+        if processed:
+            print(f"  → {channel['name']}: ギャップから{processed}件のメッセージを処理しました（残り: {len(self.gap_queue.gaps.get(str(channel_id), []))}区間）")
+
+    def close_output(self):
+        """出力を書き出して閉じる"""
+        # JSONファイルに保存
+        if self.sink.records_written or self.sink.records_pending:
+            print(f"\nJSONファイルに保存中: {self.output_file}")
+            self.save_messages_to_file()
+        else:
+            self.sink.close()
+            print(f"\n保存するメッセージがありません（output_file: {self.output_file}）")
+
+    def save_results(self):
+        """出力を閉じてから、カーソル・送信者キャッシュ・アルバムの索引・重複排除の索引・検索用の索引を保存"""
+        self.close_output()
+        # メッセージの保存後に保存（出力されていないメッセージを出力済みとして記録しないため）
+        self.cursor_store.save()
+        self.gap_queue.save()
+        if self.scheduler is not None:
+            self.scheduler.save()
+        self.sender_cache.save()
+        self.album_index.save()
+        self.dedup_index.flush()
+        for index in self.record_indexes:
+            index.flush()
+
+    async def close(self):
+        """索引を閉じてクライアントを切断"""
+        self.dedup_index.close()
+        for index in self.record_indexes:
+            index.close()
+        await self.telegram_client.disconnect()
+
     async def run(self):
-        """都度実行：前回実行時刻以降のメッセージを取得して処理"""
+        """都度実行：チャンネルごとのカーソル以降のメッセージを取得して処理"""
         await self.telegram_client.start()
+        try:
+            await self.run_cycle()
+        finally:
+            await self.close()
+
+    async def run_cycle(self):
+        """1回分の取得。中断（キャンセル）された場合も、出力済みの分までは出力先と状態を保存する"""
+        try:
+            await self.crawl_once()
+        finally:
+            self.save_results()
+
+    async def crawl_once(self):
+        """チャンネルごとのカーソル以降のメッセージとギャップを取得して処理"""
+        started_at = time.monotonic()
         
         # チャンネルリストを取得
         print("チャンネルリストを取得中...")
         await self.set_own_channel_list()
         print(f"チャンネル数: {len(self.channel_list)}件")
         
-        last_run_time = self.get_last_run_time()
-        print(f"前回実行時刻: {last_run_time}")
+        initial_fetch_time = self.get_initial_fetch_time()
+        print(f"カーソルのないチャンネルの取得開始時刻: {initial_fetch_time}")
         
-        # 全ダイアログから新しいメッセージを取得
-        processed_count = 0
-        channel_count = 0
-        skipped_count = 0
-        dialog_count = 0
-        # 全ダイアログから新しいメッセージを取得
-        async for dialog in self.telegram_client.iter_dialogs(ignore_pinned=True):
-            dialog_count += 1
-            if dialog_count % 10 == 0:
-                print(f"処理中... ダイアログ {dialog_count}件目を確認中")
-            try:
-                # チャンネルIDを取得（元のコードの形式に合わせる）
-                # InputChannelを取得してchannel_idを抽出
-                try:
-                    input_chat = await self.telegram_client.get_input_entity(dialog.entity)
-                    if hasattr(input_chat, 'channel_id'):
-                        channel_id = input_chat.channel_id
-                    else:
-                        # チャンネルでない場合はスキップ
-                        continue
-                except:
-                    # チャンネルでない場合はスキップ
-                    continue
-                
-                channel_count += 1
-                print(f"チャンネル処理中: {dialog.name} ({channel_count}件目)")
-                message_count_in_channel = 0
-                checked_messages = 0
-                # 前回実行時刻以降のメッセージを取得
-                # offset_dateは「この日時以降」のメッセージを取得するが、reverse=Falseの場合は古い順
-                # そのため、最新のメッセージから取得するためにreverse=Trueを使用
-                async for message in self.telegram_client.iter_messages(
-                    dialog.entity, 
-                    offset_date=last_run_time,
-                    reverse=True,  # 新しい順に取得（最新のメッセージから）
-                    limit=100  # 1チャンネルあたり最大100件まで取得（パフォーマンス向上）
-                ):
-                    checked_messages += 1
-                    # メッセージが前回実行時刻より後であることを確認
-                    # タイムゾーンを統一して比較
-                    message_date_utc = message.date
-                    if message_date_utc.tzinfo is None:
-                        message_date_utc = message_date_utc.replace(tzinfo=datetime.timezone.utc)
-                    
-                    if message_date_utc > last_run_time:
-                        await self.process_message(message, channel_id)
-                        processed_count += 1
-                        message_count_in_channel += 1
-                    else:
-                        # 前回実行時刻以前のメッセージに到達したら終了（新しい順に取得しているので）
-                        break
-                
-                if checked_messages > 0 and message_count_in_channel == 0:
-                    # デバッグ情報を追加
-                    print(f"  → メッセージを{checked_messages}件確認しましたが、すべて前回実行時刻（{last_run_time}）以前でした")
-                    # 最新のメッセージの日時を表示（デバッグ用）
-                    try:
-                        latest_msg = await self.telegram_client.get_messages(dialog.entity, limit=1)
-                        if latest_msg and len(latest_msg) > 0:
-                            latest_date = latest_msg[0].date
-                            if latest_date.tzinfo is None:
-                                latest_date = latest_date.replace(tzinfo=datetime.timezone.utc)
-                            print(f"  → 最新メッセージの日時: {latest_date} (前回実行時刻: {last_run_time})")
-                    except:
-                        pass
-                
-                if message_count_in_channel == 0:
-                    skipped_count += 1
-                else:
-                    print(f"  → {message_count_in_channel}件のメッセージを処理しました")
-            except Exception as e:
-                print(f"エラー: チャンネル {dialog.name} の処理中にエラーが発生しました: {e}")
-                traceback.print_exc()
+        # スナップショットから処理対象のチャンネルを収集（チャンネルごとのエンティティ取得は不要）
+        channels = []
+        unchanged_count = 0
+        excluded_count = 0
+        for channel in self.dialog_snapshot.channels.values():
+            # 除外対象のチャンネルは履歴を取得しない
+            if self.channel_filter.channel_name(channel["channel_id"]) is None:
+                excluded_count += 1
                 continue
+            if self.scheduler is not None:
+                self.scheduler.observe(channel["channel_id"], channel["top_message"])
+            cursor = self.cursor_store.get(channel["channel_id"])
+            # 最新メッセージIDがカーソルから進んでいなければ履歴を取得しない
+            if cursor is not None and channel["top_message"] <= cursor:
+                unchanged_count += 1
+                continue
+            channels.append((channel, cursor))
+        deferred_count = 0
+        if self.scheduler is not None:
+            # 取得間隔が経過していない・RPCの予算を超えるチャンネルは次回以降に回す
+            selected = self.scheduler.select(channels, self.max_messages_per_channel)
+            deferred_count = len(channels) - len(selected)
+            channels = selected
         
-        print(f"\n処理完了: {processed_count}件のメッセージを処理しました")
-        print(f"  総ダイアログ数: {dialog_count}件")
-        print(f"  チャンネル数: {channel_count}件, 新規メッセージなし: {skipped_count}件")
-        print(f"  保存待ちメッセージ数: {len(self.all_messages)}件")
-        
-        # JSONファイルに保存
-        if self.all_messages:
-            print(f"\nJSONファイルに保存中: {self.output_file}")
-            self.save_messages_to_file()
-        else:
-            print(f"\n保存するメッセージがありません（output_file: {self.output_file}）")
-        
-        # 実行時刻を保存
-        self.save_last_run_time()
+        # チャンネルごとに並行して新しいメッセージを取得
+        self.channel_semaphore = asyncio.Semaphore(self.concurrency)
+        print(f"{len(channels)}件のチャンネルを同時実行数{self.concurrency}で処理します"
+              f"（更新なし: {unchanged_count}件, 次回以降に取得: {deferred_count}件, 除外: {excluded_count}件）")
+        autoflush_task = asyncio.create_task(self.sink.autoflush())
+        try:
+            results = await asyncio.gather(*[
+                self.crawl_channel(channel, cursor, initial_fetch_time)
+                for channel, cursor in channels
+            ])
+            # 以前の実行で記録したギャップを予算の範囲で取得
+            gap_processed = await self.fill_gaps()
+        finally:
+            autoflush_task.cancel()
+        processed_count = sum(results) + gap_processed
+        skipped_count = sum(1 for count in results if count == 0)
+        elapsed = time.monotonic() - started_at
         
-        # クライアントを切断
-        await self.telegram_client.disconnect()
+        print(f"\n処理完了: {processed_count}件のメッセージを処理しました")
+        print(f"  チャンネル数: {len(channels) + unchanged_count + deferred_count}件, 更新なし（取得せず）: {unchanged_count}件, "
+              f"次回以降に取得: {deferred_count}件, 新規メッセージなし: {skipped_count}件")
+        if self.scheduler is not None:
+            scheduler_stats = self.scheduler.stats()
+            print(f"  取得間隔が最短のチャンネル: {scheduler_stats['hot']}件, RPCの残り予算: {scheduler_stats['tokens']:.0f}回")
+        print(f"  書き込み済みメッセージ数: {self.sink.records_written}件, 書き込み待ち: {self.sink.records_pending}件")
+        print(f"  所要時間: {elapsed:.1f}秒（同時実行数: {self.concurrency}）")
+        cache_stats = self.sender_cache.stats()
+        print(f"  送信者キャッシュ: ヒット {cache_stats['hits']}件, ミス {cache_stats['misses']}件"
+              f"（ヒット率: {cache_stats['hit_rate']:.1f}%, 保持数: {cache_stats['size']}件）")
+        dedup_stats = self.dedup_index.stats()
+        print(f"  出力済みのためスキップ: {dedup_stats['duplicates']}件")
+        gap_stats = self.gap_queue.stats()
+        print(f"  ギャップから取得: {gap_processed}件, 残りのギャップ: {gap_stats['gaps']}区間（{gap_stats['channels']}チャンネル, "
+              f"最大{gap_stats['message_ids']}件, 最も古いもの: {gap_stats['oldest_age'] / 3600:.1f}時間前）")
     
     # reset telegram client session
     def logout_from_telegram_session(self):
@@ -0,0 +1,144 @@
+"""
+都度実行版の常駐モード
+
+1つのプロセスで接続を保ったまま、都度実行版と同じ取得（サイクル）をinterval秒ごとに繰り返します。
+ダイアログのスナップショット・送信者キャッシュ・索引はメモリに保持したまま使い、
+出力はサイクルごとに都度実行版と同じ日時付きのファイルに書き出します。
+    SIGTERM / SIGINT: 実行中のサイクルの終了を待って（stop_timeout秒を超えたら中断して）状態を保存し終了
+    SIGHUP: 次のサイクルの前にconfig.iniを読み直す（取り込み対象の判定と[CRON]の取得の設定）
+
+    python telegram_crawler_daemon.py
+"""
+
+import asyncio
+import configparser
+import signal
+import time
+import traceback
+
+from telegram_crawler_cron import TelegramCrawlerCron
+
+
+class TelegramCrawlerDaemon(TelegramCrawlerCron):
+    def __init__(self):
+        super().__init__()
+        self.load_daemon_settings(self.config)
+        self.stop_event = None
+        self.reload_requested = False
+
+    def load_daemon_settings(self, config):
+        self.interval = max(1, config.getint('DAEMON', 'interval', fallback=300))
+        self.stop_timeout = config.getint('DAEMON', 'stop_timeout', fallback=30)
+        self.reconnect_delay = max(1, config.getint('DAEMON', 'reconnect_delay', fallback=10))
+        self.reconnect_max_delay = max(self.reconnect_delay, config.getint('DAEMON', 'reconnect_max_delay', fallback=300))
+
+    def reload(self):
+        """config.iniを読み直す。不正な場合はそれまでの設定で続行"""
+        self.reload_requested = False
+        config = configparser.ConfigParser()
+        try:
+            if not config.read('config.ini'):
+                raise FileNotFoundError("config.ini が見つかりません")
+            self.apply_settings(config)
+            self.load_daemon_settings(config)
+        except Exception as e:
+            print(f"エラー: 設定の再読み込みに失敗しました（それまでの設定で続行します）: {e}")
+            return
+        self.config = config
+        print(f"設定を再読み込みしました（取得間隔: {self.interval}秒, 同時実行数: {self.concurrency}）")
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.stop_event.set)
+            loop.add_signal_handler(signal.SIGINT, self.stop_event.set)
+            loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+        except (NotImplementedError, AttributeError):
+            # Windowsではシグナルハンドラを登録できない（Ctrl+Cで終了）
+            print("警告: シグナルハンドラを登録できませんでした")
+
+    def request_reload(self):
+        print("SIGHUPを受信しました。次のサイクルの前に設定を再読み込みします")
+        self.reload_requested = True
+
+    async def ensure_connected(self):
+        """切断されていれば再接続する。失敗した場合は待機時間を倍にしながら（reconnect_max_delay秒まで）再試行する
+
+        接続できた場合はTrue、再接続を待つ間に終了の指示を受けた場合はFalseを返します。
+        """
+        delay = self.reconnect_delay
+        while not self.telegram_client.is_connected():
+            if self.stop_event.is_set():
+                return False
+            try:
+                await self.telegram_client.connect()
+            except Exception as e:
+                print(f"エラー: 再接続に失敗しました（{delay}秒後に再試行します）: {e}")
+            if self.telegram_client.is_connected():
+                print("再接続しました")
+                return True
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.reconnect_max_delay)
+        return True
+
+    async def run_cycle_until_stopped(self):
+        """1サイクルを実行。終了の指示があればstop_timeout秒まで待ってから中断する"""
+        cycle = asyncio.create_task(self.run_cycle())
+        stopping = asyncio.create_task(self.stop_event.wait())
+        try:
+            await asyncio.wait({cycle, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not cycle.done():
+                print(f"終了の指示を受けました。実行中のサイクルの終了を最大{self.stop_timeout}秒待ちます")
+                try:
+                    await asyncio.wait_for(asyncio.shield(cycle), timeout=self.stop_timeout)
+                except asyncio.TimeoutError:
+                    # 中断しても出力済みの分はrun_cycleが保存する（カーソルは進まないので次回取得し直す）
+                    cycle.cancel()
+                    await asyncio.gather(cycle, return_exceptions=True)
+                    print("実行中のサイクルを中断しました")
+                    return
+            cycle.result()
+        finally:
+            stopping.cancel()
+
+    async def serve(self):
+        """停止の指示があるまでinterval秒ごとにサイクルを実行"""
+        self.stop_event = asyncio.Event()
+        self.install_signal_handlers()
+        await self.telegram_client.start()
+        cycles = 0
+        try:
+            while not self.stop_event.is_set():
+                if self.reload_requested:
+                    self.reload()
+                # 接続が切れていれば（Telethonの自動再接続が諦めた場合など）サイクルの前に再接続する
+                if not await self.ensure_connected():
+                    break
+                if cycles:
+                    # サイクルごとに日時付きの出力ファイルを作成（前のサイクルの出力はrun_cycleで閉じている）
+                    self.open_sink(self.config)
+                started_at = time.monotonic()
+                print(f"\n=== サイクル{cycles + 1}を開始します ===")
+                try:
+                    await self.run_cycle_until_stopped()
+                except Exception as e:
+                    # 1サイクルの失敗（接続断など）では終了せず、次のサイクルで再試行する
+                    print(f"エラー: サイクルの実行中にエラーが発生しました: {e}")
+                    traceback.print_exc()
+                cycles += 1
+                wait = max(0, self.interval - (time.monotonic() - started_at))
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.close()
+            print(f"常駐モードを終了しました（{cycles}サイクル）")
+
+
+if __name__ == "__main__":
+    crawler = TelegramCrawlerDaemon()
+    asyncio.run(crawler.serve())
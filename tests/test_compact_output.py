@@ -0,0 +1,25 @@
+import os
+
+from compact_output import OutputCompactor
+from output_sink import JsonlFileSink
+
+
+def test_adopts_stale_partial_files_not_locked_by_a_writer(tmp_path):
+    stale = tmp_path / "20260101_000000_telegram_messages.jsonl"
+    live = tmp_path / "20260101_010000_telegram_messages.jsonl"
+    with open(str(stale) + ".partial", "w", encoding="utf-8") as f:
+        f.write('{"1": {"message_id": 1, "JST_send_time": "2026/01/01 09:00:00"}}\n{"1": {"messa')
+    sink = JsonlFileSink(str(live), buffer_size=1)
+    sink.write({"1": {"message_id": 2, "JST_send_time": "2026/01/01 10:00:00"}})
+    for path in (str(stale) + ".partial", str(live) + ".partial"):
+        os.utime(path, (0, 0))
+
+    compactor = OutputCompactor(partition_dir=str(tmp_path / "partitions"), min_age=600)
+    compactor.compact([str(tmp_path / "[0-9]*_[0-9]*_telegram_messages.jsonl")])
+
+    assert compactor.files_compacted == 1
+    assert compactor.records_read == 1
+    assert not os.path.exists(str(stale) + ".partial")
+    assert os.path.exists(str(live) + ".partial")
+    sink.close()
+    assert os.path.exists(live)
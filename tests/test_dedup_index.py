@@ -0,0 +1,19 @@
+from dedup_index import DedupIndex
+
+
+def test_compact_keeps_keys_compacted_by_another_process(tmp_path):
+    path = str(tmp_path / "dedup")
+    a = DedupIndex(path, expected_items=1000)
+    b = DedupIndex(path, expected_items=1000)
+    b.add(1, 1)
+    b.flush()
+    c = DedupIndex(path, expected_items=1000)
+    c.compact()
+    a.add(2, 2)
+    a.compact()
+
+    reopened = DedupIndex(path, expected_items=1000)
+    assert reopened.contains(1, 1)
+    assert reopened.contains(2, 2)
+    for index in (a, b, c, reopened):
+        index.close()
@@ -0,0 +1,17 @@
+from telethon.tl import types
+
+from indicator_index import normalize_url
+from message_extractor import extract_entities
+
+
+def test_url_entity_offsets_are_utf16_code_units():
+    text = "🔥🔥 see https://example.com/x ok"
+    entities = extract_entities([types.MessageEntityUrl(offset=9, length=21)], text)
+    assert entities[0]["url"] == "https://example.com/x"
+
+
+def test_normalize_url_accepts_only_http_and_https():
+    assert normalize_url("hxxps://evil[.]com/a") == "https://evil.com/a"
+    assert normalize_url("example.com:8080/a") == "http://example.com:8080/a"
+    for url in ("mailto:a@example.com", "tg://resolve?domain=x", "ftp://example.com/a", "javascript:alert(1)"):
+        assert normalize_url(url) is None
@@ -0,0 +1,17 @@
+from text_index import TextIndex
+
+
+def test_merges_only_segments_of_similar_size(tmp_path):
+    index = TextIndex(str(tmp_path / "text_index.db"), batch_size=10, max_segments=4)
+    for message_id in range(1, 161):
+        index.add_record({"1": {"message_id": message_id, "JST_send_time": "2026/01/01 09:00:00", "message": "hello"}})
+    index.sync()
+
+    sizes = [doc_count for (doc_count,) in index.connection.execute("SELECT doc_count FROM segments")]
+    assert sorted(sizes) == [160]
+    index.add_record({"1": {"message_id": 161, "JST_send_time": "2026/01/01 09:00:00", "message": "hello"}})
+    index.sync()
+    sizes = [doc_count for (doc_count,) in index.connection.execute("SELECT doc_count FROM segments")]
+    assert sorted(sizes) == [1, 160]
+    assert len(index.search("hello", limit=1000)) == 161
+    index.close()
@@ -0,0 +1,356 @@
+"""
+メッセージ本文の全文検索用の転置索引
+
+クローラーが出力したレコードの本文（message）を単語に分け、単語 -> メッセージの一覧をSQLiteに保存します。
+    英数字などはNFKC正規化・小文字化した単語ごと
+    日本語・中国語・韓国語の連続部分は文字のバイグラム（と末尾の1文字）ごと
+索引はbatch_size件ごとに「セグメント」として追記し、同程度の大きさ（件数がmax_segments倍ごとの階層）の
+セグメントがmax_segments個に達したらそれらを1つにマージします（1件あたりのマージの回数は全体の件数の対数程度）。
+書き込みとマージは専用スレッドが行い、呼び出し元（イベントループ）を止めません。
+複数の単語を指定した検索はすべてを含むメッセージ（AND）を新しい順に返します。
+
+    python text_index.py [--index output/text_index.db] search 検索語 [--channel ID] [--limit 100]
+    python text_index.py [--index output/text_index.db] build output/*.jsonl
+    python text_index.py [--index output/text_index.db] merge|stats
+"""
+
+import argparse
+import array
+import glob
+import gzip
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import traceback
+import unicodedata
+import zlib
+
+# ひらがな・カタカナ、CJK統合漢字（拡張A・互換漢字を含む）、ハングル（半角カナはNFKC正規化で全角になる）
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+TOKEN_PATTERN = re.compile(f"([{CJK}]+)|([^\\W{CJK}]+)")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    sent_at TEXT,
+    UNIQUE (channel_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS segments (
+    segment_id INTEGER PRIMARY KEY,
+    doc_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    segment_id INTEGER NOT NULL,
+    docs BLOB NOT NULL,  -- doc_idの差分（昇順）をarray('Q')にしてzlib圧縮
+    PRIMARY KEY (term, segment_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_postings_segment ON postings (segment_id);
+"""
+
+
+def tokenize(text):
+    """本文を索引の単語に分ける（重複あり、出現順）"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    for match in TOKEN_PATTERN.finditer(text):
+        cjk, word = match.groups()
+        if word:
+            yield word
+            continue
+        # バイグラムと、どのバイグラムの先頭にもならない末尾の1文字（1文字での前方一致検索に使う）
+        for index in range(len(cjk) - 1):
+            yield cjk[index:index + 2]
+        yield cjk[-1]
+
+
+def _encode(doc_ids):
+    deltas = array.array('Q', (current - previous for previous, current in zip([0] + doc_ids, doc_ids)))
+    return zlib.compress(deltas.tobytes())
+
+
+def _decode(blob):
+    deltas = array.array('Q')
+    deltas.frombytes(zlib.decompress(blob))
+    return itertools.accumulate(deltas)
+
+
+class TextIndex:
+    """本文の転置索引
+
+    add_record()でクローラーの出力レコードを追加し、batch_size件溜まるかflush()を呼んだときに
+    書き込みスレッドへ渡して新しいセグメントとして書き込みます。同じメッセージを再度追加した場合は無視します。
+    検索（search・stats）は呼び出し元のスレッドの接続で行います。
+    """
+
+    def __init__(self, path, batch_size=1000, max_segments=8):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.max_segments = max(2, max_segments)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.buffer = []  # (channel_id, message_id, sent_at, text)
+        self.documents_indexed = 0  # 書き込みスレッドが更新する
+        self.batches = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="text-index-writer", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """config.iniの[INDEX]から作成（text_index_fileが空欄ならNone）"""
+        path = config.get('INDEX', 'text_index_file', fallback='')
+        if not path:
+            return None
+        return cls(
+            path,
+            batch_size=config.getint('INDEX', 'text_index_batch_size', fallback=1000),
+            max_segments=config.getint('INDEX', 'text_index_max_segments', fallback=8)
+        )
+
+    # --- 追加 ---------------------------------------------------------------
+
+    def add_record(self, record):
+        """出力レコード（{channel_id: {...}}）の本文を追加"""
+        for channel_id, body in record.items():
+            text = body.get("message")
+            if text:
+                self.buffer.append((int(channel_id), body["message_id"], body.get("JST_send_time"), text))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """溜まった分を書き込みスレッドへ渡す（書き込み・マージを待たない）"""
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        self.batches.put(batch)
+
+    def sync(self):
+        """溜まった分を渡し、それまでの書き込みとマージが終わるまで待つ"""
+        self.flush()
+        done = threading.Event()
+        self.batches.put(done)
+        done.wait()
+
+    # --- 書き込みスレッド ---------------------------------------------------
+
+    def _run(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, threading.Event):
+                    # sync()の待ち合わせ（キューの順に処理するので、それより前のバッチは処理済み）
+                    batch.set()
+                    continue
+                try:
+                    self._write_segment(connection, batch)
+                    self._merge_tiers(connection)
+                except Exception as e:
+                    print(f"エラー: 全文検索の索引への書き込みに失敗しました（{len(batch)}件）: {e}")
+                    traceback.print_exc()
+        finally:
+            connection.close()
+
+    def _write_segment(self, connection, batch):
+        postings = {}
+        added = 0
+        with connection:
+            for channel_id, message_id, sent_at, text in batch:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO docs (channel_id, message_id, sent_at) VALUES (?, ?, ?)",
+                    (channel_id, message_id, sent_at)
+                )
+                if not cursor.rowcount:
+                    continue  # 索引済み
+                for term in set(tokenize(text)):
+                    postings.setdefault(term, []).append(cursor.lastrowid)
+                added += 1
+            if postings:
+                segment_id = connection.execute(
+                    "INSERT INTO segments (doc_count) VALUES (?)", (added,)
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO postings (term, segment_id, docs) VALUES (?, ?, ?)",
+                    ((term, segment_id, _encode(doc_ids)) for term, doc_ids in postings.items())
+                )
+        self.documents_indexed += added
+
+    # --- セグメントのマージ -------------------------------------------------
+
+    def segment_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+    def _tier(self, doc_count):
+        """セグメントの階層（batch_size件以下が0、そこからmax_segments倍ごとに1つ上）"""
+        tier, size = 0, self.batch_size
+        while doc_count > size:
+            tier, size = tier + 1, size * self.max_segments
+        return tier
+
+    def _merge_tiers(self, connection):
+        """同じ階層にmax_segments個以上あるセグメントを、下の階層から古い順にmax_segments個ずつマージ"""
+        while True:
+            tiers = {}
+            for segment_id, doc_count in connection.execute(
+                "SELECT segment_id, doc_count FROM segments ORDER BY segment_id"
+            ):
+                tiers.setdefault(self._tier(doc_count), []).append((segment_id, doc_count))
+            full = [rows for _, rows in sorted(tiers.items()) if len(rows) >= self.max_segments]
+            if not full:
+                return
+            self._merge_segments(connection, full[0][:self.max_segments])
+
+    def merge(self):
+        """すべてのセグメントを1つにマージ（書き込みが終わるのを待ってから呼び出し元のスレッドで行う）"""
+        self.sync()
+        rows = self.connection.execute("SELECT segment_id, doc_count FROM segments").fetchall()
+        self._merge_segments(self.connection, rows)
+
+    def _merge_segments(self, connection, rows):
+        """rows（(segment_id, doc_count)のリスト）のセグメントを1つにマージ"""
+        if len(rows) < 2:
+            return
+        segment_ids = [segment_id for segment_id, _ in rows]
+        placeholders = ",".join("?" * len(segment_ids))
+        with connection:
+            merged_id = connection.execute(
+                "INSERT INTO segments (doc_count) VALUES (?)", (sum(doc_count for _, doc_count in rows),)
+            ).lastrowid
+            terms = connection.execute(
+                f"SELECT term, docs FROM postings WHERE segment_id IN ({placeholders}) ORDER BY term",
+                segment_ids
+            )
+            connection.executemany(
+                "INSERT INTO postings (term, segment_id, docs) VALUES (?, ?, ?)",
+                (
+                    (term, merged_id, _encode(sorted(set().union(*(_decode(blob) for _, blob in group)))))
+                    for term, group in itertools.groupby(terms, key=lambda row: row[0])
+                )
+            )
+            connection.execute(f"DELETE FROM postings WHERE segment_id IN ({placeholders})", segment_ids)
+            connection.execute(f"DELETE FROM segments WHERE segment_id IN ({placeholders})", segment_ids)
+
+    # --- 検索 ---------------------------------------------------------------
+
+    def _lookup(self, term, prefix):
+        """単語を含むdoc_idの集合（prefix=Trueなら前方一致）"""
+        if prefix:
+            rows = self.connection.execute(
+                "SELECT docs FROM postings WHERE term >= ? AND term < ?", (term, term + "\U0010ffff")
+            )
+        else:
+            rows = self.connection.execute("SELECT docs FROM postings WHERE term = ?", (term,))
+        doc_ids = set()
+        for (blob,) in rows:
+            doc_ids.update(_decode(blob))
+        return doc_ids
+
+    def search(self, query, channel_id=None, limit=100):
+        """queryの単語をすべて含むメッセージを新しい順に返す: [(channel_id, message_id, sent_at), ...]
+
+        日本語などは文字のバイグラムで照合するため、バイグラムがすべて含まれていれば
+        検索語がそのまま連続していないメッセージも返る場合があります。
+        """
+        terms = sorted(set(tokenize(query)), key=len, reverse=True)
+        if not terms:
+            return []
+        # 1文字の日本語などはその文字で始まる単語の前方一致
+        single_chars = {term for term in terms if len(term) == 1 and re.match(f"[{CJK}]", term)}
+        candidates = None
+        for term in terms:
+            doc_ids = self._lookup(term, term in single_chars)
+            candidates = doc_ids if candidates is None else candidates & doc_ids
+            if not candidates:
+                return []
+        hits = []
+        # doc_idは追加順なので、大きい順に読めば概ね新しい順になる
+        ordered = sorted(candidates, reverse=True)
+        for start in range(0, len(ordered), 500):
+            chunk = ordered[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            sql = f"SELECT channel_id, message_id, sent_at FROM docs WHERE doc_id IN ({placeholders})"
+            parameters = list(chunk)
+            if channel_id is not None:
+                sql += " AND channel_id = ?"
+                parameters.append(int(channel_id))
+            hits.extend(self.connection.execute(sql, parameters).fetchall())
+            if len(hits) >= limit:
+                break
+        hits.sort(key=lambda hit: (hit[2] or "", hit[1]), reverse=True)
+        return hits[:limit]
+
+    def stats(self):
+        return {
+            "documents": self.connection.execute("SELECT COUNT(*) FROM docs").fetchone()[0],
+            "terms": self.connection.execute("SELECT COUNT(DISTINCT term) FROM postings").fetchone()[0],
+            "segments": self.segment_count(),
+        }
+
+    def close(self):
+        """残りを書き込み、書き込みスレッドの終了を待つ"""
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()
+        self.connection.close()
+
+
+def index_jsonl_files(index, paths):
+    """既存のJSONLファイルを索引に追加（gzip圧縮したパーティションも可）"""
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    index.add_record(json.loads(line))
+                except (json.JSONDecodeError, AttributeError, KeyError):
+                    print(f"警告: {path} の不正な行をスキップしました")
+    index.sync()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="メッセージ本文の全文検索")
+    parser.add_argument("--index", default="output/text_index.db", help="索引のパス（デフォルト: output/text_index.db）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    search_parser = subparsers.add_parser("search", help="検索語をすべて含むメッセージを新しい順に表示")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--channel", type=int, help="チャンネルIDで絞り込む")
+    search_parser.add_argument("--limit", type=int, default=100)
+    build_parser = subparsers.add_parser("build", help="JSONLファイル（globパターン可）を索引に追加")
+    build_parser.add_argument("paths", nargs="+")
+    subparsers.add_parser("merge", help="すべてのセグメントを1つにマージ")
+    subparsers.add_parser("stats", help="件数を表示")
+    args = parser.parse_args()
+
+    index = TextIndex(args.index)
+    if args.command == "search":
+        started_at = time.perf_counter()
+        hits = index.search(args.query, channel_id=args.channel, limit=args.limit)
+        for channel_id, message_id, sent_at in hits:
+            print(f"{sent_at}\t{channel_id}\t{message_id}")
+        print(f"{len(hits)}件（{(time.perf_counter() - started_at) * 1000:.1f}ms）")
+    elif args.command == "build":
+        index_jsonl_files(index, sorted({path for pattern in args.paths for path in glob.glob(pattern)}))
+        print(f"{index.documents_indexed}件を追加しました")
+    elif args.command == "merge":
+        index.merge()
+    stats = index.stats()
+    print(f"メッセージ: {stats['documents']}件, 単語: {stats['terms']}種類, セグメント: {stats['segments']}個")
+    index.close()